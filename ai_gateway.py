@@ -0,0 +1,136 @@
+# =================================================================
+# 🧠 KAIA AI GATEWAY – بوابة الاتصال غير المتزامن مع OpenAI
+# =================================================================
+# كل استدعاءات النموذج تمر من هنا حتى لا يتجمد الـ event loop أثناء
+# انتظار رد الرؤية (Vision) الذي قد يستغرق عدة ثوانٍ.
+
+import os
+import asyncio
+import random
+from collections import deque
+
+from openai import AsyncOpenAI, APIStatusError, APITimeoutError, APIConnectionError
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+# الحد الأقصى للاستدعاءات المتزامنة لكل عامل (Worker)
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+# مهلة الطلب الواحد بالثواني
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+# عدد إعادة المحاولة عند 429 / 5xx وزمن التراجع الأساسي
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+
+# إعادة المحاولة تُدار يدوياً هنا، لذلك نعطّل إعادة المحاولة الداخلية في المكتبة
+# (OPENAI_BASE_URL يُقرأ تلقائياً من البيئة، مفيد لتوجيه الطلبات لخادم محلي)
+async_client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    timeout=OPENAI_TIMEOUT,
+    max_retries=0,
+)
+
+_semaphore = None
+
+
+def _get_semaphore():
+    # يُنشأ عند أول استخدام ليرتبط بحلقة الأحداث الخاصة بالعامل
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+    return _semaphore
+
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, (APITimeoutError, APIConnectionError)):
+        return True
+    if isinstance(exc, APIStatusError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    return False
+
+
+def _backoff_delay(attempt: int) -> float:
+    # تراجع أُسّي مع تشويش عشوائي (Full Jitter)
+    return random.uniform(0, OPENAI_BACKOFF_BASE * (2 ** attempt))
+
+
+# -----------------------------------------------------------------
+# 2. الاستدعاء الموحد (Chat Completion with Limiter + Retry)
+# -----------------------------------------------------------------
+
+async def create_chat_completion(**kwargs):
+    attempt = 0
+    while True:
+        try:
+            async with _get_semaphore():
+                return await async_client.chat.completions.create(**kwargs)
+        except Exception as e:
+            if attempt >= OPENAI_MAX_RETRIES or not _is_retryable(e):
+                raise
+            # الانتظار يتم خارج السيمافور حتى لا نحجز مقعداً بلا فائدة
+            await asyncio.sleep(_backoff_delay(attempt))
+            attempt += 1
+
+
+# -----------------------------------------------------------------
+# 3. البث اللحظي للردود (Streaming Completion)
+# -----------------------------------------------------------------
+
+async def stream_chat_completion(**kwargs):
+    # مولّد غير متزامن يعيد أجزاء النص فور وصولها؛ إعادة المحاولة تتم فقط قبل أول جزء
+    semaphore = _get_semaphore()
+    attempt = 0
+    while True:
+        await semaphore.acquire()
+        try:
+            stream = await async_client.chat.completions.create(stream=True, **kwargs)
+            break
+        except Exception as e:
+            semaphore.release()
+            if attempt >= OPENAI_MAX_RETRIES or not _is_retryable(e):
+                raise
+            await asyncio.sleep(_backoff_delay(attempt))
+            attempt += 1
+
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    finally:
+        # عند انقطاع العميل يُلغى المولّد فنغلق الاتصال مع OpenAI فوراً لوقف توليد التوكنات
+        await stream.close()
+        semaphore.release()
+
+
+# -----------------------------------------------------------------
+# 4. مقاييس زمن أول بايت (Time-To-First-Byte Metrics)
+# -----------------------------------------------------------------
+
+METRICS = {"ttfb": deque(maxlen=1000), "streams_started": 0, "streams_cancelled": 0}
+
+
+def record_ttfb(seconds: float):
+    METRICS["ttfb"].append(seconds)
+
+
+def metrics_summary() -> dict:
+    samples = sorted(METRICS["ttfb"])
+
+    def pct(p):
+        if not samples:
+            return None
+        return round(samples[min(len(samples) - 1, int(p * len(samples)))], 3)
+
+    return {
+        "ttfb_p50": pct(0.50),
+        "ttfb_p95": pct(0.95),
+        "ttfb_p99": pct(0.99),
+        "ttfb_samples": len(samples),
+        "streams_started": METRICS["streams_started"],
+        "streams_cancelled": METRICS["streams_cancelled"],
+        "max_concurrency": OPENAI_MAX_CONCURRENCY,
+    }
@@ -0,0 +1,219 @@
+# =================================================================
+# 🗄️ KAIA ANALYSIS CACHE – ذاكرة نتائج التحليل حسب محتوى الصورة
+# =================================================================
+# المفتاح = بصمة SHA-256 لبايتات الصورة + الإطار الزمني + نوع التحليل + اللغة.
+# عند التطابق نعيد النتيجة المثبتة (normalize_kaia_output) دون استدعاء OpenAI.
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func
+
+import db_writer
+from database import SessionLocal, AnalysisCacheEntry
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+# memory: داخل العامل فقط | sql: مشتركة بين كل عمال gunicorn | off: معطلة
+ANALYSIS_CACHE_BACKEND = os.getenv("ANALYSIS_CACHE_BACKEND", "sql").lower()
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", str(6 * 3600)))
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "5000"))
+# هل يُخصم رصيد عند إعادة نتيجة محفوظة؟
+ANALYSIS_CACHE_CHARGE_ON_HIT = os.getenv("ANALYSIS_CACHE_CHARGE_ON_HIT", "true").lower() in ("1", "true", "yes")
+# عدادات الإصابة (hits / last_hit_at) تُجمع في الذاكرة وتُكتب دفعة واحدة كل هذه المدة (ثوانٍ)
+ANALYSIS_CACHE_HIT_FLUSH = float(os.getenv("ANALYSIS_CACHE_HIT_FLUSH", "5"))
+
+
+def make_key(image_bytes: bytes, timeframe: str, analysis_type: str, lang: str) -> str:
+    h = hashlib.sha256(image_bytes)
+    for part in (timeframe, analysis_type, lang):
+        h.update(b"\x00")
+        h.update((part or "").encode("utf-8"))
+    return h.hexdigest()
+
+
+# -----------------------------------------------------------------
+# 2. الذاكرة الداخلية (In-Process LRU Backend)
+# -----------------------------------------------------------------
+
+class MemoryBackend:
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, touch: bool = True):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            if touch:
+                self._data.move_to_end(key)
+            return json.loads(value)
+
+    def put(self, key: str, value: dict):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, json.dumps(value, ensure_ascii=False))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def size(self) -> int:
+        return len(self._data)
+
+
+# -----------------------------------------------------------------
+# 3. الذاكرة المشتركة عبر قاعدة البيانات (Shared SQL Backend)
+# -----------------------------------------------------------------
+
+def write_hits(db, hits: dict):
+    # دالة كتابة لـ db_writer: {المفتاح: (عدد الإصابات, آخر إصابة)}
+    for key, (count, last_hit_at) in hits.items():
+        db.query(AnalysisCacheEntry).filter(AnalysisCacheEntry.cache_key == key).update({
+            "hits": func.coalesce(AnalysisCacheEntry.hits, 0) + count,
+            "last_hit_at": last_hit_at,
+        }, synchronize_session=False)
+
+
+class SQLBackend:
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._hits = {}
+        self._hits_lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def get(self, key: str, touch: bool = True):
+        # قراءة فقط: المنتهي يُحذف في _evict عند الإضافة التالية، والإصابة تُسجل في الذاكرة
+        db = SessionLocal()
+        try:
+            entry = db.query(AnalysisCacheEntry).filter(AnalysisCacheEntry.cache_key == key).first()
+        finally:
+            db.close()
+        if entry is None:
+            return None
+        now = datetime.now(timezone.utc)
+        created = entry.created_at.replace(tzinfo=timezone.utc) if entry.created_at.tzinfo is None else entry.created_at
+        if created + timedelta(seconds=self.ttl) < now:
+            return None
+        if touch:
+            self._touch(key, now)
+        return json.loads(entry.result)
+
+    def _touch(self, key: str, now):
+        # تحديث وقت آخر استخدام ليعمل الإخلاء بأسلوب LRU: دفعة عبر db_writer بدل معاملة كتابة لكل إصابة
+        with self._hits_lock:
+            count, _ = self._hits.get(key, (0, None))
+            self._hits[key] = (count + 1, now)
+            if time.monotonic() - self._flushed_at < ANALYSIS_CACHE_HIT_FLUSH:
+                return
+            hits, self._hits = self._hits, {}
+            self._flushed_at = time.monotonic()
+        try:
+            db_writer.submit(write_hits, hits)
+        except Exception as e:
+            print(f"Analysis Cache Error: {e}")
+
+    def put(self, key: str, value: dict):
+        db = SessionLocal()
+        try:
+            now = datetime.now(timezone.utc)
+            db.merge(AnalysisCacheEntry(
+                cache_key=key,
+                result=json.dumps(value, ensure_ascii=False),
+                hits=0,
+                created_at=now,
+                last_hit_at=now,
+            ))
+            db.commit()
+            self._evict(db, now)
+        except Exception as e:
+            # سباق بين عاملين على نفس المفتاح لا يجب أن يُفشل التحليل
+            db.rollback()
+            print(f"Analysis Cache Error: {e}")
+        finally:
+            db.close()
+
+    def _evict(self, db, now):
+        cutoff = now - timedelta(seconds=self.ttl)
+        db.query(AnalysisCacheEntry).filter(AnalysisCacheEntry.created_at < cutoff).delete(synchronize_session=False)
+        overflow = db.query(AnalysisCacheEntry).count() - self.max_entries
+        if overflow > 0:
+            oldest = (
+                db.query(AnalysisCacheEntry.cache_key)
+                .order_by(AnalysisCacheEntry.last_hit_at.asc())
+                .limit(overflow)
+                .scalar_subquery()
+            )
+            db.query(AnalysisCacheEntry).filter(AnalysisCacheEntry.cache_key.in_(oldest)).delete(synchronize_session=False)
+        db.commit()
+
+    def size(self) -> int:
+        db = SessionLocal()
+        try:
+            return db.query(AnalysisCacheEntry).count()
+        finally:
+            db.close()
+
+
+# -----------------------------------------------------------------
+# 4. الواجهة الموحدة + العدادات (Facade & Hit/Miss Counters)
+# -----------------------------------------------------------------
+
+if ANALYSIS_CACHE_BACKEND == "memory":
+    _backend = MemoryBackend(ANALYSIS_CACHE_TTL, ANALYSIS_CACHE_MAX_ENTRIES)
+elif ANALYSIS_CACHE_BACKEND == "sql":
+    _backend = SQLBackend(ANALYSIS_CACHE_TTL, ANALYSIS_CACHE_MAX_ENTRIES)
+else:
+    _backend = None
+
+STATS = {"hits": 0, "misses": 0}
+
+
+def get(key: str):
+    if _backend is None:
+        return None
+    try:
+        value = _backend.get(key)
+    except Exception as e:
+        print(f"Analysis Cache Error: {e}")
+        value = None
+    STATS["hits" if value is not None else "misses"] += 1
+    return value
+
+
+def peek(key: str):
+    # قراءة فقط: لا STATS ولا hits/last_hit_at ولا ترتيب LRU (تُستخدم أثناء انتظار تحليل جارٍ في عامل آخر)
+    if _backend is None:
+        return None
+    try:
+        return _backend.get(key, touch=False)
+    except Exception:
+        return None
+
+
+def put(key: str, value: dict):
+    if _backend is not None:
+        _backend.put(key, value)
+
+
+def stats() -> dict:
+    return {
+        "backend": ANALYSIS_CACHE_BACKEND,
+        "hits": STATS["hits"],
+        "misses": STATS["misses"],
+        "entries": _backend.size() if _backend is not None else 0,
+        "charge_on_hit": ANALYSIS_CACHE_CHARGE_ON_HIT,
+    }
@@ -0,0 +1,269 @@
+# =================================================================
+# 🖼️ KAIA ARTICLE IMAGES – نسخ متعددة المقاسات لصور المقالات (srcset)
+# =================================================================
+# صورة المقال الأصلية تُحفظ كما رُفعت (بعد التحقق)، ثم يولد عامل خلفي نسخاً
+# بعروض متعددة وبصيغة حديثة (WEBP) بجانبها:
+#   art_<id>.png  ->  art_<id>.w320.webp, art_<id>.w640.webp, art_<id>.w1024.webp
+# ووصف النسخ (srcset + الأبعاد) يُحفظ في الملف المرافق art_<id>.png.json ويُنسخ
+# إلى عمود articles.image_variants، فيختار المتصفح أصغر نسخة تكفي مساحة العرض.
+# القياس: python article_images.py [صورة ...] يطبع البايتات قبل وبعد.
+
+import io
+import os
+import sys
+import json
+import uuid
+import shutil
+import asyncio
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+from starlette.concurrency import run_in_threadpool
+
+import image_pipeline
+import storage_manager
+from chart_storage import STORAGE_PATH
+from database import SessionLocal, Article
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+ARTICLE_IMAGE_WIDTHS = sorted({int(w) for w in os.getenv("ARTICLE_IMAGE_WIDTHS", "320,640,1024").split(",") if w.strip()})
+ARTICLE_IMAGE_QUALITY = int(os.getenv("ARTICLE_IMAGE_QUALITY", "78"))
+ARTICLE_IMAGE_WORKERS = int(os.getenv("ARTICLE_IMAGE_WORKERS", "1"))
+# عرض بطاقة المقال في الصفحة الرئيسية (CSS px) - يُستخدم في القياس فقط
+ARTICLE_CARD_WIDTH = int(os.getenv("ARTICLE_CARD_WIDTH", "360"))
+
+VARIANT_FORMAT = "WEBP"
+VARIANT_MIME = "image/webp"
+IMAGE_URL_PREFIX = "/images/"
+
+_EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp", "GIF": "gif"}
+
+_queue = None
+
+
+# -----------------------------------------------------------------
+# 2. حفظ الأصل عند الرفع (Validate + Store Original)
+# -----------------------------------------------------------------
+
+def _verify(path: str):
+    try:
+        with Image.open(path) as probe:
+            image_pipeline.check_dimensions(probe)
+            probe.verify()
+    except Image.DecompressionBombError as e:
+        raise image_pipeline.InvalidImageError("أبعاد الصورة كبيرة جداً") from e
+    except (UnidentifiedImageError, OSError, SyntaxError) as e:
+        raise image_pipeline.InvalidImageError("صيغة الصورة غير مدعومة") from e
+
+
+def save_upload(upload) -> str:
+    # upload: ReceivedUpload من chart_storage (تدفق + حد الحجم + فحص التوقيع)
+    _verify(upload.path)
+    name = f"art_{uuid.uuid4()}.{_EXTENSIONS[upload.source_format]}"
+    # الملف المؤقت قد يكون على قرص آخر: shutil.move بدل os.replace
+    shutil.move(upload.path, os.path.join(STORAGE_PATH, name))
+    return name
+
+
+def name_from_url(image_url: str):
+    if not image_url or not image_url.startswith(IMAGE_URL_PREFIX):
+        return None
+    name = image_url[len(IMAGE_URL_PREFIX):].split("?", 1)[0]
+    return name if name.startswith("art_") and "/" not in name else None
+
+
+def variant_name(name: str, width: int) -> str:
+    stem = name.split(".", 1)[0]
+    return f"{stem}.w{width}.webp"
+
+
+# -----------------------------------------------------------------
+# 3. توليد النسخ (Variant Generation)
+# -----------------------------------------------------------------
+
+def _encode(img, width: int) -> bytes:
+    if img.size[0] > width:
+        height = max(1, round(img.size[1] * width / img.size[0]))
+        img = img.resize((width, height), Image.LANCZOS)
+    buffer = io.BytesIO()
+    img.save(buffer, VARIANT_FORMAT, quality=ARTICLE_IMAGE_QUALITY, method=6)
+    return buffer.getvalue()
+
+
+def _open_normalized(path: str):
+    img = Image.open(path)
+    img.load()
+    img = ImageOps.exif_transpose(img)
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    return img.convert("RGBA" if has_alpha else "RGB")
+
+
+def _widths_for(original_width: int) -> list:
+    # لا نكبّر الصورة: العروض الأكبر من الأصل تُستبدل بعرض الأصل نفسه
+    widths = [w for w in ARTICLE_IMAGE_WIDTHS if w < original_width]
+    if not widths or original_width <= ARTICLE_IMAGE_WIDTHS[-1]:
+        widths.append(original_width)
+    return widths
+
+
+def _atomic_write(path: str, data: bytes):
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def generate_variants(name: str) -> dict:
+    source = os.path.join(STORAGE_PATH, name)
+    img = _open_normalized(source)
+    width, height = img.size
+
+    variants = []
+    for w in _widths_for(width):
+        out_name = variant_name(name, w)
+        data = _encode(img, w)
+        _atomic_write(os.path.join(STORAGE_PATH, out_name), data)
+        variants.append({"name": out_name, "width": min(w, width), "bytes": len(data)})
+
+    manifest = {
+        "width": width,
+        "height": height,
+        "type": VARIANT_MIME,
+        "original_bytes": os.path.getsize(source),
+        "variants": variants,
+    }
+    _atomic_write(image_pipeline.meta_path(source), json.dumps(manifest).encode("utf-8"))
+    return manifest
+
+
+def load_manifest(name: str):
+    try:
+        with open(image_pipeline.meta_path(os.path.join(STORAGE_PATH, name))) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def public_variants(manifest: dict):
+    # الشكل الذي تستهلكه الواجهة: <img srcset="..." width height>
+    if not manifest or not manifest.get("variants"):
+        return None
+    return {
+        "srcset": ", ".join(f"{IMAGE_URL_PREFIX}{v['name']} {v['width']}w" for v in manifest["variants"]),
+        "width": manifest["width"],
+        "height": manifest["height"],
+        "type": manifest["type"],
+    }
+
+
+def variants_for_url(image_url: str):
+    # عند حفظ المقال: إذا كانت النسخ جاهزة مسبقاً نربطها فوراً، وإلا يملؤها العامل لاحقاً
+    name = name_from_url(image_url)
+    return public_variants(load_manifest(name)) if name else None
+
+
+def process(name: str):
+    # يُنفَّذ في خيط منفصل: Pillow يحرر GIL أثناء فك وضغط الصور
+    manifest = load_manifest(name) or generate_variants(name)
+    for v in manifest["variants"]:
+        storage_manager.register(v["name"], "article", v["bytes"])
+
+    db = SessionLocal()
+    try:
+        # تحديث جماعي: response_cache يلتقطه ويبطل كاش /api/articles
+        db.query(Article).filter(Article.image_url == f"{IMAGE_URL_PREFIX}{name}").update(
+            {"image_variants": public_variants(manifest)}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+# -----------------------------------------------------------------
+# 4. العامل الخلفي (Background Worker)
+# -----------------------------------------------------------------
+
+def schedule(name: str):
+    if _queue is not None:
+        _queue.put_nowait(name)
+
+
+def _pending_names() -> list:
+    # صور مقالات منشورة بلا نسخ (رُفعت قبل هذه الميزة أو توقف العامل قبل إنهائها)
+    db = SessionLocal()
+    try:
+        urls = [u for (u,) in db.query(Article.image_url).filter(Article.image_variants.is_(None)).distinct().all()]
+    finally:
+        db.close()
+    names = []
+    for url in urls:
+        name = name_from_url(url)
+        if name and os.path.exists(os.path.join(STORAGE_PATH, name)):
+            names.append(name)
+    return names
+
+
+async def _worker():
+    while True:
+        name = await _queue.get()
+        try:
+            await run_in_threadpool(process, name)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Article Images Error ({name}): {e}")
+        finally:
+            _queue.task_done()
+
+
+async def _backfill():
+    try:
+        for name in await run_in_threadpool(_pending_names):
+            schedule(name)
+    except Exception as e:
+        print(f"Article Images Error: {e}")
+
+
+def start_workers() -> list:
+    global _queue
+    _queue = asyncio.Queue()
+    tasks = [asyncio.create_task(_worker()) for _ in range(max(1, ARTICLE_IMAGE_WORKERS))]
+    tasks.append(asyncio.create_task(_backfill()))
+    return tasks
+
+
+# -----------------------------------------------------------------
+# 5. القياس (Bytes per Landing Page View)
+# -----------------------------------------------------------------
+
+def _pick(variants: list, needed: int) -> dict:
+    # نفس اختيار المتصفح من srcset: أصغر نسخة عرضها يغطي العرض المطلوب
+    fitting = [v for v in variants if v["width"] >= needed]
+    return min(fitting, key=lambda v: v["width"]) if fitting else max(variants, key=lambda v: v["width"])
+
+
+def benchmark(paths: list) -> dict:
+    totals = {"images": 0, "original": 0, "dpr1": 0, "dpr2": 0}
+    for path in paths:
+        img = _open_normalized(path)
+        variants = [{"width": min(w, img.size[0]), "bytes": len(_encode(img, w))} for w in _widths_for(img.size[0])]
+        totals["images"] += 1
+        totals["original"] += os.path.getsize(path)
+        totals["dpr1"] += _pick(variants, ARTICLE_CARD_WIDTH)["bytes"]
+        totals["dpr2"] += _pick(variants, ARTICLE_CARD_WIDTH * 2)["bytes"]
+    return totals
+
+
+if __name__ == "__main__":
+    paths = sys.argv[1:] or [
+        os.path.join(STORAGE_PATH, f) for f in sorted(os.listdir(STORAGE_PATH))
+        if f.startswith("art_") and f.count(".") == 1
+    ]
+    result = benchmark(paths)
+    original = result["original"] or 1
+    print(f"📊 {result['images']} article images, card width {ARTICLE_CARD_WIDTH}px")
+    print(f"   original : {result['original']:>12,} bytes")
+    for key, label in (("dpr1", "1x screen"), ("dpr2", "2x screen")):
+        print(f"   {label}: {result[key]:>12,} bytes ({100 - 100 * result[key] / original:.1f}% less)")
@@ -0,0 +1,115 @@
+# =================================================================
+# 🪪 KAIA AUTH CACHE – ذاكرة التوكنات والمستخدمين للطلبات السريعة
+# =================================================================
+# - التوكنات الموثقة: لا نعيد فك وتوقيع JWT في كل طلب.
+# - صفوف المستخدمين (لقطة للقراءة فقط) حسب user id بعمر قصير؛ بعد انتهائه نتحقق
+#   من عمود version فقط (استعلام مفهرس بالمفتاح الأساسي) ونعيد تحميل الصف إذا تغير.
+# كل تعديل على صف المستخدم يرفع version (انظر database.py)، لذلك تلتقط بقية
+# العمال التغيير خلال USER_CACHE_TTL ثانية كحد أقصى، والعامل نفسه فوراً.
+
+import os
+import time
+import threading
+from types import SimpleNamespace
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from database import SessionLocal, User
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "10"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+
+_lock = threading.Lock()
+_tokens = OrderedDict()       # token -> (email, exp_timestamp)
+_user_ids = {}                # email -> user_id
+_users = OrderedDict()        # user_id -> [snapshot, version, checked_at]
+
+STATS = {"token_hits": 0, "user_hits": 0, "user_revalidations": 0, "user_loads": 0}
+
+
+# -----------------------------------------------------------------
+# 2. التوكنات الموثقة (Verified Tokens)
+# -----------------------------------------------------------------
+
+def get_token(token: str):
+    with _lock:
+        entry = _tokens.get(token)
+        if entry is None:
+            return None
+        email, exp = entry
+        if exp is not None and exp < datetime.now(timezone.utc).timestamp():
+            del _tokens[token]
+            return None
+        _tokens.move_to_end(token)
+        STATS["token_hits"] += 1
+        return email
+
+
+def put_token(token: str, email: str, exp):
+    with _lock:
+        _tokens[token] = (email, exp)
+        while len(_tokens) > AUTH_TOKEN_CACHE_SIZE:
+            _tokens.popitem(last=False)
+
+
+# -----------------------------------------------------------------
+# 3. لقطات المستخدمين (User Row Snapshots)
+# -----------------------------------------------------------------
+
+def snapshot(user: User):
+    return SimpleNamespace(**{c.key: getattr(user, c.key) for c in User.__table__.columns})
+
+
+def _store(user: User):
+    snap = snapshot(user)
+    with _lock:
+        _user_ids[user.email] = user.id
+        _users[user.id] = [snap, user.version or 0, time.monotonic()]
+        _users.move_to_end(user.id)
+        while len(_users) > USER_CACHE_SIZE:
+            _users.popitem(last=False)
+    return snap
+
+
+def get_user(email: str):
+    # يعيد لقطة للقراءة فقط، أو None إذا لم يعد المستخدم موجوداً
+    with _lock:
+        user_id = _user_ids.get(email)
+        entry = _users.get(user_id) if user_id is not None else None
+        if entry is not None and time.monotonic() - entry[2] < USER_CACHE_TTL:
+            STATS["user_hits"] += 1
+            return entry[0]
+
+    db = SessionLocal()
+    try:
+        if entry is not None:
+            current_version = db.query(User.version).filter(User.id == user_id).scalar()
+            if current_version is not None and current_version == entry[1]:
+                STATS["user_revalidations"] += 1
+                with _lock:
+                    entry[2] = time.monotonic()
+                return entry[0]
+
+        STATS["user_loads"] += 1
+        user = db.query(User).filter(User.email == email).first()
+        if user is None:
+            invalidate(user_id)
+            return None
+        return _store(user)
+    finally:
+        db.close()
+
+
+def invalidate(user_id: int):
+    with _lock:
+        if user_id is not None:
+            _users.pop(user_id, None)
+
+
+def stats() -> dict:
+    return dict(STATS, tokens=len(_tokens), users=len(_users))
@@ -0,0 +1,287 @@
+# =================================================================
+# 🧬 KAIA CHART FINGERPRINT – كشف الشارتات شبه المتطابقة (Perceptual Hash)
+# =================================================================
+# بصمة dHash (64 بت) تتحمل إعادة الضغط (PNG ⇄ JPEG) والقص البسيط،
+# وفهرس BK-Tree يجيب عن "أقرب تحليل سابق ضمن مسافة هامينغ N" دون مسح خطي.
+
+import io
+import os
+import sys
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+
+from PIL import Image, ImageDraw
+
+from database import SessionLocal, ChartFingerprint
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+# إعادة استخدام تحليل شارت شبه متطابق بدلاً من استدعاء الرؤية (معطلة افتراضياً):
+# بصمة 8x8 لا تميز شمعة أخيرة مختلفة (قد تكون المسافة 0)، فتفعيلها يعني أن مستخدماً قد
+# يستلم تحليل شارت آخر لنفس الرمز والإطار. إعادة الضغط (PNG ⇄ JPEG) تبقى غالباً ضمن 0-2.
+# الفحص: python chart_fingerprint.py selftest
+PHASH_REUSE_ENABLED = os.getenv("PHASH_REUSE_ENABLED", "false").lower() in ("1", "true", "yes")
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "2"))
+PHASH_INDEX_MAX_ENTRIES = int(os.getenv("PHASH_INDEX_MAX_ENTRIES", "20000"))
+# مدة الاحتفاظ بالبصمات في قاعدة البيانات
+PHASH_RETENTION_DAYS = int(os.getenv("PHASH_RETENTION_DAYS", "30"))
+
+
+# -----------------------------------------------------------------
+# 2. حساب البصمة (Difference Hash)
+# -----------------------------------------------------------------
+
+def dhash(image_bytes: bytes, hash_size: int = 8) -> int:
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        small = img.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+        pixels = list(small.getdata())
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def to_hex(value: int) -> str:
+    return f"{value:016x}"
+
+
+# -----------------------------------------------------------------
+# 3. شجرة BK للبحث بالمسافة (BK-Tree)
+# -----------------------------------------------------------------
+
+class BKTree:
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, h: int, item):
+        self.size += 1
+        if self.root is None:
+            self.root = (h, [item], {})
+            return
+        node = self.root
+        while True:
+            d = hamming(h, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = (h, [item], {})
+                return
+            node = child
+
+    def search(self, h: int, radius: int):
+        # يعيد (المسافة, العنصر) لكل عنصر ضمن النطاق
+        found = []
+        if self.root is None:
+            return found
+        stack = [self.root]
+        while stack:
+            node_hash, items, children = stack.pop()
+            d = hamming(h, node_hash)
+            if d <= radius:
+                found.extend((d, item) for item in items)
+            for child_d, child in children.items():
+                if d - radius <= child_d <= d + radius:
+                    stack.append(child)
+        return found
+
+
+# -----------------------------------------------------------------
+# 4. الفهرس المحفوظ في قاعدة البيانات (Persistent, Bounded Index)
+# -----------------------------------------------------------------
+
+class FingerprintIndex:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._tree = BKTree()
+        self._entries = []          # (id, hash, params, cache_key) بترتيب الإدخال
+        self._last_id = 0
+        self._lock = threading.Lock()
+
+    def _rebuild(self):
+        self._entries = self._entries[-self.max_entries:]
+        self._tree = BKTree()
+        for entry_id, h, params, cache_key in self._entries:
+            self._tree.add(h, (entry_id, params, cache_key))
+
+    def _add(self, entry_id: int, h: int, params: str, cache_key: str):
+        self._entries.append((entry_id, h, params, cache_key))
+        self._tree.add(h, (entry_id, params, cache_key))
+        self._last_id = max(self._last_id, entry_id)
+        # الحذف من شجرة BK مكلف، لذا نعيد البناء عند تجاوز الحد بـ 25%
+        if len(self._entries) > self.max_entries * 1.25:
+            self._rebuild()
+
+    def sync(self):
+        # تحميل ما أضافه العمال الآخرون منذ آخر مزامنة (أول مرة = تحميل آخر max_entries)
+        db = SessionLocal()
+        try:
+            q = db.query(ChartFingerprint).filter(
+                ChartFingerprint.id > self._last_id,
+                ChartFingerprint.cache_key.isnot(None),
+            )
+            if self._last_id == 0:
+                rows = q.order_by(ChartFingerprint.id.desc()).limit(self.max_entries).all()[::-1]
+            else:
+                rows = q.order_by(ChartFingerprint.id.asc()).all()
+            with self._lock:
+                for row in rows:
+                    if row.id > self._last_id:
+                        self._add(row.id, int(row.phash, 16), row.params, row.cache_key)
+        finally:
+            db.close()
+
+    def nearest(self, h: int, params: str, radius: int):
+        with self._lock:
+            matches = [(d, -item[0], item[2]) for d, item in self._tree.search(h, radius) if item[1] == params]
+        if not matches:
+            return None
+        # الأقرب مسافةً ثم الأحدث
+        matches.sort()
+        return matches[0][2]
+
+
+_index = FingerprintIndex(PHASH_INDEX_MAX_ENTRIES)
+
+
+def make_params(timeframe: str, analysis_type: str, lang: str) -> str:
+    return f"{timeframe}|{analysis_type}|{lang}"
+
+
+# -----------------------------------------------------------------
+# 5. الواجهة المستخدمة في main.py (Public Helpers)
+# -----------------------------------------------------------------
+
+def register_upload(filename: str, image_bytes: bytes):
+    # تسجيل بصمة كل صورة مقبولة في /api/upload-chart (لا عمل إطلاقاً والميزة معطلة)
+    if not PHASH_REUSE_ENABLED:
+        return None
+    try:
+        h = dhash(image_bytes)
+    except Exception:
+        return None
+    db = SessionLocal()
+    try:
+        db.add(ChartFingerprint(filename=filename, phash=to_hex(h)))
+        db.commit()
+    finally:
+        db.close()
+    return h
+
+
+def lookup_fingerprint(filename: str, image_bytes: bytes):
+    if not PHASH_REUSE_ENABLED:
+        return None
+    db = SessionLocal()
+    try:
+        row = db.query(ChartFingerprint).filter(ChartFingerprint.filename == filename).first()
+        if row is not None:
+            return int(row.phash, 16)
+    finally:
+        db.close()
+    try:
+        return dhash(image_bytes)
+    except Exception:
+        return None
+
+
+def find_near_duplicate(h: int, timeframe: str, analysis_type: str, lang: str):
+    # يعيد مفتاح ذاكرة النتائج لأقرب تحليل سابق، أو None
+    if h is None or not PHASH_REUSE_ENABLED:
+        return None
+    _index.sync()
+    return _index.nearest(h, make_params(timeframe, analysis_type, lang), PHASH_MAX_DISTANCE)
+
+
+def record_analysis(filename: str, h: int, timeframe: str, analysis_type: str, lang: str, cache_key: str):
+    # كل تحليل جديد يُضاف كصف مستقل حتى تلتقطه مزامنة العمال الآخرين (id تصاعدي)
+    if h is None or not PHASH_REUSE_ENABLED:
+        return
+    db = SessionLocal()
+    try:
+        db.add(ChartFingerprint(
+            filename=filename,
+            phash=to_hex(h),
+            params=make_params(timeframe, analysis_type, lang),
+            cache_key=cache_key,
+        ))
+        cutoff = datetime.now(timezone.utc) - timedelta(days=PHASH_RETENTION_DAYS)
+        db.query(ChartFingerprint).filter(ChartFingerprint.created_at < cutoff).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+# -----------------------------------------------------------------
+# 6. فحص ذاتي (Self-Test: Distinct Charts Are Never Merged)
+# -----------------------------------------------------------------
+
+def _synthetic_chart(prices: list, fmt: str = "PNG", size=(1280, 720)) -> bytes:
+    # شارت شموع بسيط بنفس الخلفية والشبكة: الفرق الوحيد بين شارتين هو البيانات
+    img = Image.new("RGB", size, (19, 23, 34))
+    draw = ImageDraw.Draw(img)
+    for x in range(0, size[0], 80):
+        draw.line([(x, 0), (x, size[1])], fill=(40, 44, 56))
+    for y in range(0, size[1], 60):
+        draw.line([(0, y), (size[0], y)], fill=(40, 44, 56))
+    low, high = min(prices) - 2, max(prices) + 2
+    to_y = lambda p: size[1] - 40 - (p - low) / (high - low) * (size[1] - 80)
+    width = (size[0] - 120) / (len(prices) - 1)
+    for i in range(len(prices) - 1):
+        o, c = prices[i], prices[i + 1]
+        x = 40 + i * width
+        color = (38, 166, 154) if c >= o else (239, 83, 80)
+        draw.rectangle([x + 1, to_y(max(o, c)), x + width - 2, to_y(min(o, c)) + 1], fill=color)
+    out = io.BytesIO()
+    img.save(out, fmt, **({"quality": 80} if fmt == "JPEG" else {}))
+    return out.getvalue()
+
+
+def selftest(samples: int = 30, candles: int = 60, min_shift: int = 2) -> bool:
+    # شارتات مختلفة لنفس الرمز والإطار: سلاسل أسعار مستقلة، ونفس السلسلة بعد min_shift شموع أو أكثر.
+    # كلها يجب أن تبقى أبعد من PHASH_MAX_DISTANCE (لا دمج)، بينما نسخة JPEG من نفس الصورة تُقاس للعلم.
+    merged, reencode = [], []
+    series = []
+    for seed in range(samples):
+        rnd = random.Random(seed)
+        prices = [100.0]
+        for _ in range(candles + 10):
+            prices.append(prices[-1] + rnd.gauss(0, 1))
+        series.append(prices)
+
+    hashes = [dhash(_synthetic_chart(p[:candles + 1])) for p in series]
+    for i, prices in enumerate(series):
+        reencode.append(hamming(hashes[i], dhash(_synthetic_chart(prices[:candles + 1], "JPEG"))))
+        for shift in (min_shift, min_shift + 1, 5):
+            d = hamming(hashes[i], dhash(_synthetic_chart(prices[shift:candles + 1 + shift])))
+            if d <= PHASH_MAX_DISTANCE:
+                merged.append((f"chart {i} shifted {shift} candles", d))
+        for j in range(i + 1, len(series)):
+            d = hamming(hashes[i], hashes[j])
+            if d <= PHASH_MAX_DISTANCE:
+                merged.append((f"chart {i} vs chart {j}", d))
+
+    print(f"📊 max distance {PHASH_MAX_DISTANCE} | reuse {'on' if PHASH_REUSE_ENABLED else 'off'}")
+    print(f"   same chart re-encoded as JPEG: distance {min(reencode)}-{max(reencode)}, "
+          f"{sum(d <= PHASH_MAX_DISTANCE for d in reencode)}/{len(reencode)} within threshold")
+    for label, d in merged:
+        print(f"   ❌ {label} merged (distance {d})")
+    print(f"{'❌' if merged else '✅'} {len(merged)} distinct chart pairs merged")
+    return not merged
+
+
+if __name__ == "__main__":
+    if (sys.argv[1] if len(sys.argv) > 1 else "selftest") == "selftest":
+        sys.exit(0 if selftest() else 1)
@@ -0,0 +1,189 @@
+# =================================================================
+# 💾 KAIA CHART STORAGE – استقبال الشارت المتدفق وتخزينه بدون تكرار
+# =================================================================
+# - نقرأ جسم الطلب (multipart) قطعة قطعة ونكتبه مباشرة لملف مؤقت مع حساب
+#   SHA-256 أثناء الاستقبال، ونقطع الاتصال فور تجاوز الحد الأقصى للحجم.
+# - أول بايتات الملف تُفحص (Magic Bytes) قبل أي فك ترميز.
+# - الصورة الجاهزة تُحفظ مرة واحدة باسم بصمتها في blobs/، وكل رفع يحصل على
+#   اسم مستقل (hard link) حتى يبقى حذف ملف الرفع بعد التحليل آمناً للآخرين.
+# - الكتابة ذرية: ملف مؤقت ثم os.replace.
+
+import os
+import re
+import json
+import uuid
+import shutil
+import hashlib
+import tempfile
+
+from fastapi import Request
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+import image_pipeline
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+STORAGE_PATH = os.getenv("RENDER_DISK_MOUNT_PATH", "images")
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+# هامش لحقول multipart الأخرى وحدود الأجزاء فوق حجم الصورة نفسها
+UPLOAD_ENVELOPE_BYTES = 64 * 1024
+BLOB_DIR = os.path.join(STORAGE_PATH, "blobs")
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class ReceivedUpload:
+    def __init__(self, path: str, sha256: str, size: int, source_format: str):
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+        self.source_format = source_format
+
+    def discard(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# -----------------------------------------------------------------
+# 2. الاستقبال المتدفق (Streaming Multipart Receive)
+# -----------------------------------------------------------------
+
+async def receive_upload(request: Request, field: str = "chart", max_bytes: int = None) -> ReceivedUpload:
+    max_bytes = max_bytes or UPLOAD_MAX_BYTES
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise image_pipeline.InvalidImageError("يجب رفع الصورة كـ multipart/form-data")
+
+    # رفض مبكر بدون قراءة الجسم إذا أعلن العميل حجماً أكبر من المسموح
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > max_bytes + UPLOAD_ENVELOPE_BYTES:
+        raise UploadTooLarge()
+
+    state = {"headers": {}, "field": b"", "value": b"", "target": None}
+    hasher = hashlib.sha256()
+    received = {"size": 0, "head": b"", "format": None, "found": False}
+    tmp = tempfile.NamedTemporaryFile(prefix="kaia-upload-", delete=False)
+
+    def on_header_field(data, start, end):
+        state["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["value"] += data[start:end]
+
+    def on_header_end():
+        state["headers"][state["field"].lower()] = state["value"]
+        state["field"], state["value"] = b"", b""
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(state["headers"].get(b"content-disposition", b""))
+        is_target = disposition.get(b"name") == field.encode() and b"filename" in disposition
+        state["target"] = is_target and not received["found"]
+        if state["target"]:
+            received["found"] = True
+
+    def on_part_data(data, start, end):
+        if not state["target"]:
+            return
+        chunk = data[start:end]
+        received["size"] += len(chunk)
+        if received["size"] > max_bytes:
+            raise UploadTooLarge()
+        if received["format"] is None:
+            received["head"] += chunk[:image_pipeline.MAGIC_HEAD_SIZE]
+            if len(received["head"]) >= image_pipeline.MAGIC_HEAD_SIZE:
+                received["format"] = image_pipeline.sniff_format(received["head"])
+                if received["format"] is None:
+                    raise image_pipeline.InvalidImageError("صيغة الصورة غير مدعومة")
+        hasher.update(chunk)
+        tmp.write(chunk)
+
+    def on_part_end():
+        state["headers"], state["target"] = {}, None
+
+    parser = MultipartParser(params[b"boundary"], {
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+        parser.finalize()
+        tmp.close()
+        if not received["found"] or received["size"] == 0:
+            raise image_pipeline.InvalidImageError("لم يتم إرفاق صورة")
+        if received["format"] is None:
+            # ملف أصغر من حجم التوقيع
+            received["format"] = image_pipeline.sniff_format(received["head"])
+            if received["format"] is None:
+                raise image_pipeline.InvalidImageError("صيغة الصورة غير مدعومة")
+    except BaseException:
+        tmp.close()
+        os.remove(tmp.name)
+        raise
+
+    return ReceivedUpload(tmp.name, hasher.hexdigest(), received["size"], received["format"])
+
+
+# -----------------------------------------------------------------
+# 3. التخزين بدون تكرار (Content-Addressed Blobs + Hard Links)
+# -----------------------------------------------------------------
+
+# اسم ملف الرفع كما يولده store_upload (uuid4 + امتداد): اسم مجرد بلا مجلدات، فلا يصل
+# العميل إلى blobs/ أو خارج STORAGE_PATH (الحذف بعد التحليل يحذف ما يشير إليه الاسم)
+_UPLOAD_NAME = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.[A-Za-z0-9]{2,5}")
+
+
+def is_upload_name(name: str) -> bool:
+    return bool(name) and _UPLOAD_NAME.fullmatch(name) is not None
+
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(BLOB_DIR, sha256[:2], f"{sha256}.{image_pipeline.output_extension()}")
+
+
+def _atomic_write(path: str, data: bytes):
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # أنظمة ملفات بدون روابط صلبة: نسخة عادية
+        shutil.copyfile(src, dst)
+
+
+def store_upload(upload: ReceivedUpload):
+    # يعيد (اسم ملف الرفع, البايتات الجاهزة, هل كانت الصورة موجودة مسبقاً)
+    # البصمة للبايتات الأصلية والتجهيز حتمي، فنفس الملف ينتج نفس الصورة الجاهزة
+    blob = blob_path(upload.sha256)
+    deduplicated = os.path.exists(blob) and os.path.exists(image_pipeline.meta_path(blob))
+
+    if deduplicated:
+        with open(blob, "rb") as f:
+            prepared = f.read()
+    else:
+        with open(upload.path, "rb") as f:
+            prepared, ext, meta = image_pipeline.prepare_chart(f)
+        meta["sha256"] = upload.sha256
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        _atomic_write(blob, prepared)
+        _atomic_write(image_pipeline.meta_path(blob), json.dumps(meta).encode("utf-8"))
+
+    name = f"{uuid.uuid4()}.{image_pipeline.output_extension()}"
+    save_path = os.path.join(STORAGE_PATH, name)
+    _link_or_copy(blob, save_path)
+    _link_or_copy(image_pipeline.meta_path(blob), image_pipeline.meta_path(save_path))
+    return name, prepared, deduplicated
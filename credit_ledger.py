@@ -0,0 +1,421 @@
+# =================================================================
+# 🧾 KAIA CREDIT LEDGER – دفتر الرصيد الذري (حجز / إرجاع / تدقيق)
+# =================================================================
+# - كل تغيير على users.credits هو تحديث مشروط واحد في قاعدة البيانات
+#   (UPDATE ... WHERE credits >= n RETURNING credits) يُكتب معه سطر في credit_ledger
+#   داخل نفس المعاملة. لا قراءة ثم كتابة من كائن ORM قديم، فلا خصم مفقود ولا صرف مزدوج.
+# - التحليل يحجز الرصيد قبل استدعاء OpenAI، ويُرجع الحجز عند الفشل أو عند نتيجة
+#   مجانية من الكاش. (kind, ref) فريد: الإرجاع المكرر لنفس الحجز يفشل بالكامل.
+# - التحليل الناجح يكتب سطر settle (delta = 0) بنفس المرجع مع حفظ التحليل في نفس المعاملة.
+#   حجز تحليل مباشر أقدم من CREDIT_RESERVE_TTL بلا settle ولا refund = حجز يتيم (فشل الإرجاع
+#   أو توقف العامل)، فتُرجعه المهمة الخلفية.
+# - مهمة خلفية تجمع الدفتر دورياً في credit_balances وتقارنه بـ users.credits (drift).
+# نفس السلوك على SQLite (3.35+) و Postgres.
+# اختبار التزامن: DATABASE_URL=sqlite:////tmp/ledger.db python credit_ledger.py stress 100
+
+import os
+import sys
+import uuid
+import socket
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+
+import auth_cache
+import db_writer
+from database import SessionLocal, User, CreditLedgerEntry, CreditBalance, CreditLedgerCursor, InflightAnalysis
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+CREDIT_RECONCILE_INTERVAL = int(os.getenv("CREDIT_RECONCILE_INTERVAL", "300"))
+CREDIT_RECONCILE_BATCH = 5000
+# أرقام id قد تُثبت بترتيب مختلف عن تسلسلها (معاملات متزامنة): نجمع فقط السطور الأقدم من هذا
+CREDIT_SETTLE_SECONDS = 30
+# أقصى عمر لحجز تحليل مباشر قبل اعتباره يتيماً (أطول بكثير من أبطأ استدعاء للنموذج)
+CREDIT_RESERVE_TTL = int(os.getenv("CREDIT_RESERVE_TTL", "900"))
+ORPHAN_REF_PREFIX = "analysis:"
+ORPHAN_CURSOR = "orphan_sweep"
+
+RECONCILE_LOCK_KEY = "maintenance:credit-reconcile"
+OWNER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+STATS = {"reserved": 0, "refunded": 0, "rejected": 0, "release_errors": 0, "orphans_released": 0, "drift_users": 0, "materialized_through": 0}
+
+
+class InsufficientCredits(Exception):
+    pass
+
+
+# -----------------------------------------------------------------
+# 2. العمليات الذرية (Atomic Ledger Operations)
+# -----------------------------------------------------------------
+# الدوال التالية لا تنفذ commit: المستدعي يحدد حدود المعاملة (مثل إدراج مهمة + حجزها معاً)
+
+def new_ref(prefix: str) -> str:
+    return f"{prefix}:{uuid.uuid4().hex}"
+
+
+def _apply(db, user_id: int, delta: int, kind: str, ref: str = None) -> int:
+    stmt = update(User).where(User.id == user_id)
+    if delta < 0:
+        # الشرط والخصم في جملة واحدة: قاعدة البيانات تسلسل الطلبات المتزامنة على نفس الصف
+        stmt = stmt.where(User.credits >= -delta)
+    stmt = (
+        stmt.values(credits=User.credits + delta, version=User.version + 1)
+        .returning(User.credits)
+        .execution_options(synchronize_session=False)
+    )
+    balance = db.execute(stmt).scalar()
+    if balance is None:
+        raise InsufficientCredits()
+    db.add(CreditLedgerEntry(user_id=user_id, delta=delta, kind=kind, ref=ref, balance_after=balance))
+    # flush الآن: تعارض (kind, ref) يظهر هنا ويلغي التحديث معه عند rollback
+    db.flush()
+    auth_cache.invalidate(user_id)
+    return balance
+
+
+def reserve(db, user_id: int, ref: str, amount: int = 1) -> int:
+    try:
+        balance = _apply(db, user_id, -amount, "reserve", ref)
+    except InsufficientCredits:
+        STATS["rejected"] += 1
+        raise
+    STATS["reserved"] += 1
+    return balance
+
+
+def refund(db, user_id: int, ref: str) -> bool:
+    # يُرجع قيمة الحجز نفسها؛ لا شيء إذا لم يوجد حجز بهذا المرجع
+    reserved = db.execute(
+        select(CreditLedgerEntry.delta).where(
+            CreditLedgerEntry.kind == "reserve", CreditLedgerEntry.ref == ref, CreditLedgerEntry.user_id == user_id
+        )
+    ).scalar()
+    if reserved is None:
+        return False
+    _apply(db, user_id, -reserved, "refund", ref)
+    STATS["refunded"] += 1
+    return True
+
+
+def settle(db, user_id: int, ref: str):
+    # الحجز أصبح خصماً نهائياً: سطر بدون قيمة يميّزه عن الحجز اليتيم (نفس معاملة حفظ التحليل)
+    db.add(CreditLedgerEntry(user_id=user_id, delta=0, kind="settle", ref=ref))
+    db.flush()
+
+
+def grant(db, user_id: int, amount: int, kind: str = "signup", ref: str = None) -> int:
+    return _apply(db, user_id, amount, kind, ref)
+
+
+def set_balance(db, user_id: int, new_balance: int, kind: str = "admin") -> int:
+    # تعديل يدوي لقيمة مطلقة: مقارنة ثم تبديل (CAS) حتى لا يضيع حجز متزامن
+    while True:
+        current = db.execute(select(User.credits).where(User.id == user_id)).scalar()
+        if current is None:
+            raise ValueError("user not found")
+        delta = new_balance - current
+        if delta == 0:
+            return current
+        updated = db.execute(
+            update(User)
+            .where(User.id == user_id, User.credits == current)
+            .values(credits=new_balance, version=User.version + 1)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if updated == 1:
+            db.add(CreditLedgerEntry(user_id=user_id, delta=delta, kind=kind, balance_after=new_balance))
+            db.flush()
+            auth_cache.invalidate(user_id)
+            return new_balance
+
+
+def release(user_id: int, ref: str) -> bool:
+    # إرجاع حجز في معاملة مستقلة (مسار التحليل المباشر والبث)
+    if ref is None:
+        return False
+    try:
+        return db_writer.submit(refund, user_id, ref)
+    except IntegrityError:
+        # أُرجع مسبقاً
+        return False
+    except Exception as e:
+        # لا نرفع الخطأ: المستدعي في مسار خطأ أصلاً ولا يجب أن يخفي الخطأ الأصلي.
+        # الحجز يبقى بلا settle فتُرجعه release_orphans بعد CREDIT_RESERVE_TTL
+        STATS["release_errors"] += 1
+        print(f"Credit Ledger Error: release {ref} failed: {e}")
+        return False
+
+
+def forget_user(db, user_id: int):
+    # عند حذف الحساب: رقم المستخدم قد يُعاد استخدامه (SQLite) فلا يرث الحساب الجديد سجل القديم
+    db.query(CreditLedgerEntry).filter(CreditLedgerEntry.user_id == user_id).delete(synchronize_session=False)
+    db.query(CreditBalance).filter(CreditBalance.user_id == user_id).delete(synchronize_session=False)
+
+
+def entries(db, user_id: int, limit: int = 50) -> list:
+    rows = (
+        db.query(CreditLedgerEntry)
+        .filter(CreditLedgerEntry.user_id == user_id)
+        .order_by(CreditLedgerEntry.id.desc())
+        .limit(limit)
+        .all()
+    )
+    return [
+        {"id": r.id, "delta": r.delta, "kind": r.kind, "ref": r.ref, "balance_after": r.balance_after, "created_at": r.created_at}
+        for r in rows
+    ]
+
+
+# -----------------------------------------------------------------
+# 3. التجميع الدوري والتدقيق (Materialized Balance + Drift Check)
+# -----------------------------------------------------------------
+
+def materialize() -> dict:
+    # يجمع سطور الدفتر الجديدة منذ آخر تشغيل على دفعات حسب id
+    result = {"entries": 0, "users": 0, "drift": []}
+    db = SessionLocal()
+    try:
+        watermark = db.query(func.coalesce(func.max(CreditBalance.through_id), 0)).scalar()
+        settled = datetime.now(timezone.utc) - timedelta(seconds=CREDIT_SETTLE_SECONDS)
+        head = (
+            db.query(CreditLedgerEntry.id)
+            .filter(CreditLedgerEntry.created_at < settled)
+            .order_by(CreditLedgerEntry.id.desc())
+            .limit(1)
+            .scalar()
+        ) or 0
+        while watermark < head:
+            cutoff = min(head, watermark + CREDIT_RECONCILE_BATCH)
+            sums = (
+                db.query(CreditLedgerEntry.user_id, func.sum(CreditLedgerEntry.delta), func.count(CreditLedgerEntry.id))
+                .filter(CreditLedgerEntry.id > watermark, CreditLedgerEntry.id <= cutoff)
+                .group_by(CreditLedgerEntry.user_id)
+                .all()
+            )
+            now = datetime.now(timezone.utc)
+            for user_id, delta, count in sums:
+                updated = db.query(CreditBalance).filter(CreditBalance.user_id == user_id).update(
+                    {"balance": CreditBalance.balance + delta, "through_id": cutoff, "updated_at": now},
+                    synchronize_session=False,
+                )
+                if not updated:
+                    db.add(CreditBalance(user_id=user_id, balance=delta, through_id=cutoff, updated_at=now))
+                result["entries"] += count
+            result["users"] += len(sums)
+            result["drift"].extend(_drift(db, [user_id for user_id, _, _ in sums]))
+            db.commit()
+            watermark = cutoff
+    finally:
+        db.close()
+
+    STATS["materialized_through"] = watermark
+    STATS["drift_users"] = len(result["drift"])
+    for user_id, live, expected in result["drift"]:
+        print(f"Credit Ledger Drift: user {user_id} credits={live} ledger={expected}")
+    return result
+
+
+def _drift(db, user_ids: list) -> list:
+    # جملة واحدة = لقطة متسقة: الرصيد الحي مقابل المجمّع + ما أُضيف بعده
+    if not user_ids:
+        return []
+    rows = db.execute(
+        select(
+            User.id,
+            User.credits,
+            CreditBalance.balance + func.coalesce(
+                select(func.sum(CreditLedgerEntry.delta))
+                .where(CreditLedgerEntry.user_id == User.id, CreditLedgerEntry.id > CreditBalance.through_id)
+                .scalar_subquery(),
+                0,
+            ),
+        )
+        .join(CreditBalance, CreditBalance.user_id == User.id)
+        .where(User.id.in_(user_ids))
+    ).all()
+    return [(user_id, live, expected) for user_id, live, expected in rows if live != expected]
+
+
+def _save_cursor(db, name: str, through_id: int):
+    db.merge(CreditLedgerCursor(name=name, through_id=through_id, updated_at=datetime.now(timezone.utc)))
+    db.commit()
+
+
+def release_orphans() -> int:
+    # مسح بالمفتاح الأساسي من آخر نقطة: كل حجز أقدم من CREDIT_RESERVE_TTL يُفحص مرة واحدة.
+    # النقطة محفوظة في credit_ledger_cursors (مثل through_id في materialize): العامل الذي يأخذ
+    # القفل بعد إعادة تشغيل يكمل من حيث توقف غيره بدل مسح كل الحجوزات منذ البداية
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=CREDIT_RESERVE_TTL)
+    released = 0
+    db = SessionLocal()
+    try:
+        start = db.query(CreditLedgerCursor.through_id).filter(CreditLedgerCursor.name == ORPHAN_CURSOR).scalar() or 0
+        watermark = start
+        try:
+            while True:
+                rows = (
+                    db.query(CreditLedgerEntry.id, CreditLedgerEntry.user_id, CreditLedgerEntry.ref, CreditLedgerEntry.created_at)
+                    .filter(CreditLedgerEntry.id > watermark, CreditLedgerEntry.kind == "reserve")
+                    .order_by(CreditLedgerEntry.id.asc())
+                    .limit(CREDIT_RECONCILE_BATCH)
+                    .all()
+                )
+                old = []
+                for row in rows:
+                    created_at = row.created_at if row.created_at.tzinfo else row.created_at.replace(tzinfo=timezone.utc)
+                    if created_at >= cutoff:
+                        break
+                    old.append(row)
+                candidates = {row.ref for row in old if row.ref and row.ref.startswith(ORPHAN_REF_PREFIX)}
+                resolved = set()
+                if candidates:
+                    resolved = {
+                        ref for (ref,) in db.query(CreditLedgerEntry.ref).filter(
+                            CreditLedgerEntry.kind.in_(("settle", "refund")), CreditLedgerEntry.ref.in_(candidates)
+                        )
+                    }
+                db.rollback()
+                for row in old:
+                    if row.ref in candidates and row.ref not in resolved:
+                        errors = STATS["release_errors"]
+                        if release(row.user_id, row.ref):
+                            released += 1
+                            print(f"Credit Ledger: released orphaned reservation {row.ref} (user {row.user_id})")
+                        elif STATS["release_errors"] != errors:
+                            # الكاتب متعطل: نتوقف هنا ونعيد المحاولة من نفس السطر في الدورة القادمة
+                            return released
+                    watermark = row.id
+                if len(old) < len(rows) or len(rows) < CREDIT_RECONCILE_BATCH:
+                    break
+        finally:
+            STATS["orphans_released"] += released
+            if watermark != start:
+                _save_cursor(db, ORPHAN_CURSOR, watermark)
+    finally:
+        db.close()
+    return released
+
+
+def _try_lease() -> bool:
+    db = SessionLocal()
+    try:
+        now = datetime.now(timezone.utc)
+        db.query(InflightAnalysis).filter(
+            InflightAnalysis.cache_key == RECONCILE_LOCK_KEY, InflightAnalysis.expires_at < now
+        ).delete(synchronize_session=False)
+        db.add(InflightAnalysis(cache_key=RECONCILE_LOCK_KEY, owner=OWNER_ID, expires_at=now + timedelta(seconds=CREDIT_RECONCILE_INTERVAL)))
+        db.commit()
+        return True
+    except IntegrityError:
+        db.rollback()
+        return False
+    finally:
+        db.close()
+
+
+async def _reconcile_loop():
+    while True:
+        try:
+            if await run_in_threadpool(_try_lease):
+                await run_in_threadpool(release_orphans)
+                await run_in_threadpool(materialize)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Credit Ledger Error: {e}")
+        await asyncio.sleep(CREDIT_RECONCILE_INTERVAL)
+
+
+def start_reconciler():
+    return asyncio.create_task(_reconcile_loop())
+
+
+# -----------------------------------------------------------------
+# 4. اختبار التزامن (Concurrency Stress Check)
+# -----------------------------------------------------------------
+
+def stress(concurrency: int = 100, credits: int = None) -> dict:
+    # حساب واحد، concurrency تحليلاً متزامناً: كل واحد يحجز، نصف الناجحين يُرجع حجزه
+    # (مرتين لاختبار منع الإرجاع المكرر)، ثم نتحقق من الرصيد مقابل الدفتر
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    credits = concurrency // 2 if credits is None else credits
+    db = SessionLocal()
+    user = User(email=f"stress-{uuid.uuid4().hex[:8]}@ledger.local", credits=0)
+    db.add(user)
+    db.flush()
+    grant(db, user.id, credits)
+    db.commit()
+    user_id = user.id
+    db.close()
+
+    barrier = threading.Barrier(concurrency)
+    refs = [new_ref("stress") for _ in range(concurrency)]
+
+    def analysis(i):
+        barrier.wait()
+        session = SessionLocal()
+        try:
+            reserve(session, user_id, refs[i])
+            session.commit()
+        except InsufficientCredits:
+            session.rollback()
+            return "rejected"
+        finally:
+            session.close()
+        if i % 2 == 0:
+            first = release(user_id, refs[i])
+            second = release(user_id, refs[i])
+            return "refunded" if first and not second else "double-refund"
+        return "spent"
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(analysis, range(concurrency)))
+
+    db = SessionLocal()
+    try:
+        live = db.execute(select(User.credits).where(User.id == user_id)).scalar()
+        ledger_sum = db.execute(select(func.sum(CreditLedgerEntry.delta)).where(CreditLedgerEntry.user_id == user_id)).scalar()
+        reserves = db.query(CreditLedgerEntry).filter(CreditLedgerEntry.user_id == user_id, CreditLedgerEntry.kind == "reserve").count()
+        # تنظيف حساب الاختبار
+        forget_user(db, user_id)
+        db.query(User).filter(User.id == user_id).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+    spent = outcomes.count("spent")
+    report = {
+        "concurrency": concurrency,
+        "initial_credits": credits,
+        "spent": spent,
+        "refunded": outcomes.count("refunded"),
+        "rejected": outcomes.count("rejected"),
+        "double_refunds": outcomes.count("double-refund"),
+        "reservations": reserves,
+        "final_credits": live,
+        "ledger_sum": ledger_sum,
+    }
+    report["ok"] = (
+        live == ledger_sum == credits - spent
+        and live >= 0
+        and report["double_refunds"] == 0
+        and spent + report["refunded"] == reserves
+    )
+    return report
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "stress":
+        outcome = stress(int(sys.argv[2]) if len(sys.argv) > 2 else 100)
+        print(outcome)
+        sys.exit(0 if outcome["ok"] else 1)
+    print(materialize())
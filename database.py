@@ -1,7 +1,15 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, DateTime, Text, inspect, text, Float
+import time
+import asyncio
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager
+from sqlalchemy import exc, create_engine, event, Column, Integer, String, Boolean, ForeignKey, DateTime, Text, JSON, Index, UniqueConstraint, text, Float
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from starlette.concurrency import run_in_threadpool
 from datetime import datetime, timezone
 
 # =========================================================
@@ -15,14 +23,255 @@ if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
 
 SQLALCHEMY_DATABASE_URL = DATABASE_URL or "sqlite:///./sql_app.db"
 
-if SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
-    engine = create_engine(
-        SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+IS_SQLITE = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}
+# المسار غير المتزامن للقراءات الساخنة (run_read): auto = مع PostgreSQL فقط. على SQLite كان أبطأ
+# من threadpool في القياس (aiosqlite يمرر كل استدعاء عبر خيط الاتصال): 1 أو 0 لفرضه
+DB_ASYNC = os.getenv("DB_ASYNC", "auto").lower()
+USE_ASYNC_DB = (not IS_SQLITE) if DB_ASYNC == "auto" else DB_ASYNC == "1"
+
+# --- وضع SQLite للإنتاج (WAL + pragmas لكل اتصال) ---
+# WAL: القراءة لا تنتظر الكتابة | NORMAL: fsync عند checkpoint فقط (آمن مع WAL)
+SQLITE_PRAGMAS = os.getenv("SQLITE_PRAGMAS", "1") == "1"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+
+# --- إعدادات مجمع الاتصالات (Connection Pool) لكل عامل ---
+# الحد الأقصى للاتصالات من كل مجمع (متزامن / غير متزامن) في كل عامل = DB_POOL_SIZE + DB_MAX_OVERFLOW
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# always: ping قبل كل استخدام | idle: فقط للاتصال الخامل أكثر من DB_POOL_PING_IDLE ثانية | off
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "idle").lower()
+DB_POOL_PING_IDLE = float(os.getenv("DB_POOL_PING_IDLE", "30"))
+# انتظار أطول من هذا للحصول على اتصال يُطبع كتحذير (علامة على امتلاء المجمع)
+DB_POOL_WAIT_WARN_MS = float(os.getenv("DB_POOL_WAIT_WARN_MS", "250"))
+
+POOL_STATS = {
+    "checkouts": 0, "connects": 0, "timeouts": 0, "slow_waits": 0,
+    "wait_total_ms": 0.0, "wait_max_ms": 0.0, "peak_checked_out": 0,
+    "pings": 0, "ping_failures": 0,
+}
+_recent_waits = deque(maxlen=1000)
+
+
+class _TimedCheckout:
+    # قياس زمن انتظار الاتصال (لا يوجد حدث pool يغطي الانتظار نفسه)
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            POOL_STATS["timeouts"] += 1
+            raise
+        finally:
+            waited = (time.perf_counter() - started) * 1000
+            _recent_waits.append(waited)
+            POOL_STATS["wait_total_ms"] += waited
+            POOL_STATS["wait_max_ms"] = max(POOL_STATS["wait_max_ms"], waited)
+            if waited > DB_POOL_WAIT_WARN_MS:
+                POOL_STATS["slow_waits"] += 1
+                print(f"⚠️ DB Pool: waited {waited:.0f} ms for a connection (checked out {self.checkedout()}, overflow {self.overflow()})")
+
+
+class InstrumentedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class InstrumentedAsyncPool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+def _pool_options() -> dict:
+    options = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT}
+    if not IS_SQLITE:
+        options.update(
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING == "always",
+            # LIFO: الاتصالات الزائدة تبقى خاملة فتُغلق بعد recycle بدل تدويرها كلها
+            pool_use_lifo=True,
+        )
+    return options
+
+
+def _async_url(url: str) -> str:
+    # نفس قاعدة البيانات بمشغل غير متزامن: sqlite -> aiosqlite | postgresql -> asyncpg
+    scheme, rest = url.split("://", 1)
+    base = scheme.split("+", 1)[0]
+    if base == "postgresql":
+        # asyncpg يقبل ssl بدل sslmode (روابط Render)
+        rest = rest.replace("sslmode=", "ssl=")
+    return f"{base}+{ASYNC_DRIVERS[base]}://{rest}"
+
+
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False} if IS_SQLITE else {},
+    poolclass=InstrumentedQueuePool,
+    **_pool_options(),
+)
+
+
+def _instrument(sync_engine):
+    @event.listens_for(sync_engine, "connect")
+    def _count_connect(dbapi_connection, connection_record):
+        POOL_STATS["connects"] += 1
+
+    @event.listens_for(sync_engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        POOL_STATS["checkouts"] += 1
+        POOL_STATS["peak_checked_out"] = max(POOL_STATS["peak_checked_out"], sync_engine.pool.checkedout())
+        if DB_POOL_PRE_PING != "idle":
+            return
+        # ping فقط للاتصال الذي بقي خاملاً: الاتصالات الساخنة لا تدفع رحلة إضافية
+        idle_since = connection_record.info.get("checked_in_at")
+        if idle_since is None or time.monotonic() - idle_since < DB_POOL_PING_IDLE:
+            return
+        POOL_STATS["pings"] += 1
+        try:
+            cursor = dbapi_connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+        except Exception:
+            # المجمع يتخلص من الاتصال ويعيد المحاولة باتصال جديد
+            POOL_STATS["ping_failures"] += 1
+            raise exc.DisconnectionError()
+
+    @event.listens_for(sync_engine, "checkin")
+    def _on_checkin(dbapi_connection, connection_record):
+        connection_record.info["checked_in_at"] = time.monotonic()
+
+
+_instrument(engine)
+
+
+def pool_stats() -> dict:
+    # أرقام هذا العامل فقط (كل عامل uvicorn/gunicorn له مجمعاه الخاصان)
+    pool = engine.pool
+    async_pool = _async_engine.pool if _async_engine is not None else None
+    waits = sorted(_recent_waits)
+    return {
+        "pid": os.getpid(),
+        "size": pool.size(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "async_checked_out": async_pool.checkedout() if async_pool else 0,
+        "async_checked_in": async_pool.checkedin() if async_pool else 0,
+        "async_overflow": async_pool.overflow() if async_pool else 0,
+        "pre_ping": DB_POOL_PRE_PING,
+        **POOL_STATS,
+        "wait_avg_ms": round(sum(waits) / len(waits), 3) if waits else 0.0,
+        "wait_p95_ms": round(waits[int(len(waits) * 0.95)], 3) if waits else 0.0,
+    }
+
+
+def _apply_sqlite_pragmas(dbapi_connection):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+if IS_SQLITE and SQLITE_PRAGMAS:
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        _apply_sqlite_pragmas(dbapi_connection)
+
+    # محرك الكتابة (db_writer): نفس الملف، لكن SQLAlchemy يدير بداية المعاملة بدل pysqlite
+    # (لازم لـ SAVEPOINT) وتبدأ كل معاملة بـ BEGIN IMMEDIATE: قفل الكتابة يؤخذ من أولها، فلا
+    # تفشل معاملة قرأت ثم كتبت بـ "database is locked" إذا ثبّت غيرها كتابة بينهما.
+    # الجلسات العادية تبقى على سلوك pysqlite (القراءة خارج المعاملة) كما كانت.
+    write_engine = create_engine(
+        SQLALCHEMY_DATABASE_URL,
+        connect_args={"check_same_thread": False},
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
     )
+
+    @event.listens_for(write_engine, "connect")
+    def _sqlite_write_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        _apply_sqlite_pragmas(dbapi_connection)
+
+    @event.listens_for(write_engine, "begin")
+    def _sqlite_begin_immediate(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
 else:
-    engine = create_engine(SQLALCHEMY_DATABASE_URL, pool_pre_ping=True)
+    write_engine = engine
+
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+WriteSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=write_engine)
+
+# المحرك غير المتزامن (aiosqlite / asyncpg) يُنشأ عند أول استخدام فقط: السكربتات (set_admin، magic)
+# ومسار SQLite الافتراضي لا تحتاج مشغلاً غير متزامن. مجمعه منفصل عن مجمع المحرك المتزامن
+_async_engine = None
+_async_sessionmaker = None
+
+
+def get_async_engine():
+    global _async_engine, _async_sessionmaker
+    if _async_engine is None:
+        async_engine = create_async_engine(
+            _async_url(SQLALCHEMY_DATABASE_URL),
+            poolclass=InstrumentedAsyncPool,
+            **_pool_options(),
+        )
+        _instrument(async_engine.sync_engine)
+        if IS_SQLITE and SQLITE_PRAGMAS:
+            @event.listens_for(async_engine.sync_engine, "connect")
+            def _sqlite_async_pragmas(dbapi_connection, connection_record):
+                _apply_sqlite_pragmas(dbapi_connection)
+
+        # الكائنات تبقى مقروءة بعد commit/إغلاق الجلسة: لا تحميل كسول (lazy load) خارج حلقة الأحداث
+        _async_sessionmaker = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+        _async_engine = async_engine
+    return _async_engine
+
+# بوابة FIFO أمام المجمع غير المتزامن: asyncio.Queue يسمح لطلب جديد بخطف اتصال أُعيد للتو
+# قبل أن يستيقظ من ينتظره، فيعود المنتظر لآخر الطابور (ذيل p99 بالثواني تحت 500 اتصال).
+# الإشارة (Semaphore) عادلة وبحجم المجمع، فيأخذ المجمع الاتصال فوراً دائماً. إشارة لكل حلقة أحداث.
+_async_gates = weakref.WeakKeyDictionary()
+
+
+@asynccontextmanager
+async def async_session():
+    loop = asyncio.get_running_loop()
+    gate = _async_gates.get(loop)
+    if gate is None:
+        gate = _async_gates[loop] = asyncio.Semaphore(DB_POOL_SIZE + DB_MAX_OVERFLOW)
+    get_async_engine()
+    async with gate:
+        async with _async_sessionmaker() as db:
+            yield db
+
+
+def _read_direct(fn, args):
+    db = SessionLocal()
+    try:
+        return fn(db, *args)
+    finally:
+        db.close()
+
+
+async def run_read(fn, *args):
+    # قراءة من مسار غير متزامن: fn(db, *args) دالة متزامنة (نفس نمط db_writer.run).
+    # USE_ASYNC_DB: على المحرك غير المتزامن عبر run_sync | غير ذلك: جلسة عادية في threadpool
+    if USE_ASYNC_DB:
+        async with async_session() as db:
+            return await db.run_sync(fn, *args)
+    return await run_in_threadpool(_read_direct, fn, args)
+
+
 Base = declarative_base()
 
 # =========================================================
@@ -43,7 +292,7 @@ class User(Base):
     trader_level = Column(String, default="Beginner")
     markets = Column(String, default="Forex")
 
-    tier = Column(String, default="Trial")
+    tier = Column(String, default="Trial", index=True)
     status = Column(String, default="Active")
     credits = Column(Integer, default=3)
     
@@ -51,28 +300,37 @@ class User(Base):
     verified_at = Column(DateTime, nullable=True)        
     verification_method = Column(String, default="None") 
     registration_ip = Column(String, default="0.0.0.0")  
-    is_flagged = Column(Boolean, default=False)          
+    is_flagged = Column(Boolean, default=False, index=True)          
     
     # [حقن المرحلة الأولى] - تعريف حقول الاشتراك في الجدول
     subscription_start = Column(DateTime, nullable=True)
-    subscription_end = Column(DateTime, nullable=True)
+    subscription_end = Column(DateTime, nullable=True, index=True)
 
     is_admin = Column(Boolean, default=False)
     is_premium = Column(Boolean, default=False)
     is_whale = Column(Boolean, default=False) 
     # --- خانات نظام الإدارة الجديد (CRM) ---
     subscription_fee = Column(Float, default=0.0)
-    payment_status = Column(String, default="Unpaid")
+    payment_status = Column(String, default="Unpaid", index=True)
     total_used_analyzes = Column(Integer, default=0)
-    last_active = Column(DateTime, nullable=True)
+    last_active = Column(DateTime, nullable=True, index=True)
+    # عداد نسخة الصف: يرتفع مع كل تعديل ليعرف كل عامل أن لقطته المخزنة قديمة
+    version = Column(Integer, default=0)
 
     analyses = relationship("Analysis", back_populates="owner", cascade="all, delete-orphan")
 
+
+@event.listens_for(User, "before_update")
+def bump_user_version(mapper, connection, target):
+    target.version = User.version + 1
+
 # =========================================================
 # 2. جدول التحليلات (Portfolio/Analysis Table)
 # =========================================================
 class Analysis(Base):
     __tablename__ = "analyses"
+    # ترقيم السجل بالمؤشر (keyset) على (user_id, id)
+    __table_args__ = (Index("ix_analyses_user_id_id", "user_id", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     symbol = Column(String, default="Chart") 
@@ -95,12 +353,16 @@ class Analysis(Base):
 # =========================================================
 class Article(Base):
     __tablename__ = "articles"
+    # /api/articles وشريط الأخبار: WHERE language = ? ORDER BY id DESC LIMIT n
+    __table_args__ = (Index("ix_articles_language_id", "language", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String, index=True)
     summary = Column(Text)
     content = Column(Text)
     image_url = Column(String)
+    # نسخ الصورة المصغرة للواجهة: {"srcset", "width", "height", "type"} (article_images)
+    image_variants = Column(JSON(none_as_null=True), nullable=True)
     language = Column(String, default="ar")
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
 
@@ -109,6 +371,7 @@ class Article(Base):
 # =========================================================
 class Sponsor(Base):
     __tablename__ = "sponsors"
+    __table_args__ = (Index("ix_sponsors_location_active", "location", "is_active"),)
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String)
@@ -118,46 +381,188 @@ class Sponsor(Base):
     is_active = Column(Boolean, default=True)
 
 # =========================================================
-# 3. محرك الهجرة التلقائية (Auto-Migration Engine)
+# 5. ذاكرة نتائج التحليل المشتركة (Analysis Result Cache)
 # =========================================================
-def migrate_database():
-    inspector = inspect(engine)
-    columns = [col['name'] for col in inspector.get_columns("users")]
-    
-    try:
-        with engine.begin() as conn:
-            # 1. إضافة أعمدة الحماية
-            if "registration_ip" not in columns:
-                conn.execute(text("ALTER TABLE users ADD COLUMN registration_ip VARCHAR DEFAULT '0.0.0.0'"))
-            if "is_flagged" not in columns:
-                conn.execute(text("ALTER TABLE users ADD COLUMN is_flagged BOOLEAN DEFAULT FALSE"))
-            if "verified_at" not in columns:
-                conn.execute(text("ALTER TABLE users ADD COLUMN verified_at TIMESTAMP NULL"))
-            if "verification_method" not in columns:
-                conn.execute(text("ALTER TABLE users ADD COLUMN verification_method VARCHAR DEFAULT 'None'"))
-
-            # 2. [حقن المرحلة الأولى] إضافة حقول تاريخ الاشتراك لقاعدة البيانات
-            if "subscription_start" not in columns:
-                conn.execute(text("ALTER TABLE users ADD COLUMN subscription_start TIMESTAMP NULL"))
-            if "subscription_end" not in columns:
-                conn.execute(text("ALTER TABLE users ADD COLUMN subscription_end TIMESTAMP NULL"))
-# 3. إضافة حقول الإدارة المالية والنشاط (CRM)
-            if "subscription_fee" not in columns:
-                conn.execute(text("ALTER TABLE users ADD COLUMN subscription_fee FLOAT DEFAULT 0.0"))
-            if "payment_status" not in columns:
-                conn.execute(text("ALTER TABLE users ADD COLUMN payment_status VARCHAR DEFAULT 'Unpaid'"))
-            if "total_used_analyzes" not in columns:
-                conn.execute(text("ALTER TABLE users ADD COLUMN total_used_analyzes INTEGER DEFAULT 0"))
-            if "last_active" not in columns:
-                conn.execute(text("ALTER TABLE users ADD COLUMN last_active TIMESTAMP NULL"))
-            # 3. توحيد الإيميلات
-            if not SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
-                conn.execute(text("UPDATE users SET email = LOWER(TRIM(email))"))
-                
-            print("✅ تم تحديث بنية قاعدة البيانات وإضافة حقول الحماية والاشتراكات بنجاح")
-    except Exception as e:
-        print(f"⚠️ تنبيه أثناء التحديث: {e}")
-
-# تشغيل المهاجر
-Base.metadata.create_all(bind=engine)
-migrate_database()
\ No newline at end of file
+class AnalysisCacheEntry(Base):
+    __tablename__ = "analysis_cache"
+
+    cache_key = Column(String(64), primary_key=True)
+    result = Column(Text)
+    hits = Column(Integer, default=0)
+    # التنظيف بعد كل حفظ يحذف بالعمر (created_at < cutoff)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+    last_hit_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+
+# =========================================================
+# 6. بصمات الشارتات شبه المتطابقة (Chart Perceptual Fingerprints)
+# =========================================================
+class ChartFingerprint(Base):
+    __tablename__ = "chart_fingerprints"
+
+    id = Column(Integer, primary_key=True, index=True)
+    filename = Column(String, index=True)
+    phash = Column(String(16))
+    params = Column(String, nullable=True)
+    cache_key = Column(String(64), nullable=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+
+# =========================================================
+# 7. طابور مهام التحليل (Analysis Job Queue)
+# =========================================================
+class AnalysisJob(Base):
+    __tablename__ = "analysis_jobs"
+    # claim_next: WHERE status = 'queued' ORDER BY priority DESC, id ASC (نفس اتجاه الترتيب، بلا فرز)
+    __table_args__ = (Index("ix_analysis_jobs_claim_priority", "status", text("priority DESC"), "id"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    filename = Column(String)
+    timeframe = Column(String)
+    analysis_type = Column(String)
+    lang = Column(String, default="ar")
+    webhook_url = Column(String, nullable=True)
+
+    # queued → running → done / failed
+    status = Column(String, default="queued")
+    priority = Column(Integer, default=0)
+    attempts = Column(Integer, default=0)
+    credit_reserved = Column(Boolean, default=False)
+
+    result = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    analysis_id = Column(Integer, nullable=True)
+
+    available_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    locked_at = Column(DateTime, nullable=True)
+    locked_by = Column(String, nullable=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    finished_at = Column(DateTime, nullable=True)
+
+# =========================================================
+# 8. أقفال التحليلات الجارية بين العمال (In-Flight Analysis Locks)
+# =========================================================
+class InflightAnalysis(Base):
+    __tablename__ = "inflight_analyses"
+
+    cache_key = Column(String(64), primary_key=True)
+    owner = Column(String)
+    expires_at = Column(DateTime)
+
+# =========================================================
+# 9. شريط الأخبار المشترك بين العمال (Shared News Ticker Store)
+# =========================================================
+class NewsTicker(Base):
+    __tablename__ = "news_ticker"
+
+    lang = Column(String(8), primary_key=True)
+    text = Column(Text, default="")
+    updated_at = Column(DateTime, nullable=True)
+    # عقد التحديث: عامل واحد فقط يجلب المصادر في كل دورة
+    refresh_lease_until = Column(DateTime, nullable=True)
+
+
+class NewsFeedState(Base):
+    __tablename__ = "news_feeds"
+
+    url = Column(String, primary_key=True)
+    etag = Column(String, nullable=True)
+    last_modified = Column(String, nullable=True)
+    titles = Column(Text, default="[]")
+    fetched_at = Column(DateTime, nullable=True)
+
+class NewsFeed(Base):
+    __tablename__ = "news_feed_registry"
+
+    id = Column(Integer, primary_key=True, index=True)
+    url = Column(String, unique=True)
+    name = Column(String, default="")
+    language = Column(String(8), default="ar", index=True)
+    enabled = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+class NewsKeyword(Base):
+    __tablename__ = "news_keywords"
+    __table_args__ = (UniqueConstraint("language", "keyword", name="uq_news_keywords_language_keyword"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    language = Column(String(8), default="ar", index=True)
+    keyword = Column(String)
+
+# =========================================================
+# 10. أرقام نسخ البيانات العامة لكاش HTTP (Response Cache Versions)
+# =========================================================
+class CacheVersion(Base):
+    __tablename__ = "cache_versions"
+
+    namespace = Column(String(32), primary_key=True)
+    version = Column(Integer, default=0)
+
+# =========================================================
+# 11. فهرس ملفات التخزين (Stored Files Index for GC & Quota)
+# =========================================================
+class StoredFile(Base):
+    __tablename__ = "stored_files"
+    __table_args__ = (
+        Index("ix_stored_files_kind_created", "kind", "created_at"),
+        Index("ix_stored_files_last_access", "last_access_at"),
+    )
+
+    # المسار نسبةً إلى STORAGE_PATH
+    path = Column(String, primary_key=True)
+    kind = Column(String(16))       # chart | blob | article
+    size = Column(Integer, default=0)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    last_access_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+# =========================================================
+# 12. سجل إصدارات البنية (Schema Version)
+# =========================================================
+# الهجرات نفسها في migrations.py: استيراد هذا الملف لم يعد يلمس البنية
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
+    name = Column(String)
+    applied_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+# =========================================================
+# 13. دفتر الرصيد (Append-Only Credit Ledger)
+# =========================================================
+# users.credits هو الرصيد الحي (يُعدل بتحديث مشروط ذري)، وكل تغيير عليه يُسجل هنا
+# في نفس المعاملة. (kind, ref) فريد: لا يمكن حجز أو إرجاع نفس العملية مرتين.
+# حذف الحساب يحذف سطوره صراحة (credit_ledger.forget_user): SQLite قد يعيد استخدام رقم المستخدم.
+class CreditLedgerEntry(Base):
+    __tablename__ = "credit_ledger"
+    __table_args__ = (
+        Index("ix_credit_ledger_user_id_id", "user_id", "id"),
+        UniqueConstraint("kind", "ref", name="uq_credit_ledger_kind_ref"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    delta = Column(Integer, nullable=False)
+    kind = Column(String(16), nullable=False)   # opening | signup | reserve | refund | admin
+    ref = Column(String(64), nullable=True)     # job:12 | analysis:<hex>
+    balance_after = Column(Integer)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+# الرصيد المجمّع دورياً من الدفتر حتى through_id (للتحقق من users.credits بدون جمع كل السجل)
+class CreditBalance(Base):
+    __tablename__ = "credit_balances"
+
+    user_id = Column(Integer, primary_key=True)
+    balance = Column(Integer, default=0)
+    through_id = Column(Integer, default=0, index=True)
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+# مؤشرات المسح الدوري على الدفتر (آخر id فُحص): تبقى بعد إعادة التشغيل وتنتقل بين العمال
+# مع قفل المهمة الخلفية، فلا يُعاد مسح سجل الحجوزات كاملاً (credit_ledger.release_orphans)
+class CreditLedgerCursor(Base):
+    __tablename__ = "credit_ledger_cursors"
+
+    name = Column(String(32), primary_key=True)
+    through_id = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
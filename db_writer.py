@@ -0,0 +1,336 @@
+# =================================================================
+# ✍️ KAIA DB WRITER – كاتب واحد لكل عامل مع تثبيت جماعي (SQLite Group Commit)
+# =================================================================
+# على SQLite كاتب واحد فقط في أي لحظة: بدل أن تتسابق خيوط الطلبات على قفل الكتابة
+# (وتفشل بـ "database is locked")، تُرسل مسارات الكتابة الساخنة دالة كتابة إلى هذا الطابور.
+# خيط واحد يأخذ كل ما تجمع في الطابور، ينفذه في معاملة BEGIN IMMEDIATE واحدة
+# (كل دالة داخل SAVEPOINT خاص بها فلا يُفسد فشل إحداها البقية)، ثم commit واحد للجميع.
+# بين عمال gunicorn: قفل ملف (flock) يمرر دور الكاتب من عامل لآخر فور انتهائه، بدل انتظار
+# busy_timeout الذي ينام بفترات متزايدة (حتى 100ms) قبل إعادة المحاولة.
+# على Postgres (أو SQLITE_WRITE_QUEUE=0) تُنفذ الدالة مباشرة في جلسة قصيرة بنفس الواجهة
+# (run: جلسة غير متزامنة عبر run_sync، فلا يُحجز خيط أثناء انتظار قاعدة البيانات).
+# دالة الكتابة: fn(db, *args) بدون commit، وقيمتها تعود للمستدعي بعد التثبيت.
+# القياس: python db_writer.py bench [ثواني] [عمال]  (الإعداد الحالي مقابل الإعداد القديم)
+
+import os
+import sys
+import json
+import time
+import queue
+import asyncio
+import threading
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+from starlette.concurrency import run_in_threadpool
+
+from database import engine, WriteSessionLocal, async_session, IS_SQLITE, SQLITE_PRAGMAS, USE_ASYNC_DB
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+# الطابور يحتاج SAVEPOINT و BEGIN IMMEDIATE (يفعّلهما SQLITE_PRAGMAS في database.py)
+SQLITE_WRITE_QUEUE = os.getenv("SQLITE_WRITE_QUEUE", "1") == "1" and IS_SQLITE and SQLITE_PRAGMAS
+SQLITE_WRITE_BATCH = int(os.getenv("SQLITE_WRITE_BATCH", "128"))
+
+STATS = {"writes": 0, "batches": 0, "failed": 0, "max_batch": 0}
+
+_queue = queue.Queue()
+_thread = None
+_thread_pid = None
+_start_lock = threading.Lock()
+_lock_file = None
+
+
+# -----------------------------------------------------------------
+# 2. الخيط الكاتب (Writer Thread)
+# -----------------------------------------------------------------
+
+def _drain(first) -> list:
+    # لا ننتظر عمداً: ما تجمع أثناء تثبيت الدفعة السابقة هو الدفعة التالية
+    batch = [first]
+    while len(batch) < SQLITE_WRITE_BATCH:
+        try:
+            batch.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+@contextmanager
+def _cross_worker_lock():
+    global _lock_file
+    database = engine.url.database
+    if fcntl is None or not database or database == ":memory:":
+        yield
+        return
+    if _lock_file is None:
+        _lock_file = open(f"{database}.write.lock", "w")
+    fcntl.flock(_lock_file, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(_lock_file, fcntl.LOCK_UN)
+
+
+def _commit_batch(batch: list):
+    with _cross_worker_lock():
+        _commit_batch_locked(batch)
+
+
+def _commit_batch_locked(batch: list):
+    outcomes = []
+    db = WriteSessionLocal()
+    try:
+        for fn, args, future in batch:
+            try:
+                with db.begin_nested():
+                    outcomes.append((future, fn(db, *args), None))
+            except Exception as e:
+                outcomes.append((future, None, e))
+        db.commit()
+    except Exception as e:
+        # فشل التثبيت نفسه: لا شيء من الدفعة كُتب
+        db.rollback()
+        outcomes = [(future, None, error or e) for future, _, error in outcomes]
+        outcomes += [(future, None, e) for _, _, future in batch[len(outcomes):]]
+    finally:
+        db.close()
+
+    STATS["batches"] += 1
+    STATS["max_batch"] = max(STATS["max_batch"], len(batch))
+    for future, result, error in outcomes:
+        if error is None:
+            STATS["writes"] += 1
+            future.set_result(result)
+        else:
+            STATS["failed"] += 1
+            future.set_exception(error)
+
+
+def _writer_loop():
+    while True:
+        batch = _drain(_queue.get())
+        try:
+            _commit_batch(batch)
+        except Exception as e:
+            print(f"DB Writer Error: {e}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+def _ensure_started():
+    global _thread, _thread_pid, _lock_file
+    # يبدأ عند أول كتابة في كل عملية (بعد fork عمال gunicorn، لا قبله)
+    if _thread is not None and _thread_pid == os.getpid():
+        return
+    with _start_lock:
+        if _thread is None or _thread_pid != os.getpid():
+            # ملف القفل الموروث من العملية الأم يشارك نفس القفل: كل عامل يفتح ملفه
+            _lock_file = None
+            _thread = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+            _thread.start()
+            _thread_pid = os.getpid()
+
+
+# -----------------------------------------------------------------
+# 3. واجهة الكتابة (Submit API)
+# -----------------------------------------------------------------
+
+def _run_direct(fn, args):
+    db = WriteSessionLocal()
+    try:
+        result = fn(db, *args)
+        db.commit()
+        return result
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _enqueue(fn, args) -> Future:
+    _ensure_started()
+    future = Future()
+    _queue.put((fn, args, future))
+    return future
+
+
+def submit(fn, *args):
+    # للكود المتزامن (خيوط الطلبات والمهام): ينتظر حتى تثبيت الدفعة ويعيد النتيجة أو يرفع الخطأ
+    if not SQLITE_WRITE_QUEUE:
+        return _run_direct(fn, args)
+    return _enqueue(fn, args).result()
+
+
+async def run(fn, *args):
+    # للكود غير المتزامن: انتظار بدون حجز خيط من threadpool
+    if not SQLITE_WRITE_QUEUE:
+        if not USE_ASYNC_DB:
+            return await run_in_threadpool(_run_direct, fn, args)
+        # نفس دالة الكتابة المتزامنة fn(db, *args) تعمل على المحرك غير المتزامن
+        async with async_session() as db:
+            result = await db.run_sync(fn, *args)
+            await db.commit()
+            return result
+    return await asyncio.wrap_future(_enqueue(fn, args))
+
+
+def stats() -> dict:
+    return dict(STATS, enabled=SQLITE_WRITE_QUEUE, pending=_queue.qsize())
+
+
+# -----------------------------------------------------------------
+# 4. القياس (Mixed Load Benchmark)
+# -----------------------------------------------------------------
+# كل عامل عملية مستقلة (مثل gunicorn): خيوط كتابة (حفظ تحليل + تحديث عداد المستخدم
+# مثل save_analysis) وخيوط قراءة (سجل المستخدم) تعمل معاً لمدة ثابتة.
+
+BENCH_WRITERS = 8
+BENCH_READERS = 4
+# معدل قراءة ثابت لكل خيط (حمل معروض ثابت): المقارنة تكون بزمن القراءة وسرعة الكتابة تحت نفس الطلب
+BENCH_READ_INTERVAL = 0.05
+BENCH_USERS = 50
+
+
+def _bench_write(db, user_id: int):
+    from database import Analysis, User
+    analysis = Analysis(user_id=user_id, symbol="EURUSD", signal="شراء", reason="bench", timeframe="H1")
+    db.add(analysis)
+    db.query(User).filter(User.id == user_id).update(
+        {"total_used_analyzes": User.total_used_analyzes + 1, "version": User.version + 1}, synchronize_session=False
+    )
+    db.flush()
+    return analysis.id
+
+
+def _bench_worker(seconds: float):
+    from database import SessionLocal, Analysis
+    deadline = time.monotonic() + seconds
+    result = {"writes": 0, "write_errors": 0, "reads": 0, "read_errors": 0, "read_ms": [], "errors": {}}
+    lock = threading.Lock()
+
+    def record_error(kind, e):
+        with lock:
+            result[kind] += 1
+            key = str(e).split("\n")[0][:80]
+            result["errors"][key] = result["errors"].get(key, 0) + 1
+
+    def writer(n):
+        while time.monotonic() < deadline:
+            try:
+                submit(_bench_write, 1 + (n + result["writes"]) % BENCH_USERS)
+                with lock:
+                    result["writes"] += 1
+            except Exception as e:
+                record_error("write_errors", e)
+
+    def reader(n):
+        next_read = time.monotonic()
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            db = SessionLocal()
+            try:
+                db.query(Analysis.id, Analysis.symbol).filter(Analysis.user_id == 1 + n % BENCH_USERS) \
+                    .order_by(Analysis.id.desc()).limit(20).all()
+                with lock:
+                    result["reads"] += 1
+                    result["read_ms"].append((time.perf_counter() - started) * 1000)
+            except Exception as e:
+                record_error("read_errors", e)
+            finally:
+                db.close()
+            next_read += BENCH_READ_INTERVAL
+            time.sleep(max(0.0, next_read - time.monotonic()))
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(BENCH_WRITERS)]
+    threads += [threading.Thread(target=reader, args=(i,)) for i in range(BENCH_READERS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print(json.dumps(result))
+
+
+def _bench_setup():
+    import migrations
+    from database import SessionLocal, User
+    migrations.run()
+    db = SessionLocal()
+    try:
+        if db.query(User).count() < BENCH_USERS:
+            db.add_all([User(email=f"bench{i}@kaia.local", credits=0) for i in range(BENCH_USERS)])
+            db.commit()
+    finally:
+        db.close()
+
+
+def _percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def benchmark(seconds: float, workers: int) -> dict:
+    results = {}
+    configs = {
+        "legacy (rollback journal, direct commits)": {"SQLITE_PRAGMAS": "0", "SQLITE_WRITE_QUEUE": "0"},
+        "tuned (WAL + pragmas + writer queue)": {"SQLITE_PRAGMAS": "1", "SQLITE_WRITE_QUEUE": "1"},
+    }
+    for label, overrides in configs.items():
+        path = f"/tmp/kaia_bench_{os.getpid()}_{len(results)}.db"
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{path}", MIGRATE_ON_STARTUP="0", **overrides)
+        subprocess.run([sys.executable, __file__, "_setup"], env=env, check=True, stdout=subprocess.DEVNULL)
+        procs = [
+            subprocess.Popen([sys.executable, __file__, "_worker", str(seconds)], env=env, stdout=subprocess.PIPE, text=True)
+            for _ in range(workers)
+        ]
+        totals = {"writes": 0, "write_errors": 0, "reads": 0, "read_errors": 0, "read_ms": [], "errors": {}}
+        for proc in procs:
+            out, _ = proc.communicate()
+            part = json.loads(out.strip().splitlines()[-1])
+            for key in ("writes", "write_errors", "reads", "read_errors"):
+                totals[key] += part[key]
+            totals["read_ms"] += part["read_ms"]
+            for key, count in part["errors"].items():
+                totals["errors"][key] = totals["errors"].get(key, 0) + count
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        results[label] = {
+            "writes_per_sec": round(totals["writes"] / seconds, 1),
+            "write_errors": totals["write_errors"],
+            "reads_per_sec": round(totals["reads"] / seconds, 1),
+            "read_errors": totals["read_errors"],
+            "read_p50_ms": round(_percentile(totals["read_ms"], 0.50), 2),
+            "read_p99_ms": round(_percentile(totals["read_ms"], 0.99), 2),
+            "errors": totals["errors"],
+        }
+    return results
+
+
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "bench"
+    if mode == "_setup":
+        _bench_setup()
+    elif mode == "_worker":
+        _bench_worker(float(sys.argv[2]))
+    else:
+        seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+        workers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+        print(f"📊 {workers} workers x ({BENCH_WRITERS} writers + {BENCH_READERS} readers), {seconds:.0f}s each")
+        for label, row in benchmark(seconds, workers).items():
+            print(f"   {label}")
+            print(f"      writes/s {row['writes_per_sec']:>8} | write errors {row['write_errors']}")
+            print(f"      reads/s  {row['reads_per_sec']:>8} | read errors {row['read_errors']} | "
+                  f"p50 {row['read_p50_ms']} ms | p99 {row['read_p99_ms']} ms")
+            for message, count in row["errors"].items():
+                print(f"      ⚠️ {count}x {message}")
@@ -289,6 +289,45 @@ function formatAIValue(val) {
     return val;
 }
 
+// قراءة أحداث SSE من /api/analyze-chart?stream=1 (الردود غير المتدفقة مثل upgrade_required تصل JSON عادي)
+async function readAnalysisStream(res, onPartial) {
+    if (!(res.headers.get("content-type") || "").includes("text/event-stream")) {
+        return await res.json();
+    }
+
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    const partial = {};
+    let buffer = "";
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let sep;
+        while ((sep = buffer.indexOf("\n\n")) !== -1) {
+            const raw = buffer.slice(0, sep);
+            buffer = buffer.slice(sep + 2);
+            const eventLine = raw.split("\n").find(l => l.startsWith("event: "));
+            const dataLine = raw.split("\n").find(l => l.startsWith("data: "));
+            if (!eventLine || !dataLine) continue;
+            const payload = JSON.parse(dataLine.slice(6));
+            const eventName = eventLine.slice(7);
+
+            if (eventName === "field") {
+                partial[payload.key] = payload.value;
+                onPartial(partial);
+            } else if (eventName === "result") {
+                return payload;
+            } else if (eventName === "error") {
+                throw new Error(payload.detail);
+            }
+        }
+    }
+    throw new Error("stream ended without result");
+}
+
 async function runInstitutionalAnalysis() {
     const strategy = $("strategy")?.value || "SMC";
     const timeframe = $("timeframe")?.value || "15m";
@@ -313,7 +352,7 @@ async function runInstitutionalAnalysis() {
         const uploadFd = new FormData();
         uploadFd.append("chart", fileInput.files[0]);
 
-        const uploadRes = await fetch("/api/upload-chart", { method: "POST", body: uploadFd });
+        const uploadRes = await fetch("/api/upload-chart", { method: "POST", headers: { "Authorization": "Bearer " + token }, body: uploadFd });
         const uploadData = await uploadRes.json();
 
         const analyzeFd = new FormData();
@@ -322,13 +361,18 @@ async function runInstitutionalAnalysis() {
         analyzeFd.append("analysis_type", strategy);
         analyzeFd.append("lang", currentLang);
 
-        const analyzeRes = await fetch("/api/analyze-chart", {
+        // وضع البث: تُعرض أجزاء تقرير KAIA Master (الاتجاه ونقطة الارتكاز أولاً) فور اكتمالها
+        const analyzeRes = await fetch("/api/analyze-chart?stream=1", {
             method: "POST",
             headers: { "Authorization": "Bearer " + token },
             body: analyzeFd
         });
 
-        const data = await analyzeRes.json();
+        const data = await readAnalysisStream(analyzeRes, (partial) => {
+            if (strategy === "KAIA Master" && typeof renderMasterVisionUI === "function") {
+                renderMasterVisionUI(partial);
+            }
+        });
         
         if (data.status === "upgrade_required") {
             alert(data.detail);
@@ -500,7 +544,8 @@ window.sendChatMessage = async function() {
     messagesBox.scrollTop = messagesBox.scrollHeight;
 
     try {
-        const res = await fetch("/api/chat", {
+        // وضع البث: تظهر الكلمات فور وصولها بدلاً من انتظار الرد كاملاً
+        const res = await fetch("/api/chat?stream=1", {
             method: "POST",
             headers: { 
                 "Content-Type": "application/json",
@@ -509,14 +554,48 @@ window.sendChatMessage = async function() {
             body: JSON.stringify({ message: msg, lang: currentLang })
         });
 
-        const data = await res.json();
-        if (typing) typing.style.display = "none";
-
-        if (res.ok) {
-            appendChatMessage(data.reply, 'kaia');
-        } else {
+        if (!res.ok) {
+            const data = await res.json();
+            if (typing) typing.style.display = "none";
             appendChatMessage(data.detail || "عذراً يا مدير، حدث عطل فني بسيط.", 'kaia');
+            return;
         }
+
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        let bubble = null;
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            // كل حدث SSE ينتهي بسطر فارغ
+            let sep;
+            while ((sep = buffer.indexOf("\n\n")) !== -1) {
+                const raw = buffer.slice(0, sep);
+                buffer = buffer.slice(sep + 2);
+                const eventLine = raw.split("\n").find(l => l.startsWith("event: "));
+                const dataLine = raw.split("\n").find(l => l.startsWith("data: "));
+                if (!dataLine) continue;
+                const payload = JSON.parse(dataLine.slice(6));
+                const eventName = eventLine ? eventLine.slice(7) : "message";
+
+                if (eventName === "error") {
+                    if (typing) typing.style.display = "none";
+                    appendChatMessage(payload.detail || "عذراً يا مدير، حدث عطل فني بسيط.", 'kaia');
+                } else if (eventName === "message" && payload.delta) {
+                    if (!bubble) {
+                        if (typing) typing.style.display = "none";
+                        bubble = appendChatMessage("", 'kaia');
+                    }
+                    if (bubble) bubble.innerText += payload.delta;
+                    messagesBox.scrollTop = messagesBox.scrollHeight;
+                }
+            }
+        }
+        if (typing) typing.style.display = "none";
     } catch (e) {
         if (typing) typing.style.display = "none";
         appendChatMessage("فشل الاتصال بمدير الأعمال، تأكد من جودة الإنترنت.", 'kaia');
@@ -535,4 +614,5 @@ function appendChatMessage(text, sender) {
     
     // تمرير تلقائي لأسفل المحادثة
     container.scrollTop = container.scrollHeight;
+    return div;
 }
\ No newline at end of file
@@ -417,7 +417,7 @@ async function runDemoAnalysis() {
     try {
         const upFd = new FormData(); 
         upFd.append("chart", fileInput.files[0]);
-        const uploadRes = await fetch("/api/upload-chart", { method: "POST", body: upFd });
+        const uploadRes = await fetch("/api/upload-chart", { method: "POST", headers: { "Authorization": "Bearer " + authToken }, body: upFd });
         const { filename } = await uploadRes.json();
 
         const anFd = new FormData();
@@ -1,8 +1,120 @@
-self.addEventListener('install', (e) => {
-  console.log('KAIA Service Worker Installed');
+// =================================================================
+// KAIA Service Worker – واجهة تعمل من الكاش + استراتيجيات تخزين حسب نوع الطلب
+// =================================================================
+// قائمة الملفات المسبقة (PRECACHE) يولدها السيرفر عند البناء (static_assets.py):
+// أي تعديل في أي ملف يغير الإصدار، فيتثبت Service Worker جديد ويحذف الكاش القديم.
+
+const PRECACHE = __KAIA_PRECACHE_MANIFEST__;
+
+const SHELL_CACHE = `kaia-shell-${PRECACHE.version}`;
+const STATIC_CACHE = "kaia-static-v1";
+const API_CACHE = "kaia-api-v1";
+const HISTORY_CACHE = "kaia-history-v1";
+const KEEP_CACHES = [SHELL_CACHE, STATIC_CACHE, API_CACHE, HISTORY_CACHE];
+// اسم مبصوم من static_assets.py: style.3f2a9c0d1e4b.css (12 خانة hex قبل الامتداد)
+const FINGERPRINTED = /\.[0-9a-f]{12}\.[A-Za-z0-9]+$/;
+
+const SWR_API = ["/api/news", "/api/articles", "/api/sponsors"];
+
+self.addEventListener("install", (e) => {
+  e.waitUntil(
+    caches.open(SHELL_CACHE)
+      .then((cache) => cache.addAll(PRECACHE.urls))
+      .then(() => self.skipWaiting())
+  );
+});
+
+// الملفات المبصومة من نشرات سابقة لم تعد في القائمة الحالية: تُحذف بدل أن تتراكم على الجهاز
+async function pruneStatic() {
+  const current = new Set(PRECACHE.urls);
+  const cache = await caches.open(STATIC_CACHE);
+  const requests = await cache.keys();
+  await Promise.all(
+    requests.filter((r) => !current.has(new URL(r.url).pathname)).map((r) => cache.delete(r))
+  );
+}
+
+self.addEventListener("activate", (e) => {
+  e.waitUntil(
+    caches.keys()
+      .then((keys) => Promise.all(
+        keys.filter((k) => k.startsWith("kaia-") && !KEEP_CACHES.includes(k)).map((k) => caches.delete(k))
+      ))
+      .then(pruneStatic)
+      .then(() => self.clients.claim())
+  );
 });
 
-self.addEventListener('fetch', (e) => {
-  // هذا الكود يضمن تشغيل التطبيق بسلاسة
-  e.respondWith(fetch(e.request));
-});
\ No newline at end of file
+// --- الاستراتيجيات (Strategies) ---
+
+// الملفات المبصومة لا تتغير أبداً: من الكاش مباشرة
+async function cacheFirst(request) {
+  const cached = await caches.match(request);
+  if (cached) return cached;
+  const response = await fetch(request);
+  if (response.ok) {
+    const cache = await caches.open(STATIC_CACHE);
+    cache.put(request, response.clone());
+  }
+  return response;
+}
+
+// نعرض النسخة المخزنة فوراً ونحدثها في الخلفية للزيارة القادمة
+async function staleWhileRevalidate(request, cacheName, event) {
+  const cache = await caches.open(cacheName);
+  const cached = await cache.match(request, { ignoreVary: true });
+  const network = fetch(request)
+    .then((response) => {
+      if (response.ok) cache.put(request, response.clone());
+      return response;
+    })
+    .catch(() => cached);
+  if (cached) {
+    event.waitUntil(network);
+    return cached;
+  }
+  return network;
+}
+
+// بيانات المستخدم: الشبكة أولاً، والكاش فقط عند انقطاع الاتصال
+async function networkFirst(request, cacheKey) {
+  const cache = await caches.open(HISTORY_CACHE);
+  try {
+    const response = await fetch(request);
+    if (response.ok) cache.put(cacheKey, response.clone());
+    return response;
+  } catch (err) {
+    const cached = await cache.match(cacheKey);
+    if (cached) return cached;
+    throw err;
+  }
+}
+
+// مفتاح كاش منفصل لكل توكن حتى لا يرى مستخدم سجل مستخدم آخر على نفس الجهاز
+async function userScopedKey(request) {
+  const auth = request.headers.get("Authorization") || "";
+  const digest = await crypto.subtle.digest("SHA-256", new TextEncoder().encode(auth));
+  const tag = Array.from(new Uint8Array(digest).slice(0, 8)).map((b) => b.toString(16).padStart(2, "0")).join("");
+  const url = new URL(request.url);
+  url.searchParams.set("__u", tag);
+  return new Request(url.toString());
+}
+
+self.addEventListener("fetch", (e) => {
+  const request = e.request;
+  if (request.method !== "GET") return;
+  const url = new URL(request.url);
+  if (url.origin !== self.location.origin) return;
+
+  if (request.mode === "navigate" && PRECACHE.shell.includes(url.pathname)) {
+    e.respondWith(staleWhileRevalidate(new Request(url.pathname), SHELL_CACHE, e));
+  } else if (url.pathname.startsWith("/static/") && FINGERPRINTED.test(url.pathname)) {
+    // الروابط غير المبصومة تبقى للشبكة وكاش المتصفح القصير (max-age) ولا تُثبت هنا للأبد
+    e.respondWith(cacheFirst(request));
+  } else if (SWR_API.includes(url.pathname)) {
+    e.respondWith(staleWhileRevalidate(request, API_CACHE, e));
+  } else if (url.pathname === "/api/history") {
+    e.respondWith(userScopedKey(request).then((key) => networkFirst(request, key)));
+  }
+  // أي طلب آخر (التحليل، الدخول، الإدارة) يذهب للشبكة مباشرة بدون تدخل
+});
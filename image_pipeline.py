@@ -0,0 +1,290 @@
+# =================================================================
+# 🖼️ KAIA IMAGE PIPELINE – تجهيز الشارت قبل إرساله لنموذج الرؤية
+# =================================================================
+# يتم كل العمل على الصورة مرة واحدة عند الرفع: التحقق من الصيغة، حذف البيانات
+# الوصفية (EXIF)، تصغير الأبعاد، واختيار مستوى detail، ثم إعادة الضغط.
+# التحليل بعدها يقرأ الملف الجاهز ونوعه من الملف المرافق فقط.
+# الفحص: python image_pipeline.py selftest
+# القياس (حجم الإرسال وزمن التجهيز قبل/بعد): python image_pipeline.py bench [تكرار]
+
+import io
+import os
+import sys
+import json
+import math
+import time
+import base64
+import random
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+ALLOWED_FORMATS = {"PNG", "JPEG", "WEBP", "GIF"}
+# أطول ضلع بعد التصغير، وأقصر ضلع (OpenAI يصغّر وضع high إلى 768 على الضلع الأقصر أصلاً)
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "2048"))
+IMAGE_MAX_SHORT_EDGE = int(os.getenv("IMAGE_MAX_SHORT_EDGE", "768"))
+# WEBP أو JPEG أو PNG
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "WEBP").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+# أقصى عدد بكسلات مقبول (عرض × ارتفاع) يُفحص من رأس الملف قبل فك الترميز
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(Image.MAX_IMAGE_PIXELS)))
+# auto: low للصور الصغيرة (≤ 512) و high لغيرها | أو قيمة ثابتة low / high
+VISION_DETAIL = os.getenv("VISION_DETAIL", "auto").lower()
+
+_EXTENSIONS = {"WEBP": "webp", "JPEG": "jpg", "PNG": "png"}
+_MIME_TYPES = {"webp": "image/webp", "jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png", "gif": "image/gif"}
+
+
+class InvalidImageError(ValueError):
+    pass
+
+
+# -----------------------------------------------------------------
+# 2. التجهيز عند الرفع (Prepare at Upload Time)
+# -----------------------------------------------------------------
+
+# التوقيعات الثنائية في بداية الملف (Magic Bytes) لرفض غير الصور قبل فك ترميزها
+_MAGIC_BYTES = [
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+]
+MAGIC_HEAD_SIZE = 12
+
+
+def sniff_format(head: bytes):
+    for signature, fmt in _MAGIC_BYTES:
+        if head.startswith(signature):
+            return fmt
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+
+def output_format() -> str:
+    return IMAGE_OUTPUT_FORMAT if IMAGE_OUTPUT_FORMAT in _EXTENSIONS else "WEBP"
+
+
+def output_extension() -> str:
+    return _EXTENSIONS[output_format()]
+
+
+def _pick_detail(width: int, height: int) -> str:
+    if VISION_DETAIL in ("low", "high"):
+        return VISION_DETAIL
+    return "low" if max(width, height) <= 512 else "high"
+
+
+def check_dimensions(img):
+    # Pillow يرفض تلقائياً فقط ما فوق ضعف MAX_IMAGE_PIXELS (DecompressionBombError)؛ بين 1× و 2×
+    # يكتفي بتحذير ويفك الصورة كاملة. الأبعاد متاحة من الرأس بعد open وقبل load، فنرفض هنا
+    # (فحص صريح بدل تحويل التحذير لخطأ: فلاتر warnings عامة للعملية وغير آمنة بين الخيوط)
+    width, height = img.size
+    if width * height > IMAGE_MAX_PIXELS:
+        raise InvalidImageError("أبعاد الصورة كبيرة جداً")
+
+
+def prepare_chart(source):
+    # source: بايتات أو ملف مفتوح (الرفع المتدفق) | يعيد (البايتات الجاهزة, الامتداد, البيانات الوصفية)
+    stream = io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+    original_size = stream.seek(0, io.SEEK_END)
+    try:
+        stream.seek(0)
+        with Image.open(stream) as probe:
+            check_dimensions(probe)
+            probe.verify()
+        stream.seek(0)
+        img = Image.open(stream)
+        source_format = img.format
+        check_dimensions(img)
+        img.load()
+    except Image.DecompressionBombError as e:
+        # أبعاد تتجاوز ضعف Image.MAX_IMAGE_PIXELS: ملف صغير يفك إلى مئات الميغابايت
+        # (DecompressionBombError يرث Exception وليس OSError)
+        raise InvalidImageError("أبعاد الصورة كبيرة جداً") from e
+    except (UnidentifiedImageError, OSError, SyntaxError) as e:
+        raise InvalidImageError("صيغة الصورة غير مدعومة") from e
+
+    if source_format not in ALLOWED_FORMATS:
+        raise InvalidImageError("صيغة الصورة غير مدعومة")
+
+    # تصحيح الاتجاه حسب EXIF قبل حذفه (صور الجوال)
+    img = ImageOps.exif_transpose(img)
+
+    width, height = img.size
+    scale = min(1.0, IMAGE_MAX_EDGE / max(width, height), IMAGE_MAX_SHORT_EDGE / min(width, height))
+    if scale < 1.0:
+        img = img.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+
+    out_format = output_format()
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    if out_format == "JPEG" or not has_alpha:
+        img = img.convert("RGB")
+    else:
+        img = img.convert("RGBA")
+
+    # إعادة الحفظ بدون info/exif تحذف كل البيانات الوصفية
+    buffer = io.BytesIO()
+    if out_format == "PNG":
+        img.save(buffer, "PNG", optimize=True)
+    elif out_format == "WEBP":
+        img.save(buffer, "WEBP", quality=IMAGE_QUALITY, method=4)
+    else:
+        img.save(buffer, "JPEG", quality=IMAGE_QUALITY, optimize=True)
+    prepared = buffer.getvalue()
+
+    ext = _EXTENSIONS[out_format]
+    meta = {
+        "mime": _MIME_TYPES[ext],
+        "detail": _pick_detail(*img.size),
+        "width": img.size[0],
+        "height": img.size[1],
+        "original_bytes": original_size,
+        "prepared_bytes": len(prepared),
+    }
+    return prepared, ext, meta
+
+
+def meta_path(img_path: str) -> str:
+    return img_path + ".json"
+
+
+def save_meta(img_path: str, meta: dict):
+    with open(meta_path(img_path), "w") as f:
+        json.dump(meta, f)
+
+
+# -----------------------------------------------------------------
+# 3. القراءة عند التحليل (Load Prepared Payload)
+# -----------------------------------------------------------------
+
+def load_meta(img_path: str) -> dict:
+    try:
+        with open(meta_path(img_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # ملفات قديمة رُفعت قبل خط التجهيز: نعتمد على الامتداد فقط
+        ext = img_path.rsplit(".", 1)[-1].lower()
+        return {"mime": _MIME_TYPES.get(ext, "image/png"), "detail": "auto"}
+
+
+def build_image_part(image_bytes: bytes, meta: dict) -> dict:
+    encoded = base64.b64encode(image_bytes).decode()
+    return {
+        "type": "image_url",
+        "image_url": {"url": f"data:{meta.get('mime', 'image/png')};base64,{encoded}", "detail": meta.get("detail", "auto")},
+    }
+
+
+# -----------------------------------------------------------------
+# 4. فحص ذاتي (Self-Test: Rejected Inputs)
+# -----------------------------------------------------------------
+
+def _bomb_png(width: int = 20000, height: int = 20000) -> bytes:
+    # 400 مليون بكسل بلون واحد: عشرات الكيلوبايتات مضغوطة
+    buffer = io.BytesIO()
+    Image.new("1", (width, height)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def selftest() -> bool:
+    cases = [
+        ("decompression bomb", _bomb_png()),
+        # بين 1× و 2× من MAX_IMAGE_PIXELS: Pillow يحذر فقط
+        ("oversized, warning range", _bomb_png(10000, 10000)),
+        ("not an image", b"%PDF-1.7 not an image"),
+        ("truncated png", b"\x89PNG\r\n\x1a\n" + b"\x00" * 32),
+    ]
+    ok = True
+    for label, data in cases:
+        try:
+            prepare_chart(data)
+            outcome, passed = "accepted", False
+        except InvalidImageError as e:
+            outcome, passed = f"InvalidImageError ({e})", True
+        except Exception as e:
+            outcome, passed = f"unhandled {type(e).__name__}", False
+        ok = ok and passed
+        print(f"{'✅' if passed else '❌'} {label} ({len(data)} bytes): {outcome}")
+    return ok
+
+
+# -----------------------------------------------------------------
+# 5. القياس (Benchmark: Bytes Sent & Preparation Time)
+# -----------------------------------------------------------------
+
+def vision_tokens(width: int, height: int, detail: str) -> int:
+    # قاعدة OpenAI للصور: low = 85 ثابتة | high = 85 + 170 لكل مربع 512 بعد الملاءمة في 2048 ثم 768 للضلع الأقصر
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def _sample(size, fmt: str, grain: int) -> bytes:
+    # خلفية داكنة وشموع عشوائية + ضجيج بدقة أقل (grain) يحاكي التدرجات والنصوص في لقطات الجوال
+    rnd = random.Random(size[0] * 31 + grain)
+    noise_size = (max(1, size[0] // grain), max(1, size[1] // grain))
+    img = Image.frombytes("RGB", noise_size, rnd.randbytes(noise_size[0] * noise_size[1] * 3)).resize(size, Image.BILINEAR)
+    img = Image.blend(Image.new("RGB", size, (19, 23, 34)), img, 0.25)
+    price, x = size[1] / 2, 20
+    while x < size[0] - 20:
+        move = rnd.gauss(0, size[1] / 60)
+        top, bottom = sorted((price, price + move))
+        img.paste((38, 166, 154) if move >= 0 else (239, 83, 80), (x, int(top), x + 8, int(bottom) + 2))
+        price = min(max(price + move, size[1] * 0.1), size[1] * 0.9)
+        x += 12
+    buffer = io.BytesIO()
+    img.save(buffer, fmt, **({"quality": 92} if fmt == "JPEG" else {}))
+    return buffer.getvalue()
+
+
+def bench(rounds: int = 5):
+    # قبل: الملف الخام كما رُفع بوسم image/png و detail=auto (high للصور الكبيرة)
+    # بعد: ناتج prepare_chart مرة واحدة عند الرفع، والتحليل يرمّز base64 فقط
+    samples = [
+        ("phone screenshot PNG 1170x2532", _sample((1170, 2532), "PNG", 6)),
+        ("desktop chart PNG 2560x1440", _sample((2560, 1440), "PNG", 16)),
+        ("phone photo JPEG 3024x4032", _sample((3024, 4032), "JPEG", 2)),
+    ]
+    for label, raw in samples:
+        with Image.open(io.BytesIO(raw)) as probe:
+            raw_size = probe.size
+        started = time.perf_counter()
+        for _ in range(rounds):
+            prepared, ext, meta = prepare_chart(raw)
+        prepare_ms = (time.perf_counter() - started) / rounds * 1000
+
+        started = time.perf_counter()
+        for _ in range(rounds):
+            before = build_image_part(raw, {"mime": "image/png", "detail": "auto"})
+        before_ms = (time.perf_counter() - started) / rounds * 1000
+        started = time.perf_counter()
+        for _ in range(rounds):
+            after = build_image_part(prepared, meta)
+        after_ms = (time.perf_counter() - started) / rounds * 1000
+
+        before_bytes = len(before["image_url"]["url"])
+        after_bytes = len(after["image_url"]["url"])
+        print(f"📦 {label} ({len(raw) / 1024:.0f} KB)")
+        print(f"   before: {before_bytes / 1024:.0f} KB base64 | encode {before_ms:.1f} ms | "
+              f"~{vision_tokens(*raw_size, 'high')} tokens")
+        print(f"   after:  {after_bytes / 1024:.0f} KB base64 ({ext} {meta['width']}x{meta['height']}, {meta['detail']}) | "
+              f"encode {after_ms:.1f} ms | prepare once at upload {prepare_ms:.0f} ms | "
+              f"~{vision_tokens(meta['width'], meta['height'], meta['detail'])} tokens | "
+              f"-{(1 - after_bytes / before_bytes) * 100:.0f}% bytes")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "selftest"
+    if command == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 5)
+    elif command == "selftest":
+        sys.exit(0 if selftest() else 1)
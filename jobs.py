@@ -0,0 +1,341 @@
+# =================================================================
+# 📬 KAIA JOB QUEUE – طابور مهام التحليل الدائم (SQLite / Postgres)
+# =================================================================
+# المهمة تُحفظ في جدول analysis_jobs مع حجز الرصيد في نفس المعاملة، ثم يلتقطها
+# عامل خلفي حسب أولوية الباقة (Platinum قبل Trial). انقطاع اتصال الجوال لم يعد
+# يضيّع التحليل المدفوع: العميل يستعلم لاحقاً برقم المهمة أو يستلمها عبر Webhook.
+
+import os
+import json
+import socket
+import asyncio
+import secrets
+import ipaddress
+from urllib.parse import urlsplit
+from datetime import datetime, timedelta, timezone
+
+import requests
+from starlette.concurrency import run_in_threadpool
+
+import auth_cache
+import credit_ledger
+import db_writer
+from credit_ledger import InsufficientCredits
+from database import SessionLocal, User, AnalysisJob
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "2"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", "5"))
+# مهمة "running" بلا تقدم بعد هذه المدة تعود للطابور (عامل توقف فجأة)
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+# العامل يجدد locked_at أثناء التحليل، فلا يُعاد التقاط مهمة ما زالت تعمل
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", str(max(JOB_LEASE_SECONDS / 3, 1))))
+
+# قائمة سماح اختيارية لمضيفي Webhook (مفصولة بفواصل)؛ فارغة = أي مضيف عام
+JOB_WEBHOOK_ALLOWED_HOSTS = {h.strip().lower() for h in os.getenv("JOB_WEBHOOK_ALLOWED_HOSTS", "").split(",") if h.strip()}
+
+TIER_PRIORITY = {"Platinum": 30, "Pro": 20, "Basic": 10, "Trial": 0}
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+# -----------------------------------------------------------------
+# 2. الإدراج وحجز الرصيد (Enqueue + Atomic Credit Reservation)
+# -----------------------------------------------------------------
+
+def insert_job(db, user_id: int, priority: int, credit_reserved: bool, filename: str, timeframe: str,
+               analysis_type: str, lang: str, webhook_url: str = None) -> int:
+    # دالة كتابة لـ db_writer (بدون commit): الحجز ورقم المهمة في نفس المعاملة، إما الاثنان أو لا شيء
+    job = AnalysisJob(
+        user_id=user_id,
+        filename=filename,
+        timeframe=timeframe,
+        analysis_type=analysis_type,
+        lang=lang,
+        webhook_url=webhook_url,
+        priority=priority,
+        credit_reserved=credit_reserved,
+    )
+    db.add(job)
+    db.flush()
+    if credit_reserved:
+        credit_ledger.reserve(db, user_id, f"job:{job.id}")
+    return job.id
+
+
+async def enqueue(user: User, filename: str, timeframe: str, analysis_type: str, lang: str, webhook_url: str = None) -> int:
+    # عبر الكاتب الموحد مثل بقية حركات الرصيد: على SQLite لا يتسابق خيط الطلب على قفل الكتابة
+    # يعيد رقم المهمة، أو يرفع InsufficientCredits (ولا يُدرج شيء)
+    return await db_writer.run(
+        insert_job, user.id, TIER_PRIORITY.get(user.tier, 0), not user.is_whale,
+        filename, timeframe, analysis_type, lang, webhook_url,
+    )
+
+
+# -----------------------------------------------------------------
+# 3. الالتقاط والتسوية (Claim / Complete / Fail)
+# -----------------------------------------------------------------
+
+def _lease_filter(query, job: AnalysisJob):
+    # كل عملية على مهمة قيد التنفيذ مشروطة بأن القفل ما زال لنا: إن انتهى الحجز (lease)
+    # وأُعيدت المهمة لعامل آخر، لا نسوّي الرصيد ولا نكتب النتيجة مرتين
+    return query.filter(
+        AnalysisJob.id == job.id, AnalysisJob.locked_by == job.locked_by, AnalysisJob.status == "running"
+    )
+
+
+def write_requeue_stale(db) -> list:
+    # دالة كتابة لـ db_writer: يعيد قائمة المهام التي فشلت نهائياً هنا (لتنظيف الصورة وإشعار Webhook)
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(seconds=JOB_LEASE_SECONDS)
+    stale = db.query(AnalysisJob).filter(AnalysisJob.status == "running", AnalysisJob.locked_at < cutoff).all()
+    failed = []
+    for job in stale:
+        # attempts زادت عند الالتقاط: مهمة تُسقط العامل في كل مرة لا تدور للأبد
+        final = job.attempts >= JOB_MAX_ATTEMPTS
+        values = {"status": "failed", "finished_at": now, "error": "lease expired"} if final else {"status": "queued"}
+        values["locked_by"] = None
+        if _lease_filter(db.query(AnalysisJob), job).update(values, synchronize_session=False) != 1:
+            continue
+        if final:
+            if job.credit_reserved:
+                credit_ledger.refund(db, job.user_id, f"job:{job.id}")
+            # نسخة منفصلة عن الجلسة تكفي للتنظيف والإشعار بعد التثبيت
+            db.expunge(job)
+            job.status, job.error = "failed", "lease expired"
+            failed.append(job)
+    return failed
+
+
+async def requeue_stale() -> list:
+    return await db_writer.run(write_requeue_stale)
+
+
+def claim_next():
+    db = SessionLocal()
+    try:
+        now = datetime.now(timezone.utc)
+        candidate = (
+            db.query(AnalysisJob.id)
+            .filter(AnalysisJob.status == "queued", AnalysisJob.available_at <= now)
+            .order_by(AnalysisJob.priority.desc(), AnalysisJob.id.asc())
+            .limit(1)
+            .scalar()
+        )
+        if candidate is None:
+            return None
+
+        # تحديث مشروط: إن سبقنا عامل آخر لنفس المهمة يكون rowcount = 0
+        # رمز قفل فريد لكل التقاط (وليس لكل عملية): نفس العامل قد يلتقط المهمة مجدداً بعد انتهاء الحجز
+        lease = f"{WORKER_ID}:{secrets.token_hex(4)}"
+        claimed = db.query(AnalysisJob).filter(
+            AnalysisJob.id == candidate, AnalysisJob.status == "queued"
+        ).update({
+            "status": "running",
+            "locked_at": now,
+            "locked_by": lease,
+            "attempts": AnalysisJob.attempts + 1,
+        }, synchronize_session=False)
+        db.commit()
+        if claimed != 1:
+            return None
+
+        job = db.get(AnalysisJob, candidate)
+        db.expunge(job)
+        return job
+    finally:
+        db.close()
+
+
+def heartbeat(job: AnalysisJob) -> bool:
+    # تجديد الحجز أثناء التحليل الطويل؛ False = فقدنا المهمة
+    db = SessionLocal()
+    try:
+        renewed = _lease_filter(db.query(AnalysisJob), job).update(
+            {"locked_at": datetime.now(timezone.utc)}, synchronize_session=False
+        )
+        db.commit()
+        return renewed == 1
+    finally:
+        db.close()
+
+
+def write_complete(db, job: AnalysisJob, payload: dict, save, refund: bool = False) -> bool:
+    # دالة كتابة لـ db_writer: التحقق من الحجز، حفظ التحليل، والتسوية في معاملة واحدة.
+    # False = الحجز لم يعد لنا (عامل آخر يملك المهمة الآن)، فلا حفظ ولا تسوية ولا إشعار.
+    # انهيار العامل قبل التثبيت لا يترك تحليلاً محفوظاً، فإعادة المهمة لا تكرره
+    claimed = _lease_filter(db.query(AnalysisJob), job).update({
+        "status": "done",
+        "error": None,
+        "finished_at": datetime.now(timezone.utc),
+    }, synchronize_session=False)
+    if claimed != 1:
+        return False
+    # save(db) -> رقم التحليل | يُكمل الحمولة قبل تخزينها مع المهمة
+    payload["analysis_id"] = analysis_id = save(db) if save else None
+    db.query(AnalysisJob).filter(AnalysisJob.id == job.id).update({
+        "result": json.dumps(payload, ensure_ascii=False),
+        "analysis_id": analysis_id,
+    }, synchronize_session=False)
+    if refund and job.credit_reserved:
+        credit_ledger.refund(db, job.user_id, f"job:{job.id}")
+    return True
+
+
+async def complete(job: AnalysisJob, payload: dict, save, refund: bool = False) -> bool:
+    if not await db_writer.run(write_complete, job, payload, save, refund):
+        return False
+    auth_cache.invalidate(job.user_id)
+    return True
+
+
+def write_fail(db, job: AnalysisJob, error: str):
+    # دالة كتابة لـ db_writer
+    # True = فشل نهائي (استُنفدت المحاولات وأُعيد الرصيد) | False = أُعيدت للطابور | None = الحجز ليس لنا
+    now = datetime.now(timezone.utc)
+    final = job.attempts >= JOB_MAX_ATTEMPTS
+    values = {"error": error[:1000], "locked_by": None}
+    if final:
+        values.update(status="failed", finished_at=now)
+    else:
+        values.update(status="queued", available_at=now + timedelta(seconds=JOB_RETRY_BACKOFF * (2 ** (job.attempts - 1))))
+    if _lease_filter(db.query(AnalysisJob), job).update(values, synchronize_session=False) != 1:
+        return None
+    if final and job.credit_reserved:
+        credit_ledger.refund(db, job.user_id, f"job:{job.id}")
+    return final
+
+
+async def fail(job: AnalysisJob, error: str):
+    final = await db_writer.run(write_fail, job, error)
+    if final:
+        auth_cache.invalidate(job.user_id)
+    return final
+
+
+def get_job(db, job_id: int, user_id: int):
+    return db.query(AnalysisJob).filter(AnalysisJob.id == job_id, AnalysisJob.user_id == user_id).first()
+
+
+def job_to_dict(job: AnalysisJob) -> dict:
+    out = {"job_id": job.id, "status": job.status, "attempts": job.attempts}
+    if job.status == "done" and job.result:
+        out.update(json.loads(job.result))
+        out["status"] = "success"
+        out["job_status"] = job.status
+    if job.status == "failed":
+        out["detail"] = job.error
+    return out
+
+
+# -----------------------------------------------------------------
+# 4. العمال الخلفيون (Background Workers)
+# -----------------------------------------------------------------
+
+def webhook_url_error(url: str):
+    # حماية من SSRF: الرابط من المستخدم، والعامل يرسل منه طلباً من داخل شبكتنا.
+    # يُرفض أي مضيف يحل (DNS) إلى عنوان غير عام: loopback، شبكات خاصة (RFC1918)،
+    # link-local (169.254.x = metadata السحابة)، multicast أو محجوز.
+    parts = urlsplit(url)
+    if parts.scheme != "https" or not parts.hostname:
+        return "رابط Webhook يجب أن يبدأ بـ https://"
+    if parts.username or parts.password:
+        return "رابط Webhook لا يقبل بيانات دخول"
+    host = parts.hostname.lower()
+    if JOB_WEBHOOK_ALLOWED_HOSTS and host not in JOB_WEBHOOK_ALLOWED_HOSTS:
+        return "مضيف Webhook غير مسموح"
+    try:
+        port = parts.port or 443
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)}
+    except (OSError, ValueError):
+        return "تعذر الوصول إلى مضيف Webhook"
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%", 1)[0])
+        if not ip.is_global or ip.is_multicast:
+            return "مضيف Webhook يشير إلى عنوان داخلي"
+    return None
+
+
+def _notify_webhook(job: AnalysisJob, body: dict):
+    # فحص ثانٍ وقت الإرسال: سجل DNS قد يتغير بعد قبول المهمة (DNS rebinding)
+    error = webhook_url_error(job.webhook_url)
+    if error:
+        print(f"Job Webhook Error: job {job.id} blocked ({error})")
+        return
+    try:
+        # بدون تحويل (redirect): وإلا يمكن لمضيف عام أن يحوّل الطلب إلى عنوان داخلي
+        requests.post(job.webhook_url, json=body, timeout=5, allow_redirects=False)
+    except Exception as e:
+        print(f"Job Webhook Error: {e}")
+
+
+async def _keep_lease(job: AnalysisJob):
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+        try:
+            if not await run_in_threadpool(heartbeat, job):
+                print(f"Job Queue Error: lost lease on job {job.id}")
+                return
+        except Exception as e:
+            print(f"Job Queue Error: {e}")
+
+
+async def _worker_loop(handler, cleanup):
+    while True:
+        try:
+            job = await run_in_threadpool(claim_next)
+        except Exception as e:
+            print(f"Job Queue Error: {e}")
+            job = None
+        if job is None:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+
+        keeper = asyncio.create_task(_keep_lease(job))
+        try:
+            payload, save, refund = await handler(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            final = await fail(job, str(e))
+            if final:
+                await cleanup(job)
+                if job.webhook_url:
+                    await run_in_threadpool(_notify_webhook, job, {"job_id": job.id, "status": "failed", "detail": str(e)})
+            continue
+        finally:
+            keeper.cancel()
+
+        if not await complete(job, payload, save, refund):
+            # عامل آخر التقط المهمة بعد انتهاء الحجز: هو من يسوّي ويشعر وينظف
+            continue
+        await cleanup(job)
+        if job.webhook_url:
+            await run_in_threadpool(_notify_webhook, job, {"job_id": job.id, **payload})
+
+
+async def _lease_reaper(cleanup):
+    while True:
+        try:
+            for job in await requeue_stale():
+                await cleanup(job)
+                if job.webhook_url:
+                    await run_in_threadpool(_notify_webhook, job, {"job_id": job.id, "status": "failed", "detail": job.error})
+        except Exception as e:
+            print(f"Job Queue Error: {e}")
+        await asyncio.sleep(max(JOB_LEASE_SECONDS / 4, 5))
+
+
+def start_workers(handler, cleanup):
+    # handler(job) -> (payload, save, refund): save(db) يحفظ التحليل داخل معاملة complete ويعيد رقمه
+    # await cleanup(job) بعد الانتهاء النهائي
+    if JOB_WORKER_CONCURRENCY <= 0:
+        return []
+    tasks = [asyncio.create_task(_worker_loop(handler, cleanup)) for _ in range(JOB_WORKER_CONCURRENCY)]
+    tasks.append(asyncio.create_task(_lease_reaper(cleanup)))
+    return tasks
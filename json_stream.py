@@ -0,0 +1,67 @@
+# =================================================================
+# 🧩 KAIA JSON STREAM – محلل JSON تدريجي لردود النموذج المتدفقة
+# =================================================================
+# يستقبل أجزاء النص كما تصل من النموذج، ويعيد كل مفتاح من المستوى الأعلى
+# (market_state, zones, institutional_evidence, scenarios ...) فور اكتمال قيمته.
+
+import json
+
+
+class IncrementalObjectParser:
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key_start = None
+        self._colon = None
+
+    def feed(self, text: str):
+        # يعيد قائمة (المفتاح, القيمة) للأعضاء التي اكتملت في هذا الجزء
+        self._buf += text
+        completed = []
+        buf = self._buf
+        i = self._pos
+        while i < len(buf):
+            ch = buf[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+                if self._depth == 1 and self._key_start is None:
+                    self._key_start = i
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                if self._depth == 1:
+                    self._close_member(i, completed)
+                self._depth -= 1
+            elif ch == ":" and self._depth == 1 and self._colon is None:
+                self._colon = i
+            elif ch == "," and self._depth == 1:
+                self._close_member(i, completed)
+            i += 1
+        self._pos = i
+        return completed
+
+    def _close_member(self, end: int, completed: list):
+        if self._key_start is not None and self._colon is not None:
+            try:
+                key = json.loads(self._buf[self._key_start:self._colon])
+                value = json.loads(self._buf[self._colon + 1:end])
+            except ValueError:
+                pass
+            else:
+                completed.append((key, value))
+        self._key_start = None
+        self._colon = None
+
+    @property
+    def text(self) -> str:
+        return self._buf
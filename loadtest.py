@@ -0,0 +1,295 @@
+# =================================================================
+# 🏋️ KAIA LOAD TEST – حمل متزامن على الواجهات الساخنة
+# =================================================================
+# N اتصال keep-alive متزامن (بدون مكتبات إضافية) يرسل طلبات متتالية لمدة ثابتة،
+# ثم يطبع عدد الطلبات في الثانية وزمن الاستجابة (p50 / p99) والأخطاء.
+# مقارنة المسار المتزامن بغير المتزامن: شغّل السيرفر من كل نسخة على نفس قاعدة البيانات ثم:
+#   uvicorn main:app --port 8000 &
+#   LOADTEST_TOKEN=<JWT> python loadtest.py http://127.0.0.1:8000 500 20
+# كاش المصادقة (auth_cache): نفس الأمر على /api/me فقط:
+#   LOADTEST_TOKEN=<JWT> LOADTEST_PATHS=/api/me python loadtest.py http://127.0.0.1:8000 50 20
+# أثر التحليلات الجارية على بقية الواجهات: خادم OpenAI وهمي محلي يرد بعد تأخير ثابت،
+# و LOADTEST_ANALYSES تحليلاً (رفع + تحليل لصورة فريدة، فلا كاش) تبقى جارية طوال القياس:
+#   python loadtest.py fake-openai 9100 2 &
+#   OPENAI_BASE_URL=http://127.0.0.1:9100/v1 OPENAI_API_KEY=fake uvicorn main:app --port 8000 &
+#   LOADTEST_TOKEN=<JWT> LOADTEST_PATHS=/api/me LOADTEST_ANALYSES=50 python loadtest.py http://127.0.0.1:8000 50 20
+
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+from urllib.parse import urlsplit
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+LOADTEST_TOKEN = os.getenv("LOADTEST_TOKEN", "")
+LOADTEST_PATHS = [p for p in os.getenv(
+    "LOADTEST_PATHS", "/api/history?limit=20,/api/articles?lang=ar,/api/sponsors?location=main"
+).split(",") if p]
+# مهلة فتح الاتصالات قبل بدء القياس (فتح 500 اتصال دفعة واحدة يشوّه الثواني الأولى)
+LOADTEST_CONNECT_TIMEOUT = float(os.getenv("LOADTEST_CONNECT_TIMEOUT", "30"))
+# عدد التحليلات الجارية في الخلفية أثناء القياس (يحتاج حساباً برصيد كافٍ أو Platinum)
+LOADTEST_ANALYSES = int(os.getenv("LOADTEST_ANALYSES", "0"))
+LOADTEST_ANALYSIS_TYPE = os.getenv("LOADTEST_ANALYSIS_TYPE", "SMC")
+# أبعاد صورة التحليل، و grain > 1 يكبّر الضجيج (لقطة جوال ~1170x2532 و grain 6 ≈ 3 ميغابايت PNG)
+LOADTEST_CHART_SIZE = tuple(int(v) for v in os.getenv("LOADTEST_CHART_SIZE", "320x200").split("x"))
+LOADTEST_CHART_GRAIN = int(os.getenv("LOADTEST_CHART_GRAIN", "1"))
+# زمن رد خادم OpenAI الوهمي (ثوانٍ) إن لم يُمرر في سطر الأوامر
+FAKE_OPENAI_DELAY = float(os.getenv("FAKE_OPENAI_DELAY", "2"))
+# سرعة الرفع نحو OpenAI بالميغابت/ثانية (0 = بلا حد): زمن نقل الصورة يُضاف للتأخير
+FAKE_OPENAI_MBPS = float(os.getenv("FAKE_OPENAI_MBPS", "0"))
+
+
+# -----------------------------------------------------------------
+# 2. عميل HTTP/1.1 بسيط (Keep-Alive Client)
+# -----------------------------------------------------------------
+
+async def _read_response(reader):
+    # يعيد (الحالة, الجسم)
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    status = int(status_line.split()[1])
+    length, chunked = 0, False
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        name = name.strip().lower()
+        if name == "content-length":
+            length = int(value)
+        elif name == "transfer-encoding" and "chunked" in value.lower():
+            chunked = True
+    body = b""
+    if chunked:
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            body += (await reader.readexactly(size + 2))[:-2]
+            if size == 0:
+                break
+    elif length:
+        body = await reader.readexactly(length)
+    return status, body
+
+
+async def _client(n: int, host: str, port: int, start, deadline_box: list, results: dict):
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError as e:
+        results["errors"][f"connect: {e}"] = results["errors"].get(f"connect: {e}", 0) + 1
+        return
+    auth = f"Authorization: Bearer {LOADTEST_TOKEN}\r\n" if LOADTEST_TOKEN else ""
+    await start.wait()
+    i = n
+    try:
+        while time.monotonic() < deadline_box[0]:
+            path = LOADTEST_PATHS[i % len(LOADTEST_PATHS)]
+            i += 1
+            started = time.perf_counter()
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n{auth}\r\n".encode("latin-1"))
+            status, _ = await _read_response(reader)
+            results["latencies"].append((time.perf_counter() - started) * 1000)
+            results["statuses"][status] = results["statuses"].get(status, 0) + 1
+    except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+        key = type(e).__name__
+        results["errors"][key] = results["errors"].get(key, 0) + 1
+    finally:
+        writer.close()
+
+
+# -----------------------------------------------------------------
+# 3. تحليلات جارية في الخلفية (Analyses In Flight)
+# -----------------------------------------------------------------
+
+def _unique_chart() -> bytes:
+    # ضجيج عشوائي: بصمة مختلفة في كل مرة، فلا كاش نتائج ولا دمج طلبات متطابقة
+    from PIL import Image
+    width, height = LOADTEST_CHART_SIZE
+    noise = (max(1, width // LOADTEST_CHART_GRAIN), max(1, height // LOADTEST_CHART_GRAIN))
+    img = Image.frombytes("RGB", noise, random.randbytes(noise[0] * noise[1] * 3)).resize((width, height), Image.BILINEAR)
+    buffer = io.BytesIO()
+    img.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def _multipart(fields: dict, files: dict = None):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8"))
+    for name, (filename, data) in (files or {}).items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: image/png\r\n\r\n".encode("utf-8") + data + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode("utf-8"))
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+async def _post(reader, writer, host: str, path: str, body: bytes, content_type: str):
+    auth = f"Authorization: Bearer {LOADTEST_TOKEN}\r\n" if LOADTEST_TOKEN else ""
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: {host}\r\n{auth}Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body
+    )
+    return await _read_response(reader)
+
+
+async def _analysis_client(host: str, port: int, deadline_box: list, results: dict):
+    # يبدأ فوراً (قبل القياس) حتى تكون التحليلات جارية فعلاً عند بدء العد
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError as e:
+        results["errors"][f"analysis connect: {e}"] = results["errors"].get(f"analysis connect: {e}", 0) + 1
+        return
+    try:
+        while time.monotonic() < deadline_box[0]:
+            body, content_type = _multipart({}, {"chart": ("chart.png", _unique_chart())})
+            started = time.perf_counter()
+            status, payload = await _post(reader, writer, host, "/api/upload-chart", body, content_type)
+            if status == 200:
+                fields = {"filename": json.loads(payload)["filename"], "timeframe": "H1", "analysis_type": LOADTEST_ANALYSIS_TYPE, "lang": "ar"}
+                status, _ = await _post(reader, writer, host, "/api/analyze-chart", *_multipart(fields))
+            results["analysis_latencies"].append((time.perf_counter() - started) * 1000)
+            key = f"analysis {status}"
+            results["statuses"][key] = results["statuses"].get(key, 0) + 1
+    except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+        key = f"analysis {type(e).__name__}"
+        results["errors"][key] = results["errors"].get(key, 0) + 1
+    finally:
+        writer.close()
+
+
+async def run(base_url: str, connections: int, seconds: float, analyses: int = LOADTEST_ANALYSES) -> dict:
+    parts = urlsplit(base_url)
+    host, port = parts.hostname, parts.port or 80
+    results = {"latencies": [], "analysis_latencies": [], "statuses": {}, "errors": {}}
+    start = asyncio.Event()
+    deadline_box = [float("inf")]
+    background = [asyncio.create_task(_analysis_client(host, port, deadline_box, results)) for _ in range(analyses)]
+    tasks = [asyncio.create_task(_client(n, host, port, start, deadline_box, results)) for n in range(connections)]
+    # كل الاتصالات تُفتح أولاً ثم يبدأ القياس معاً
+    await asyncio.sleep(min(LOADTEST_CONNECT_TIMEOUT, 1 + connections / 250 + (2 if analyses else 0)))
+    began = time.monotonic()
+    deadline_box[0] = began + seconds
+    start.set()
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - began
+    # التحليلات العالقة لا تدخل في مدة القياس
+    await asyncio.gather(*background)
+
+    latencies = sorted(results["latencies"])
+    pick = lambda p: round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 1) if latencies else 0.0
+    analysis_latencies = sorted(results["analysis_latencies"])
+    return {
+        "connections": connections,
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": pick(0.50),
+        "p99_ms": pick(0.99),
+        "max_ms": round(latencies[-1], 1) if latencies else 0.0,
+        "analyses": analyses,
+        "analyses_done": len(analysis_latencies),
+        "analysis_p50_ms": round(analysis_latencies[len(analysis_latencies) // 2], 1) if analysis_latencies else 0.0,
+        "statuses": results["statuses"],
+        "errors": results["errors"],
+    }
+
+
+# -----------------------------------------------------------------
+# 4. خادم OpenAI وهمي (Fake Upstream)
+# -----------------------------------------------------------------
+# يرد على POST /v1/chat/completions بعد تأخير ثابت بنتيجة تحليل صالحة (بدون بث)،
+# ويعد الطلبات والبايتات المستلمة: GET /stats يعيدها (حجم الصورة المرسلة فعلياً للنموذج).
+# FAKE_OPENAI_MBPS يحاكي سرعة رابط الرفع: على localhost لا يظهر فرق حجم الإرسال في الزمن.
+
+FAKE_STATS = {"requests": 0, "bytes": 0, "in_flight": 0, "max_in_flight": 0}
+FAKE_RESULT = {
+    "market": "EURUSD", "timeframe": "H1", "market_bias": "شراء",
+    "market_state": {"directional_bias": "صاعد", "notes": "📊 اتجاه السوق: صاعد"},
+    "analysis_text": "load test", "confidence_score": 60,
+}
+
+
+def _fake_completion() -> bytes:
+    return json.dumps({
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "object": "chat.completion", "created": int(time.time()),
+        "model": "gpt-4o-mini",
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": json.dumps(FAKE_RESULT, ensure_ascii=False)}}],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }).encode("utf-8")
+
+
+async def _fake_openai_conn(reader, writer, delay: float):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, path = request_line.decode("latin-1").split()[:2]
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value)
+            body = await reader.readexactly(length) if length else b""
+
+            if method == "GET" and path == "/stats":
+                payload = json.dumps(FAKE_STATS).encode("utf-8")
+            else:
+                FAKE_STATS["requests"] += 1
+                FAKE_STATS["bytes"] += len(body)
+                FAKE_STATS["in_flight"] += 1
+                FAKE_STATS["max_in_flight"] = max(FAKE_STATS["max_in_flight"], FAKE_STATS["in_flight"])
+                try:
+                    transfer = len(body) * 8 / (FAKE_OPENAI_MBPS * 1_000_000) if FAKE_OPENAI_MBPS > 0 else 0
+                    await asyncio.sleep(delay + transfer)
+                finally:
+                    FAKE_STATS["in_flight"] -= 1
+                payload = _fake_completion()
+            writer.write(
+                f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n".encode("latin-1")
+                + payload
+            )
+            await writer.drain()
+    except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def fake_openai(port: int, delay: float):
+    server = await asyncio.start_server(lambda r, w: _fake_openai_conn(r, w, delay), "127.0.0.1", port)
+    link = f", uplink {FAKE_OPENAI_MBPS} Mbit/s" if FAKE_OPENAI_MBPS > 0 else ""
+    print(f"🤖 Fake OpenAI on http://127.0.0.1:{port}/v1 (reply after {delay}s{link})")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "fake-openai":
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 9100
+        delay = float(sys.argv[3]) if len(sys.argv) > 3 else FAKE_OPENAI_DELAY
+        asyncio.run(fake_openai(port, delay))
+        sys.exit(0)
+
+    url = sys.argv[1] if len(sys.argv) > 1 else "http://127.0.0.1:8000"
+    connections = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+    report = asyncio.run(run(url, connections, seconds))
+    print(f"📊 {url} | {connections} connections x {seconds:.0f}s | {', '.join(LOADTEST_PATHS)}")
+    print(f"   {report['rps']} req/s | p50 {report['p50_ms']} ms | p99 {report['p99_ms']} ms | max {report['max_ms']} ms")
+    if report["analyses"]:
+        print(f"   {report['analyses']} analyses in flight | {report['analyses_done']} done | p50 {report['analysis_p50_ms']} ms")
+    print(f"   statuses {report['statuses']} | errors {report['errors'] or 0}")
@@ -1,10 +1,11 @@
 from database import SessionLocal, User
+import credit_ledger
 db = SessionLocal()
 email = input("اكتب إيميلك اللي سجلت فيه: ")
 user = db.query(User).filter(User.email == email).first()
 if user:
     user.is_admin = True
-    user.credits = 1000
+    credit_ledger.set_balance(db, user.id, 1000)
     db.commit()
     print("✅ مبروك! أصبحت مديراً للنظام (Admin).")
 else:
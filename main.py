@@ -3,21 +3,23 @@
 # 🛡️ VERSION: 2025.12.31 - KAIA MASTER PLATINUM VISION (STEP 1)
 # =================================================================
 
-from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException, Request
+from fastapi import FastAPI, Form, Depends, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from sqlalchemy import func, or_, select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from passlib.context import CryptContext
 from jose import jwt
 from datetime import datetime, timedelta, timezone
-import shutil
 import os
-import base64
+import time
+import asyncio
+from contextlib import aclosing, asynccontextmanager
 import json
-import requests
-import uuid
 import re
 # دالة تطهير النصوص: تحذف أي كود HTML أو تنسيقات خارجية لمنع تشوه الموقع
 def clean_html_content(text: str):
@@ -72,8 +74,6 @@ def normalize_kaia_output(result: dict, timeframe: str):
                 out["zones"][key] = []
             
     return out
-from bs4 import BeautifulSoup
-from openai import OpenAI
 from dotenv import load_dotenv
 
 # -----------------------------------------------------------------
@@ -82,8 +82,30 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-from database import SessionLocal, User, Analysis, Article, Sponsor
+from database import SessionLocal, run_read, User, Analysis, Article, Sponsor, NewsFeed, NewsKeyword, pool_stats
 import schemas
+import ai_gateway
+from ai_gateway import create_chat_completion
+import analysis_cache
+import article_images
+import chart_fingerprint
+import chart_storage
+import credit_ledger
+import db_writer
+import image_pipeline
+import json_stream
+import migrations
+import news_aggregator
+import response_cache
+import static_assets
+import storage_manager
+import jobs
+import single_flight
+import auth_cache
+
+# هجرات البنية المرقمة: فحص سريع لرقم الإصدار، والتنفيذ فقط عند وجود خطوات جديدة
+if migrations.MIGRATE_ON_STARTUP:
+    migrations.run()
 
 # -----------------------------------------------------------------
 # 2. إعدادات الحماية والذكاء الاصطناعي (Security & AI)
@@ -95,9 +117,24 @@ ALGORITHM = "HS256"
 pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/login")
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-app = FastAPI(title="KAIA AI – Institutional Analyst Engine")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # تشغيل عمال طابور التحليل في كل عامل gunicorn (JOB_WORKER_CONCURRENCY=0 للتعطيل)
+    background_tasks = jobs.start_workers(process_analysis_job, cleanup_analysis_job)
+    # محدّث شريط الأخبار الخلفي (عامل واحد يجلب المصادر في كل دورة)
+    background_tasks.append(news_aggregator.start_refresher())
+    # تنظيف الملفات اليتيمة وتطبيق حصة القرص (عامل واحد في كل دورة)
+    background_tasks.append(storage_manager.start_gc())
+    # توليد نسخ صور المقالات (srcset) في الخلفية
+    background_tasks.extend(article_images.start_workers())
+    # تجميع دفتر الرصيد دورياً والتحقق من تطابقه مع users.credits
+    background_tasks.append(credit_ledger.start_reconciler())
+    yield
+    for task in background_tasks:
+        task.cancel()
+
+
+app = FastAPI(title="KAIA AI – Institutional Analyst Engine", lifespan=lifespan)
 
 # -----------------------------------------------------------------
 # 3. إعداد مخزن الصور الدائم (Render Disk Persistent Storage)
@@ -123,8 +160,13 @@ app.add_middleware(
 
 app.mount("/images", StaticFiles(directory=STORAGE_PATH), name="images")
 
-if os.path.exists("frontend"):
-    app.mount("/static", StaticFiles(directory="frontend"), name="static")
+# ملفات الواجهة: أسماء مبصومة + نسخ gzip/brotli مبنية مسبقاً (انظر static_assets)
+static_assets.build()
+
+
+@app.get("/static/{path:path}")
+def static_file(path: str, request: Request):
+    return static_assets.serve(request, path)
 
 
 # -----------------------------------------------------------------
@@ -146,14 +188,46 @@ def create_access_token(data: dict):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def sse_event(payload: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def decode_token_email(token: str):
+    # التوكن الموثق سابقاً لا يُعاد فك توقيعه حتى انتهاء صلاحيته
+    email = auth_cache.get_token(token)
+    if email is not None:
+        return email
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    email = payload.get("sub")
+    if email:
+        email = email.lower().strip()
+    auth_cache.put_token(token, email, payload.get("exp"))
+    return email
+
+
+def _user_by_email(db: Session, email: str):
+    return db.execute(select(User).where(User.email == email)).scalars().first()
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    # جلسة قصيرة (run_read): الاتصال يعود للمجمع فور القراءة ولا يُحجز طوال الطلب
+    # الكائن يبقى مقروءاً بعد إغلاق الجلسة؛ التعديل يتم عبر جلسة المسار نفسها
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        if email:
-            email = email.lower().strip()
-        
-        user = db.query(User).filter(User.email == email).first()
+        email = decode_token_email(token)
+        user = await run_read(_user_by_email, email)
+        if not user:
+            raise HTTPException(status_code=401, detail="عذراً، المستخدم غير موجود")
+        return user
+    except Exception:
+        raise HTTPException(status_code=401, detail="انتهت الجلسة، يرجى تسجيل الدخول مجدداً")
+
+
+def get_current_user_cached(token: str = Depends(oauth2_scheme)):
+    # للمسارات القراءة فقط (/api/me، السجل، الدردشة): لقطة مخزنة بدون جلسة قاعدة بيانات
+    try:
+        email = decode_token_email(token)
+        user = auth_cache.get_user(email)
         if not user:
             raise HTTPException(status_code=401, detail="عذراً، المستخدم غير موجود")
         return user
@@ -165,82 +239,99 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
 # 6. محرك الأخبار المؤسسي السريع (Institutional News Engine)
 # -----------------------------------------------------------------
 
-NEWS_CACHE = {
-    "ar": {
-        "data": "KAIA AI: نراقب تحركات السيولة والسياسة النقدية الحالية",
-        "timestamp": None
-    },
-    "en": {
-        "data": "KAIA AI: Monitoring current liquidity and monetary policy",
-        "timestamp": None
-    }
-}
-
 @app.get("/api/news")
-def get_news(lang: str = "ar", db: Session = Depends(get_db)):
-    # النظام يعمل فقط للنسخة العربية حالياً بناءً على طلب المدير
-    if lang != "ar":
-        return {"news": "KAIA AI: Monitoring global markets..."}
-
-    global NEWS_CACHE
-    now = datetime.now()
-    cache_entry = NEWS_CACHE["ar"]
-    
-    # تحديث الكاش كل 10 دقائق لضمان السرعة وعدم الضغط على المصادر
-    if cache_entry["timestamp"] and (now - cache_entry["timestamp"]).seconds < 600:
-        return {"news": cache_entry["data"]}
+def get_news(request: Request, lang: str = "ar"):
+    # القراءة من المخزن المشترك فوراً؛ التحديث يتم في الخلفية (news_aggregator)
+    # اللغات المسجلة في news_feed_registry / news_keywords (وليس القائمة الافتراضية فقط)
+    lang = lang if news_aggregator.is_served(lang) else "en"
+    ticker = news_aggregator.get_ticker(lang)
+    # نسخة الأخبار = النص نفسه: الـ ETag يتغير فقط عند نشر شريط جديد
+    return response_cache.cached_json(
+        request, "news", {"lang": lang}, lambda: {"news": ticker}, version=ticker, max_age=30
+    )
 
-    try:
-        final_ticker_items = []
-
-        # 1. جلب آخر 3 مقالات من تقاريرك الخاصة أولاً
-        my_articles = db.query(Article).filter(Article.language == "ar").order_by(Article.id.desc()).limit(3).all()
-        for art in my_articles:
-            final_ticker_items.append(f"🔥 من تقارير المحلل: {art.title}")
-
-        # 2. الكلمات المفتاحية الاستراتيجية المحددة من قبل المدير
-        keywords = [
-            "بطالة", "تضخم", "تداول", "بورصة", "بنك", "أسعار", "اتفاقيات", 
-            "تجارة", "رجال أعمال", "رجل أعمال", "هبوط", "ارتفاع", "مؤشرات", 
-            "صناديق استثمارية", "سيولة", "الفيدرالي", "الذهب", "النفط"
-        ]
-
-        # 3. مصادر الأخبار الكبرى (سكاي نيوز الاقتصادية و Investing)
-        rss_sources = [
-            "https://www.skynewsarabia.com/web/rss/business.xml", # سكاي نيوز اقتصاد
-            "https://sa.investing.com/rss/news_1.rss"             # انفستنج أخبار عامة
-        ]
-            
-        headers = {"User-Agent": "Mozilla/5.0"}
-        
-        for url in rss_sources:
-            try:
-                response = requests.get(url, timeout=5, headers=headers)
-                if response.status_code == 200:
-                    soup = BeautifulSoup(response.content, "xml")
-                    items = soup.find_all("item")
-                    for i in items[:15]:
-                        title = i.title.text.strip()
-                        # فلترة الخبر بناءً على الكلمات المفتاحية
-                        if any(key in title for key in keywords):
-                            clean_t = title.replace("'", "").replace('"', "")
-                            # تمييز العاجل
-                            if "عاجل" in clean_t:
-                                clean_t = f"🚨 [عاجل] {clean_t.replace('عاجل', '').strip()}"
-                            final_ticker_items.append(clean_t)
-            except: continue
-
-        if final_ticker_items:
-            # دمج الأخبار بفاصل النجمة الفخمة
-            final_text = " ★ ".join(final_ticker_items)
-            NEWS_CACHE["ar"]["data"] = final_text
-            NEWS_CACHE["ar"]["timestamp"] = now
-            return {"news": final_text}
-            
-    except Exception as e:
-        print(f"News Engine Error: {e}")
-            
-    return {"news": NEWS_CACHE["ar"]["data"]}
+
+@app.get("/api/admin/news/feeds")
+def admin_list_news_feeds(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="غير مسموح")
+    feeds = db.query(NewsFeed).order_by(NewsFeed.language, NewsFeed.id).all()
+    return [
+        {"id": f.id, "url": f.url, "name": f.name, "language": f.language, "enabled": f.enabled}
+        for f in feeds
+    ]
+
+
+@app.post("/api/admin/news/feeds")
+def admin_add_news_feed(data: dict, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="غير مسموح")
+
+    url = (data.get("url") or "").strip()
+    if not url.startswith(("http://", "https://")):
+        raise HTTPException(status_code=400, detail="رابط المصدر غير صالح")
+    if db.query(NewsFeed.id).filter(NewsFeed.url == url).first():
+        raise HTTPException(status_code=400, detail="المصدر مسجل مسبقاً")
+
+    lang = data.get("language", "ar")
+    db.add(NewsFeed(url=url, name=data.get("name", ""), language=lang, enabled=data.get("enabled", True)))
+    db.commit()
+    news_aggregator.mark_stale(lang)
+    return {"status": "success"}
+
+
+@app.put("/api/admin/news/feeds/{feed_id}")
+def admin_update_news_feed(feed_id: int, data: dict, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="غير مسموح")
+
+    feed = db.query(NewsFeed).filter(NewsFeed.id == feed_id).first()
+    if not feed:
+        raise HTTPException(status_code=404, detail="المصدر غير موجود")
+    old_lang = feed.language
+    for field in ("name", "language", "enabled"):
+        if field in data:
+            setattr(feed, field, data[field])
+    db.commit()
+    news_aggregator.mark_stale(old_lang)
+    news_aggregator.mark_stale(feed.language)
+    return {"status": "success"}
+
+
+@app.delete("/api/admin/news/feeds/{feed_id}")
+def admin_delete_news_feed(feed_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="غير مسموح")
+
+    feed = db.query(NewsFeed).filter(NewsFeed.id == feed_id).first()
+    if feed:
+        db.delete(feed)
+        db.commit()
+        news_aggregator.mark_stale(feed.language)
+    return {"status": "success"}
+
+
+@app.get("/api/admin/news/keywords")
+def admin_get_news_keywords(lang: str = "ar", current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="غير مسموح")
+    keywords = db.query(NewsKeyword.keyword).filter(NewsKeyword.language == lang).order_by(NewsKeyword.id).all()
+    return {"language": lang, "keywords": [k for (k,) in keywords]}
+
+
+@app.put("/api/admin/news/keywords")
+def admin_set_news_keywords(data: dict, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="غير مسموح")
+
+    # استبدال مجموعة كلمات اللغة بالكامل (بدون تكرار أو فراغات)
+    lang = data.get("language", "ar")
+    keywords = list(dict.fromkeys(k.strip() for k in data.get("keywords", []) if k and k.strip()))
+    db.query(NewsKeyword).filter(NewsKeyword.language == lang).delete(synchronize_session=False)
+    db.add_all([NewsKeyword(language=lang, keyword=k) for k in keywords])
+    db.commit()
+    news_aggregator.mark_stale(lang)
+    return {"status": "success", "count": len(keywords)}
 
 
 # -----------------------------------------------------------------
@@ -248,19 +339,36 @@ def get_news(lang: str = "ar", db: Session = Depends(get_db)):
 # -----------------------------------------------------------------
 
 @app.get("/api/articles")
-def get_articles(lang: str = "ar", db: Session = Depends(get_db)):
-    return db.query(Article).filter(Article.language == lang).order_by(Article.id.desc()).limit(6).all()
+async def get_articles(request: Request, lang: str = "ar"):
+    # الاستعلام ينفذ فقط عند تغير نسخة المقالات (انظر response_cache)
+    async def load():
+        stmt = select(Article).where(Article.language == lang).order_by(Article.id.desc()).limit(6)
+        return await run_read(lambda db: db.execute(stmt).scalars().all())
+
+    return await response_cache.cached_json_async(request, "articles", {"lang": lang}, load)
 
 
 @app.get("/api/sponsors")
-def get_sponsors(location: str = "main", db: Session = Depends(get_db)):
-    return db.query(Sponsor).filter(Sponsor.location == location, Sponsor.is_active == True).all()
+async def get_sponsors(request: Request, location: str = "main"):
+    async def load():
+        stmt = select(Sponsor).where(Sponsor.location == location, Sponsor.is_active == True)
+        return await run_read(lambda db: db.execute(stmt).scalars().all())
+
+    return await response_cache.cached_json_async(request, "sponsors", {"location": location}, load)
 
 
 # -----------------------------------------------------------------
 # 8. نظام التسجيل والحماية الذكي (Auth & IP Tracking) - النسخة المحدثة
 # -----------------------------------------------------------------
 
+def insert_user(db: Session, new_user: User, credits: int) -> int:
+    db.add(new_user)
+    db.flush()
+    # الرصيد الأولي يمر عبر الدفتر مثل أي حركة أخرى
+    credit_ledger.grant(db, new_user.id, credits, "signup")
+    return new_user.id
+
+
 @app.post("/api/register", response_model=schemas.UserOut)
 def register(user: schemas.UserCreate, request: Request, db: Session = Depends(get_db)):
     clean_email = user.email.lower().strip()
@@ -286,7 +394,7 @@ def register(user: schemas.UserCreate, request: Request, db: Session = Depends(g
         whatsapp=user.whatsapp,
         country=user.country,
         tier=user.tier,
-        credits=credits_map.get(user.tier, 3),
+        credits=0,
         status="Active",
         is_verified=False,
         registration_ip=client_ip,
@@ -295,11 +403,13 @@ def register(user: schemas.UserCreate, request: Request, db: Session = Depends(g
         is_whale=(user.tier == "Platinum")
     )
     
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-    
-    return new_user
+    try:
+        user_id = db_writer.submit(insert_user, new_user, credits_map.get(user.tier, 3))
+    except IntegrityError:
+        # تسجيل متزامن بنفس البريد سبق هذا الطلب
+        raise HTTPException(status_code=400, detail="البريد الإلكتروني مسجل لدينا بالفعل")
+
+    return db.get(User, user_id)
 
 
 @app.post("/api/login")
@@ -314,7 +424,7 @@ def login(form: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get
 
 
 @app.get("/api/me", response_model=schemas.UserOut)
-def me(current_user: User = Depends(get_current_user)):
+def me(current_user: User = Depends(get_current_user_cached)):
     return current_user
 
 
@@ -322,11 +432,121 @@ def me(current_user: User = Depends(get_current_user)):
 # 9. لوحة التحكم والاشتراكات (Admin Command Center)
 # -----------------------------------------------------------------
 
+# أعمدة جدول الإدارة فقط (بدون password_hash)
+ADMIN_USER_COLUMNS = [
+    User.id, User.email, User.full_name, User.phone, User.whatsapp, User.country,
+    User.tier, User.status, User.credits, User.is_verified, User.is_flagged, User.registration_ip,
+    User.subscription_start, User.subscription_end, User.is_admin, User.is_premium, User.is_whale,
+    User.subscription_fee, User.payment_status, User.total_used_analyzes, User.last_active,
+]
+ADMIN_USER_SORTS = {
+    "id": User.id,
+    "email": User.email,
+    "full_name": User.full_name,
+    "credits": User.credits,
+    "subscription_end": User.subscription_end,
+    "subscription_fee": User.subscription_fee,
+    "total_used_analyzes": User.total_used_analyzes,
+    "last_active": User.last_active,
+}
+
+
 @app.get("/api/admin/users")
-def admin_get_users(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def admin_get_users(
+    page: int = 1,
+    page_size: int = 50,
+    q: str = None,
+    tier: str = None,
+    payment_status: str = None,
+    flagged: bool = None,
+    expires_within_days: int = None,
+    expired: bool = None,
+    sort: str = "id",
+    order: str = "desc",
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="صلاحيات غير كافية")
-    return db.query(User).all()
+
+    page = max(1, page)
+    page_size = max(1, min(page_size, 200))
+    now_utc = datetime.now(timezone.utc)
+
+    query = db.query(*ADMIN_USER_COLUMNS)
+    if q:
+        pattern = f"%{q.strip()}%"
+        query = query.filter(or_(User.email.ilike(pattern), User.full_name.ilike(pattern), User.phone.ilike(pattern)))
+    if tier:
+        query = query.filter(User.tier == tier)
+    if payment_status:
+        query = query.filter(User.payment_status == payment_status)
+    if flagged is not None:
+        query = query.filter(User.is_flagged == flagged)
+    if expires_within_days is not None:
+        query = query.filter(User.subscription_end >= now_utc, User.subscription_end <= now_utc + timedelta(days=expires_within_days))
+    if expired is not None:
+        query = query.filter(User.subscription_end < now_utc if expired else or_(User.subscription_end >= now_utc, User.subscription_end.is_(None)))
+
+    total = query.order_by(None).count()
+    sort_col = ADMIN_USER_SORTS.get(sort, User.id)
+    ordering = sort_col.asc() if order == "asc" else sort_col.desc()
+    rows = query.order_by(ordering, User.id.desc()).offset((page - 1) * page_size).limit(page_size).all()
+    return {"items": [dict(row._mapping) for row in rows], "total": total, "page": page, "page_size": page_size}
+
+
+@app.get("/api/admin/users/summary")
+def admin_users_summary(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="صلاحيات غير كافية")
+
+    # كل الأرقام محسوبة في قاعدة البيانات (GROUP BY) بدل تحميل كل المستخدمين للمتصفح
+    now_utc = datetime.now(timezone.utc)
+    by_tier = dict(db.query(User.tier, func.count(User.id)).group_by(User.tier).all())
+    revenue = {
+        status: float(total or 0)
+        for status, total in db.query(User.payment_status, func.sum(User.subscription_fee)).group_by(User.payment_status).all()
+    }
+    active_24h = db.query(func.count(User.id)).filter(User.last_active >= now_utc - timedelta(hours=24)).scalar()
+    online = db.query(func.count(User.id)).filter(User.last_active >= now_utc - timedelta(minutes=5)).scalar()
+
+    return {
+        "total_users": sum(by_tier.values()),
+        "by_tier": by_tier,
+        "revenue_paid": revenue.get("Paid", 0.0),
+        "revenue_unpaid": sum(v for k, v in revenue.items() if k != "Paid"),
+        "active_24h": active_24h,
+        "online": online,
+    }
+
+
+@app.get("/api/admin/storage")
+def admin_storage_stats(current_user: User = Depends(get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="صلاحيات غير كافية")
+    # استهلاك القرص حسب نوع الملف + نتيجة آخر دورة تنظيف
+    return storage_manager.stats()
+
+
+@app.get("/api/admin/db-pool")
+def admin_db_pool_stats(current_user: User = Depends(get_current_user_cached)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="صلاحيات غير كافية")
+    # مجمع اتصالات هذا العامل: المحجوز، الزائد (overflow)، وزمن انتظار الاتصال
+    return pool_stats()
+
+
+@app.get("/api/admin/users/{user_id}/credits")
+def admin_user_credits(user_id: int, limit: int = 50, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="صلاحيات غير كافية")
+    # حركات دفتر الرصيد (حجز / إرجاع / تعديل يدوي) للتدقيق في شكاوى الرصيد
+    balance = db.query(User.credits).filter(User.id == user_id).scalar()
+    return {
+        "credits": balance,
+        "entries": credit_ledger.entries(db, user_id, max(1, min(limit, 500))),
+        "stats": credit_ledger.STATS,
+    }
 
 
 @app.post("/api/admin/update_user")
@@ -345,10 +565,11 @@ def admin_update_user(data: dict, current_user: User = Depends(get_current_user)
     new_tier = data.get("tier", user.tier)
     if new_tier != user.tier:
         user.tier = new_tier
-        user.credits = credits_map.get(new_tier, user.credits)
-    else:
+        if new_tier in credits_map:
+            credit_ledger.set_balance(db, user.id, credits_map[new_tier])
+    elif data.get("credits") is not None:
         # إذا لم تتغير الباقة، اسمح بتعديل الرصيد يدوياً كما هو
-        user.credits = data.get("credits", user.credits)
+        credit_ledger.set_balance(db, user.id, int(data["credits"]))
 
     user.is_premium = (user.tier != "Trial")
     user.is_whale = (user.tier == "Platinum")
@@ -379,6 +600,7 @@ def admin_update_user(data: dict, current_user: User = Depends(get_current_user)
         user.is_flagged = data["is_flagged"]
     
     db.commit()
+    auth_cache.invalidate(user.id)
     return {"status": "success"}
 
 
@@ -390,11 +612,27 @@ def admin_delete_user(user_id: int, current_user: User = Depends(get_current_use
     user = db.query(User).filter(User.id == user_id).first()
     if user:
         db.query(Analysis).filter(Analysis.user_id == user_id).delete()
+        credit_ledger.forget_user(db, user_id)
         db.delete(user)
         db.commit()
+        auth_cache.invalidate(user_id)
     return {"status": "success"}
 
 
+@app.get("/api/admin/analysis-cache")
+def admin_analysis_cache_stats(current_user: User = Depends(get_current_user_cached)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="صلاحيات غير كافية")
+    return dict(analysis_cache.stats(), single_flight=single_flight.stats())
+
+
+@app.get("/api/admin/ai-metrics")
+def admin_ai_metrics(current_user: User = Depends(get_current_user_cached)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="صلاحيات غير كافية")
+    return ai_gateway.metrics_summary()
+
+
 # -----------------------------------------------------------------
 # 10. غرفة التحرير المؤسسية (Editorial Room)
 # -----------------------------------------------------------------
@@ -410,6 +648,7 @@ def admin_add_article(data: dict, current_user: User = Depends(get_current_user)
         summary=clean_html_content(data.get("summary")), 
         content=clean_html_content(data.get("content")), 
         image_url=data.get("image_url"), 
+        image_variants=article_images.variants_for_url(data.get("image_url")),
         language=data.get("language", "ar")
     )
     db.add(new_art)
@@ -434,6 +673,7 @@ def admin_update_article(art_id: int, data: dict, current_user: User = Depends(g
         "summary": clean_html_content(data.get("summary")), 
         "content": clean_html_content(data.get("content")), 
         "image_url": data.get("image_url"), 
+        "image_variants": article_images.variants_for_url(data.get("image_url")),
         "language": data.get("language")
     })
     db.commit()
@@ -451,16 +691,29 @@ def admin_delete_article(art_id: int, current_user: User = Depends(get_current_u
 
 
 @app.post("/api/admin/upload-article-image")
-async def upload_article_image(image: UploadFile = File(...), current_user: User = Depends(get_current_user)):
+async def upload_article_image(request: Request, current_user: User = Depends(get_current_user)):
     if not current_user.is_admin: 
         raise HTTPException(status_code=403)
-    
-    file_name = f"art_{uuid.uuid4()}.png"
-    final_save_path = os.path.join(STORAGE_PATH, file_name) 
-    
-    with open(final_save_path, "wb") as buffer:
-        shutil.copyfileobj(image.file, buffer)
-        
+
+    # نفس الاستقبال المتدفق للشارت: حد الحجم + فحص التوقيع قبل الحفظ
+    try:
+        upload = await chart_storage.receive_upload(request, "image")
+    except chart_storage.UploadTooLarge:
+        raise HTTPException(status_code=413, detail="حجم الصورة أكبر من المسموح")
+    except image_pipeline.InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        file_name = await run_in_threadpool(article_images.save_upload, upload)
+    except image_pipeline.InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        upload.discard()
+
+    # تُحذف تلقائياً بعد مهلة إذا لم يُحفظ مقال يشير إليها
+    await run_in_threadpool(storage_manager.register, file_name, "article")
+    # النسخ المصغرة تُولد في الخلفية وتُربط بالمقال عند جاهزيتها
+    article_images.schedule(file_name)
     return {"image_url": f"/images/{file_name}"}
 
 
@@ -468,33 +721,12 @@ async def upload_article_image(image: UploadFile = File(...), current_user: User
 # 11. محرك التحليل الذكي المطور (KAIA AI Engine - Tiered Logic)
 # -----------------------------------------------------------------
 
-@app.post("/api/analyze-chart")
-async def analyze_chart(
-    filename: str = Form(...),
-    timeframe: str = Form(...),
-    analysis_type: str = Form(...),
-    lang: str = Form("ar"),
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
-):
-    if current_user.credits <= 0 and not current_user.is_whale:
-        raise HTTPException(status_code=400, detail="الرصيد غير كافٍ، يرجى الترقية")
-
-    if analysis_type == "KAIA Master" and current_user.tier != "Platinum":
-        msg = "عذراً، استراتيجية KAIA Master Vision مخصصة حصرياً لمشتركي الباقة البلاتينية." if lang == "ar" else "Sorry, KAIA Master is for Platinum members."
-        return {"status": "upgrade_required", "detail": msg}
-
-    img_path = os.path.join(STORAGE_PATH, filename)
-    if not os.path.exists(img_path):
-        raise HTTPException(status_code=404, detail="الصورة غير موجودة")
-
-    try:
-        with open(img_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode()
+def build_vision_request(image_bytes: bytes, image_meta: dict, timeframe: str, analysis_type: str, lang: str):
+    image_part = image_pipeline.build_image_part(image_bytes, image_meta)
 
- # --- البرومبت المخصص لكشف الحيتان (SMC Whale Hunter) ---
-        if analysis_type == "KAIA Master":
-            system_prompt = f"""
+    # --- البرومبت المخصص لكشف الحيتان (SMC Whale Hunter) ---
+    if analysis_type == "KAIA Master":
+        system_prompt = f"""
 أنت "KAIA Pro" — محلل مالي يدمج بين صياغة تقارير شركات الوساطة الرسمية وبين عمق تحليل المال الذكي (SMC).
 
 مهمتك:
@@ -533,103 +765,381 @@ async def analyze_chart(
    - حدد بدقة المناطق التي قد يستهدفها صناع السوق لضرب الستوبات (Liquidity Sweeps).
 
 صيغة الإخراج JSON فقط:
-(market, timeframe, market_state, institutional_evidence, key_levels, stop_hunt_risk_zones, scenarios, confidence_score)
+(market_state, market, timeframe, institutional_evidence, key_levels, stop_hunt_risk_zones, scenarios, confidence_score)
 """
 
-        else:
-            system_prompt = f"أنت خبير تحليل فني. حلل الشارت بأسلوب {analysis_type} باللغة ({lang}). أعد JSON حصراً بمفاتيح: (market_bias, analysis_text, market, timeframe)."
+    else:
+        system_prompt = f"أنت خبير تحليل فني. حلل الشارت بأسلوب {analysis_type} باللغة ({lang}). أعد JSON حصراً بمفاتيح: (market_bias, analysis_text, market, timeframe)."
+
+    return dict(
+        model="gpt-4o-mini",
+        messages=[{"role": "system", "content": system_prompt},
+                  {"role": "user", "content": [{"type": "text", "text": f"Analyze this {analysis_type} chart on {timeframe}"},
+                                             image_part] } ],
+        response_format={"type": "json_object"},
+        temperature=0.3
+    )
 
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "system", "content": system_prompt},
-                      {"role": "user", "content": [{"type": "text", "text": f"Analyze this {analysis_type} chart on {timeframe}"},
-                                                 {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{encoded_string}"}}] } ],
-            response_format={"type": "json_object"},
-            temperature=0.3
+
+async def run_vision_analysis(image_bytes: bytes, image_meta: dict, timeframe: str, analysis_type: str, lang: str):
+    response = await create_chat_completion(**build_vision_request(image_bytes, image_meta, timeframe, analysis_type, lang))
+
+    # 1. تحويل الرد إلى JSON وتمريره عبر "فلتر التثبيت" لضمان القاموس السيادي
+    raw_result = json.loads(response.choices[0].message.content)
+    return normalize_kaia_output(raw_result, timeframe)
+
+
+def write_analysis(db: Session, user_id: int, result: dict, timeframe: str, settle_ref: str = None) -> int:
+    # 2. تحضير "الخلاصة المدمجة" للسجل (تجمع الخلاصة مع نقطة الانطلاق)
+    bp = result.get("execution_blueprint", {})
+    notes = result.get("market_state", {}).get("notes", "")
+    compact_reason = f"{notes}\n★ نقطة الانطلاق: {bp.get('نقطة_انطلاق_مناسبة')}\n★ الإبطال: {bp.get('مستوى_سعر_يبطل_التحليل')}"
+    
+    # 3. حفظ التحليل في قاعدة البيانات
+    analysis = Analysis(
+        user_id=user_id, 
+        symbol=result.get("market", "Asset"), 
+        signal=result.get("market_state", {}).get("directional_bias", bp.get("bias", "Neutral")),
+        reason=compact_reason[:500], 
+        timeframe=timeframe
+    )
+    db.add(analysis)
+    
+    # 4. تحديث إحصائيات الاستهلاك والنشاط (CRM) - زيادة ذرية بدل الكتابة من كائن قديم
+    # الرصيد نفسه محجوز مسبقاً عبر credit_ledger قبل استدعاء النموذج
+    db.query(User).filter(User.id == user_id).update({
+        "total_used_analyzes": User.total_used_analyzes + 1,
+        "last_active": datetime.now(timezone.utc),
+        "version": User.version + 1,
+    }, synchronize_session=False)
+    # الحجز صار خصماً نهائياً مع التحليل نفسه (وإلا تُرجعه مهمة الحجوزات اليتيمة)
+    if settle_ref:
+        credit_ledger.settle(db, user_id, settle_ref)
+
+    db.flush()
+    return analysis.id
+
+
+async def save_analysis(user_id: int, result: dict, timeframe: str, settle_ref: str = None) -> int:
+    # الحفظ عبر الكاتب الموحد (db_writer): تثبيت جماعي مع بقية الكتابات، ونعيد الرقم بدل الكائن
+    analysis_id = await db_writer.run(write_analysis, user_id, result, timeframe, settle_ref)
+    auth_cache.invalidate(user_id)
+    return analysis_id
+
+
+def remember_analysis(filename: str, fingerprint, timeframe: str, analysis_type: str, lang: str, cache_key: str, result: dict):
+    analysis_cache.put(cache_key, result)
+    chart_fingerprint.record_analysis(filename, fingerprint, timeframe, analysis_type, lang, cache_key)
+
+
+async def reserve_analysis_credit(user: User):
+    # يعيد مرجع الحجز (أو None للباقة البلاتينية) | الحجز يُثبت فوراً قبل أي استدعاء طويل
+    if user.is_whale:
+        return None
+    reservation = credit_ledger.new_ref("analysis")
+    try:
+        await db_writer.run(credit_ledger.reserve, user.id, reservation)
+    except credit_ledger.InsufficientCredits:
+        raise HTTPException(status_code=400, detail="الرصيد غير كافٍ، يرجى الترقية")
+    return reservation
+
+
+def should_charge(cache_hit: bool) -> bool:
+    # النتيجة المحفوظة تُخصم فقط إذا كان الإعداد يطلب ذلك
+    return not cache_hit or analysis_cache.ANALYSIS_CACHE_CHARGE_ON_HIT
+
+
+def analysis_payload(result: dict, analysis_type: str, cache_hit: bool, analysis_id: int):
+    return {
+        "status": "success", 
+        "analysis": result, 
+        "tier_mode": "Platinum" if analysis_type == "KAIA Master" else "Standard",
+        "cached": cache_hit,
+        "analysis_id": analysis_id
+    }
+
+
+async def lookup_cached_analysis(filename: str, image_bytes: bytes, timeframe: str, analysis_type: str, lang: str):
+    # فحص ذاكرة النتائج أولاً: نفس الصورة بنفس الإعدادات لا تُرسل للنموذج مرتين
+    cache_key = analysis_cache.make_key(image_bytes, timeframe, analysis_type, lang)
+    result = await run_in_threadpool(analysis_cache.get, cache_key)
+    fingerprint = None
+    if result is None and chart_fingerprint.PHASH_REUSE_ENABLED:
+        # ثم البحث عن شارت شبه متطابق (قص بسيط أو إعادة ضغط) حُلل مؤخراً
+        fingerprint = await run_in_threadpool(chart_fingerprint.lookup_fingerprint, filename, image_bytes)
+        near_key = await run_in_threadpool(chart_fingerprint.find_near_duplicate, fingerprint, timeframe, analysis_type, lang)
+        if near_key:
+            result = await run_in_threadpool(analysis_cache.get, near_key)
+    return cache_key, fingerprint, result
+
+
+async def analyze_uncached(filename: str, image_bytes: bytes, image_meta: dict, timeframe: str, analysis_type: str,
+                           lang: str, cache_key: str, fingerprint):
+    # يعيد (النتيجة, shared): الطلبات المتطابقة الجارية تتشارك استدعاءً واحداً لـ OpenAI
+    async def compute():
+        result = await run_vision_analysis(image_bytes, image_meta, timeframe, analysis_type, lang)
+        await run_in_threadpool(remember_analysis, filename, fingerprint, timeframe, analysis_type, lang, cache_key, result)
+        return result
+
+    return await single_flight.run(cache_key, compute)
+
+
+def delete_chart_files(img_path: str):
+    if os.path.exists(img_path): os.remove(img_path)
+    if os.path.exists(image_pipeline.meta_path(img_path)): os.remove(image_pipeline.meta_path(img_path))
+    storage_manager.forget(os.path.relpath(img_path, STORAGE_PATH))
+
+
+async def remove_chart_files(img_path: str):
+    # حذف الملف وصف الفهرس (DELETE + commit) في threadpool: لا عمل قاعدة بيانات على حلقة الأحداث
+    await run_in_threadpool(delete_chart_files, img_path)
+
+
+async def stream_chart_analysis(user_id: int, filename: str, image_bytes: bytes, image_meta: dict, timeframe: str,
+                                analysis_type: str, lang: str, cache_key: str, fingerprint, cached_result, reservation: str = None):
+    # أحداث SSE: field لكل مفتاح يكتمل (market_state أولاً ثم البقية)، ثم result بالنتيجة المثبتة ورقم السجل
+    analysis_id = None
+    try:
+        cache_hit = cached_result is not None
+        result = cached_result
+        if not cache_hit:
+            parser = json_stream.IncrementalObjectParser()
+            async with aclosing(ai_gateway.stream_chat_completion(
+                **build_vision_request(image_bytes, image_meta, timeframe, analysis_type, lang)
+            )) as deltas:
+                async for delta in deltas:
+                    for key, value in parser.feed(delta):
+                        yield sse_event({"key": key, "value": value}, event="field")
+
+            result = normalize_kaia_output(json.loads(parser.text), timeframe)
+            await run_in_threadpool(remember_analysis, filename, fingerprint, timeframe, analysis_type, lang, cache_key, result)
+
+        # الحفظ عبر db_writer لا يعتمد على جلسة الطلب (قد تُغلق قبل انتهاء البث)
+        charge = should_charge(cache_hit)
+        analysis_id = await save_analysis(user_id, result, timeframe, reservation if charge else None)
+        if not charge:
+            await run_in_threadpool(credit_ledger.release, user_id, reservation)
+
+        yield sse_event(analysis_payload(result, analysis_type, cache_hit, analysis_id), event="result")
+    except asyncio.CancelledError:
+        # انقطع العميل قبل اكتمال النتيجة: لا خصم. الإرجاع ينتظر الكاتب (db_writer) فلا يُنفذ على
+        # حلقة الأحداث، ولا ننتظره هنا حتى لا يتأخر الإلغاء؛ إن فشل تُرجعه مهمة الحجوزات اليتيمة
+        if analysis_id is None and reservation:
+            asyncio.get_running_loop().run_in_executor(None, credit_ledger.release, user_id, reservation)
+        raise
+    except Exception as e:
+        await run_in_threadpool(credit_ledger.release, user_id, reservation)
+        yield sse_event({"detail": str(e)}, event="error")
+
+
+async def process_analysis_job(job):
+    # يُنفَّذ داخل عامل الطابور: الرصيد محجوز مسبقاً عند الإدراج، لذا لا خصم هنا
+    if not chart_storage.is_upload_name(job.filename):
+        raise ValueError("اسم الملف غير صالح")
+    img_path = os.path.join(STORAGE_PATH, job.filename)
+    with open(img_path, "rb") as image_file:
+        image_bytes = image_file.read()
+
+    cache_key, fingerprint, result = await lookup_cached_analysis(job.filename, image_bytes, job.timeframe, job.analysis_type, job.lang)
+    cache_hit = result is not None
+    if not cache_hit:
+        result, cache_hit = await analyze_uncached(
+            job.filename, image_bytes, image_pipeline.load_meta(img_path),
+            job.timeframe, job.analysis_type, job.lang, cache_key, fingerprint
         )
 
-        # 1. تحويل الرد إلى JSON وتمريره عبر "فلتر التثبيت" لضمان القاموس السيادي
-        raw_result = json.loads(response.choices[0].message.content)
-        result = normalize_kaia_output(raw_result, timeframe)
-        
-        # 2. تحضير "الخلاصة المدمجة" للسجل (تجمع الخلاصة مع نقطة الانطلاق)
-        bp = result.get("execution_blueprint", {})
-        notes = result.get("market_state", {}).get("notes", "")
-        compact_reason = f"{notes}\n★ نقطة الانطلاق: {bp.get('نقطة_انطلاق_مناسبة')}\n★ الإبطال: {bp.get('مستوى_سعر_يبطل_التحليل')}"
-        
-        # 3. حفظ التحليل في قاعدة البيانات
-        db.add(Analysis(
-            user_id=current_user.id, 
-            symbol=result.get("market", "Asset"), 
-            signal=result.get("market_state", {}).get("directional_bias", bp.get("bias", "Neutral")),
-            reason=compact_reason[:500], 
-            timeframe=timeframe
-        ))
-        
-        # 4. تحديث إحصائيات الاستهلاك والنشاط (CRM)
-        current_user.total_used_analyzes += 1
-        current_user.last_active = datetime.now(timezone.utc)
+    # الحفظ لا يتم هنا: jobs.complete ينفذه في نفس معاملة التحقق من الحجز، فإعادة المهمة
+    # بعد فقدان الحجز أو انهيار العامل لا تحفظ التحليل ولا تحسب الاستهلاك مرتين
+    save = lambda db: write_analysis(db, job.user_id, result, job.timeframe)
 
-        # 5. خصم الرصيد (إلا إذا كان ملكاً بلاتينياً)
-        if not current_user.is_whale: 
-            current_user.credits -= 1
-            
-        db.commit()
+    # التسوية: إعادة الرصيد المحجوز إذا كانت النتيجة محفوظة والإعداد يعفيها
+    return analysis_payload(result, job.analysis_type, cache_hit, None), save, not should_charge(cache_hit)
 
-        return {
-            "status": "success", 
-            "analysis": result, 
-            "tier_mode": "Platinum" if analysis_type == "KAIA Master" else "Standard"
-        }
+
+async def cleanup_analysis_job(job):
+    if chart_storage.is_upload_name(job.filename):
+        await remove_chart_files(os.path.join(STORAGE_PATH, job.filename))
+
+
+@app.post("/api/analyze-chart")
+async def analyze_chart(
+    filename: str = Form(...),
+    timeframe: str = Form(...),
+    analysis_type: str = Form(...),
+    lang: str = Form("ar"),
+    webhook_url: str = Form(None),
+    stream: int = 0,
+    queue: int = 0,
+    current_user: User = Depends(get_current_user_cached),
+):
+    # لا جلسة للطلب: لقطة المستخدم من auth_cache، وكل كتابة (حجز، إدراج مهمة، حفظ) تمر عبر
+    # db_writer في معاملة قصيرة. استدعاء OpenAI الطويل لا يحجز أي اتصال من المجمع
+    if current_user.credits <= 0 and not current_user.is_whale:
+        raise HTTPException(status_code=400, detail="الرصيد غير كافٍ، يرجى الترقية")
+
+    if analysis_type == "KAIA Master" and current_user.tier != "Platinum":
+        msg = "عذراً، استراتيجية KAIA Master Vision مخصصة حصرياً لمشتركي الباقة البلاتينية." if lang == "ar" else "Sorry, KAIA Master is for Platinum members."
+        return {"status": "upgrade_required", "detail": msg}
+
+    # اسم الرفع فقط: مسار مثل blobs/<sha>.webp كان سيحذف الصورة المشتركة وسجلها عند التنظيف
+    if not chart_storage.is_upload_name(filename):
+        raise HTTPException(status_code=400, detail="اسم الملف غير صالح")
+    img_path = os.path.join(STORAGE_PATH, filename)
+    if not os.path.exists(img_path):
+        raise HTTPException(status_code=404, detail="الصورة غير موجودة")
+
+    # وضع الطابور (?queue=1): حجز الرصيد وإعادة رقم المهمة فوراً، والصورة تبقى حتى ينتهي العامل
+    if queue:
+        if webhook_url:
+            # حل DNS يحجب الخيط، لذا يتم في threadpool
+            webhook_error = await run_in_threadpool(jobs.webhook_url_error, webhook_url)
+            if webhook_error:
+                raise HTTPException(status_code=400, detail=webhook_error)
+        try:
+            job_id = await jobs.enqueue(current_user, filename, timeframe, analysis_type, lang, webhook_url)
+        except jobs.InsufficientCredits:
+            raise HTTPException(status_code=400, detail="الرصيد غير كافٍ، يرجى الترقية")
+        return {"status": "queued", "job_id": job_id}
+
+    # حجز ذري قبل استدعاء OpenAI: الطلبات المتزامنة لنفس الحساب لا تتجاوز الرصيد
+    user_id = current_user.id
+    reservation = await reserve_analysis_credit(current_user)
+    try:
+        with open(img_path, "rb") as image_file:
+            image_bytes = image_file.read()
+
+        cache_key, fingerprint, result = await lookup_cached_analysis(filename, image_bytes, timeframe, analysis_type, lang)
+        cache_hit = result is not None
+        image_meta = image_pipeline.load_meta(img_path)
+
+        # وضع البث (?stream=1): الصورة مقروءة في الذاكرة، لذا حذفها في finally لا يؤثر على البث
+        if stream:
+            return StreamingResponse(
+                stream_chart_analysis(
+                    user_id, filename, image_bytes, image_meta, timeframe, analysis_type, lang,
+                    cache_key, fingerprint, result, reservation
+                ),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+
+        if not cache_hit:
+            result, cache_hit = await analyze_uncached(filename, image_bytes, image_meta, timeframe, analysis_type, lang, cache_key, fingerprint)
+
+        charge = should_charge(cache_hit)
+        analysis_id = await save_analysis(user_id, result, timeframe, reservation if charge else None)
+        if not charge:
+            await run_in_threadpool(credit_ledger.release, user_id, reservation)
+
+        return analysis_payload(result, analysis_type, cache_hit, analysis_id)
     
     except Exception as e:
+        await run_in_threadpool(credit_ledger.release, user_id, reservation)
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        if os.path.exists(img_path): os.remove(img_path)
+        await remove_chart_files(img_path)
+
+
+@app.get("/api/analysis-jobs/{job_id}")
+def get_analysis_job(job_id: int, current_user: User = Depends(get_current_user_cached), db: Session = Depends(get_db)):
+    job = jobs.get_job(db, job_id, current_user.id)
+    if not job:
+        raise HTTPException(status_code=404, detail="المهمة غير موجودة")
+    return jobs.job_to_dict(job)
         
 # -----------------------------------------------------------------
 # 12. توجيه الصفحات ودعم PWA (المستعادة بالكامل)
 # -----------------------------------------------------------------
 
+HISTORY_SUMMARY_COLUMNS = [Analysis.id, Analysis.symbol, Analysis.signal, Analysis.timeframe, Analysis.created_at]
+HISTORY_FULL_COLUMNS = HISTORY_SUMMARY_COLUMNS + [Analysis.entry_data, Analysis.tp_data, Analysis.sl_data, Analysis.reason]
+
+
 @app.get("/api/history")
-def get_user_history(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    return db.query(Analysis).filter(Analysis.user_id == current_user.id).order_by(Analysis.id.desc()).all()
+async def get_user_history(
+    cursor: int = None,
+    limit: int = 50,
+    fields: str = "full",
+    symbol: str = None,
+    timeframe: str = None,
+    date_from: datetime = None,
+    date_to: datetime = None,
+    current_user: User = Depends(get_current_user_cached),
+):
+    # ترقيم بالمؤشر: cursor = آخر id في الصفحة السابقة، والفهرس (user_id, id) يجعل كل صفحة بنفس السرعة
+    limit = max(1, min(limit, 200))
+    columns = HISTORY_SUMMARY_COLUMNS if fields == "summary" else HISTORY_FULL_COLUMNS
+
+    q = select(*columns).where(Analysis.user_id == current_user.id)
+    if cursor:
+        q = q.where(Analysis.id < cursor)
+    if symbol:
+        q = q.where(Analysis.symbol == symbol)
+    if timeframe:
+        q = q.where(Analysis.timeframe == timeframe)
+    if date_from:
+        q = q.where(Analysis.created_at >= date_from)
+    if date_to:
+        q = q.where(Analysis.created_at <= date_to)
+
+    # الاتصال يعود للمجمع قبل تحويل الصفوف والرد (لا نعتمد على تنظيف التبعية بعد الإرسال)
+    rows = await run_read(lambda db: db.execute(q.order_by(Analysis.id.desc()).limit(limit + 1)).all())
+    items = [dict(row._mapping) for row in rows[:limit]]
+    next_cursor = items[-1]["id"] if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
 
 @app.get("/")
-def home_page(): return FileResponse("frontend/index.html")
+def home_page(request: Request): return static_assets.page(request, "index.html")
 
 @app.get("/manifest.json")
-def get_manifest(): return FileResponse("frontend/manifest.json")
+def get_manifest(request: Request): return static_assets.page(request, "manifest.json")
 
 @app.get("/sw.js")
-def get_sw(): return FileResponse("frontend/sw.js")
+def get_sw(request: Request): return static_assets.page(request, "sw.js")
 
 @app.get("/.well-known/assetlinks.json")
 async def get_assetlinks():
     return [{"relation": ["delegate_permission/common.handle_all_urls"],"target": {"namespace": "android_app","package_name": "com.onrender.kaia_ai_app.twa","sha256_cert_fingerprints": ["73:70:D7:27:14:0D:C7:A2:F9:FC:D1:A1:21:B4:1D:18:99:7D:27:38:14:85:E3:40:57:FD:8B:5B:AB:36:3A:0C"]}}]
 
 @app.get("/mobile")
-def mobile_page(): return FileResponse("frontend/mobile.html")
+def mobile_page(request: Request): return static_assets.page(request, "mobile.html")
 
 @app.get("/dashboard")
-def dashboard_page(): return FileResponse("frontend/dashboard.html")
+def dashboard_page(request: Request): return static_assets.page(request, "dashboard.html")
 
 @app.get("/admin")
-def admin_page(): return FileResponse("frontend/admin.html")
+def admin_page(request: Request): return static_assets.page(request, "admin.html")
 
 @app.get("/editor")
-def editor_page(): return FileResponse("frontend/editor.html")
+def editor_page(request: Request): return static_assets.page(request, "editor.html")
 
 @app.get("/history")
-def history_page(): return FileResponse("frontend/history.html")
+def history_page(request: Request): return static_assets.page(request, "history.html")
 
 @app.post("/api/upload-chart")
-async def upload_chart(chart: UploadFile = File(...)):
-    name = f"{uuid.uuid4()}.{chart.filename.split('.')[-1]}"
-    save_path = os.path.join(STORAGE_PATH, name)
-    with open(save_path, "wb") as buffer:
-        shutil.copyfileobj(chart.file, buffer)
-    return {"filename": name}
+async def upload_chart(request: Request, current_user: User = Depends(get_current_user_cached)):
+    # استقبال متدفق بحد أقصى للحجم + فحص التوقيع + بصمة SHA-256 أثناء الكتابة (chart_storage)
+    try:
+        upload = await chart_storage.receive_upload(request, "chart")
+    except chart_storage.UploadTooLarge:
+        raise HTTPException(status_code=413, detail="حجم الصورة أكبر من المسموح")
+    except image_pipeline.InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # تجهيز الصورة مرة واحدة لكل محتوى: تحقق، حذف EXIF، تصغير وإعادة ضغط
+    try:
+        name, prepared, deduplicated = await run_in_threadpool(chart_storage.store_upload, upload)
+    except image_pipeline.InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        upload.discard()
+
+    # تسجيل الملف في فهرس التخزين (تنظيف الشارتات غير المحللة بعد مهلة)
+    await run_in_threadpool(storage_manager.record_chart_upload, name, upload.sha256, deduplicated)
+    # تسجيل البصمة الإدراكية للصورة في فهرس الشارتات شبه المتطابقة (فقط إن كانت الميزة مفعلة)
+    if chart_fingerprint.PHASH_REUSE_ENABLED:
+        await run_in_threadpool(chart_fingerprint.register_upload, name, prepared)
+    return {"filename": name, "deduplicated": deduplicated}
 
 # -----------------------------------------------------------------
 # 13. أدوات الصيانة الطارئة
@@ -645,8 +1155,10 @@ def nuclear_wipe(email: str, current_user: User = Depends(get_current_user), db:
     user = db.query(User).filter(User.email == target).first()
     if user:
         db.query(Analysis).filter(Analysis.user_id == user.id).delete()
+        credit_ledger.forget_user(db, user.id)
         db.delete(user)
         db.commit()
+        auth_cache.invalidate(user.id)
         return {"message": f"تم مسح الحساب {target} بنجاح"}
     return {"message": "المستخدم غير موجود"}
 
@@ -663,8 +1175,9 @@ def fix_my_account(email: str, new_password: str, current_user: User = Depends(g
         user.is_verified = True
         user.is_admin = True
         user.is_whale = True
-        user.credits = 9999
+        credit_ledger.set_balance(db, user.id, 9999)
         db.commit()
+        auth_cache.invalidate(user.id)
         return {"message": f"تم إصلاح وتفعيل حساب الملك: {target}"}
     return {"error": "لم يتم العثور على الحساب"}
 
@@ -672,20 +1185,9 @@ def fix_my_account(email: str, new_password: str, current_user: User = Depends(g
 # 14. وكيل الذكاء الاصطناعي (KAIA - مدير أعمالك الاستراتيجي)
 # -----------------------------------------------------------------
 
-@app.post("/api/chat")
-async def chat_with_kaia(data: dict, current_user: User = Depends(get_current_user)):
-    # التحقق من الرصيد
-    if current_user.credits <= 0 and not current_user.is_whale:
-        raise HTTPException(status_code=400, detail="الرصيد غير كافٍ للدردشة")
-
-    user_message = data.get("message", "")
-    lang = data.get("lang", "ar")
-
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": f"""
+def build_chat_messages(user_message: str, lang: str):
+    return [
+        {"role": "system", "content": f"""
         أنت الآن 'KAIA - كبير المخططين الاستراتيجيين والمدير السيادي'. 
         وظيفتك هي العمل كشريك تنفيذي ومحلل مؤسسي عالي المستوى للمتداول الذي يخاطبك (المدير).
 
@@ -704,8 +1206,56 @@ async def chat_with_kaia(data: dict, current_user: User = Depends(get_current_us
         5. الذكاء الاصطناعي: ادمج دائماً بين "السعر" و"الزمن" في ردودك لإظهار قوة محرك كايا ماستر.
         6. اللغة: الرد حصراً باللغة ({lang}).
         """},
-                {"role": "user", "content": user_message}
-            ],
+        {"role": "user", "content": user_message}
+    ]
+
+
+@app.post("/api/chat")
+async def chat_with_kaia(data: dict, request: Request, stream: int = 0, current_user: User = Depends(get_current_user_cached)):
+    # التحقق من الرصيد
+    if current_user.credits <= 0 and not current_user.is_whale:
+        raise HTTPException(status_code=400, detail="الرصيد غير كافٍ للدردشة")
+
+    user_message = data.get("message", "")
+    lang = data.get("lang", "ar")
+    messages = build_chat_messages(user_message, lang)
+
+    # وضع البث (?stream=1): إرسال التوكنات كأحداث SSE فور وصولها من النموذج
+    if stream:
+        started = time.monotonic()
+
+        async def event_stream():
+            ai_gateway.METRICS["streams_started"] += 1
+            first = True
+            try:
+                async with aclosing(ai_gateway.stream_chat_completion(
+                    model="gpt-4o-mini", messages=messages, temperature=0.7, max_tokens=600
+                )) as deltas:
+                    async for delta in deltas:
+                        if await request.is_disconnected():
+                            ai_gateway.METRICS["streams_cancelled"] += 1
+                            return
+                        if first:
+                            ai_gateway.record_ttfb(time.monotonic() - started)
+                            first = False
+                        yield sse_event({"delta": delta})
+                yield sse_event({}, event="done")
+            except asyncio.CancelledError:
+                ai_gateway.METRICS["streams_cancelled"] += 1
+                raise
+            except Exception as e:
+                yield sse_event({"detail": str(e)}, event="error")
+
+        return StreamingResponse(
+            event_stream(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    try:
+        response = await create_chat_completion(
+            model="gpt-4o-mini",
+            messages=messages,
             temperature=0.7,
             max_tokens=600
         )
@@ -0,0 +1,197 @@
+# =================================================================
+# 🧱 KAIA MIGRATIONS – هجرات البنية المرقمة (Versioned Schema Migrations)
+# =================================================================
+# كل خطوة لها رقم ثابت وتُسجل في جدول schema_version بعد تنفيذها في نفس المعاملة.
+# عند الإقلاع: استعلام واحد (MAX(version)) فإذا كانت البنية محدثة لا يُنفذ أي شيء،
+# فلا يعتمد زمن الإقلاع على حجم الجداول أو عدد المستخدمين.
+# عند وجود خطوات جديدة يأخذ عامل واحد قفلاً (pg_advisory_lock أو قفل ملف لـ SQLite)
+# وبقية العمال تنتظر ثم تجد البنية محدثة.
+# خطوة جديدة = دالة جديدة + سطر في STEPS برقم أكبر. لا تُعدّل خطوة نُشرت سابقاً.
+# التشغيل اليدوي: python migrations.py
+
+import os
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import inspect, insert, text
+
+from database import engine, Base, SchemaVersion, CreditLedgerEntry, CreditBalance, CreditLedgerCursor, SQLALCHEMY_DATABASE_URL
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "1") == "1"
+# مفتاح ثابت لقفل Postgres الاستشاري (أي رقم 64-bit فريد للتطبيق)
+MIGRATION_LOCK_KEY = 0x4B414941
+
+
+# -----------------------------------------------------------------
+# 2. الخطوات (Numbered, Idempotent Steps)
+# -----------------------------------------------------------------
+# كل خطوة آمنة للتكرار: قواعد بيانات قديمة بلا schema_version تمر عليها كلها
+
+def _baseline(conn):
+    # إنشاء أي جدول أو فهرس ناقص (checkfirst)؛ لا يعدل الجداول الموجودة
+    Base.metadata.create_all(bind=conn)
+
+
+def _users_security_and_crm_columns(conn):
+    columns = {col["name"] for col in inspect(conn).get_columns("users")}
+    additions = [
+        # حقول الحماية
+        ("registration_ip", "VARCHAR DEFAULT '0.0.0.0'"),
+        ("is_flagged", "BOOLEAN DEFAULT FALSE"),
+        ("verified_at", "TIMESTAMP NULL"),
+        ("verification_method", "VARCHAR DEFAULT 'None'"),
+        # تواريخ الاشتراك
+        ("subscription_start", "TIMESTAMP NULL"),
+        ("subscription_end", "TIMESTAMP NULL"),
+        # الإدارة المالية والنشاط (CRM)
+        ("subscription_fee", "FLOAT DEFAULT 0.0"),
+        ("payment_status", "VARCHAR DEFAULT 'Unpaid'"),
+        ("total_used_analyzes", "INTEGER DEFAULT 0"),
+        ("last_active", "TIMESTAMP NULL"),
+        ("version", "INTEGER DEFAULT 0"),
+    ]
+    for name, ddl in additions:
+        if name not in columns:
+            conn.execute(text(f"ALTER TABLE users ADD COLUMN {name} {ddl}"))
+
+
+def _articles_image_variants(conn):
+    columns = {col["name"] for col in inspect(conn).get_columns("articles")}
+    if "image_variants" not in columns:
+        conn.execute(text("ALTER TABLE articles ADD COLUMN image_variants JSON NULL"))
+
+
+def _history_and_admin_indexes(conn):
+    # create_all لا يضيف فهارس لجداول كانت موجودة قبل تعريفها
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_analyses_user_id_id ON analyses (user_id, id)"))
+    for col in ("tier", "payment_status", "is_flagged", "subscription_end", "last_active"):
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_users_{col} ON users ({col})"))
+
+
+def _normalize_emails(conn):
+    # مرة واحدة فقط (كانت تُنفذ على كل الجدول في كل إقلاع)؛ التسجيل يوحد الإيميل أصلاً
+    if not SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
+        conn.execute(text("UPDATE users SET email = LOWER(TRIM(email)) WHERE email <> LOWER(TRIM(email))"))
+
+
+def _credit_ledger(conn):
+    Base.metadata.create_all(bind=conn, tables=[CreditLedgerEntry.__table__, CreditBalance.__table__])
+    # رصيد افتتاحي لكل مستخدم حالي حتى يطابق مجموع الدفتر users.credits
+    conn.execute(text(
+        "INSERT INTO credit_ledger (user_id, delta, kind, balance_after, created_at) "
+        "SELECT id, COALESCE(credits, 0), 'opening', COALESCE(credits, 0), CURRENT_TIMESTAMP FROM users "
+        "WHERE NOT EXISTS (SELECT 1 FROM credit_ledger l WHERE l.user_id = users.id)"
+    ))
+
+
+def _hot_query_indexes(conn):
+    # فهارس المسارات الساخنة (انظر query_plans.py): الجداول صغيرة فالإنشاء داخل المعاملة سريع
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_articles_language_id ON articles (language, id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_sponsors_location_active ON sponsors (location, is_active)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_analysis_cache_created_at ON analysis_cache (created_at)"))
+    # فهرس الطابور القديم (status, priority, id) يفرض فرزاً لأن claim_next يرتب priority تنازلياً
+    conn.execute(text("DROP INDEX IF EXISTS ix_analysis_jobs_claim"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_analysis_jobs_claim_priority ON analysis_jobs (status, priority DESC, id)"))
+
+
+def _credit_ledger_cursors(conn):
+    Base.metadata.create_all(bind=conn, tables=[CreditLedgerCursor.__table__])
+
+
+STEPS = [
+    (1, "baseline", _baseline),
+    (2, "users_security_and_crm_columns", _users_security_and_crm_columns),
+    (3, "articles_image_variants", _articles_image_variants),
+    (4, "history_and_admin_indexes", _history_and_admin_indexes),
+    (5, "normalize_emails", _normalize_emails),
+    (6, "credit_ledger", _credit_ledger),
+    (7, "hot_query_indexes", _hot_query_indexes),
+    (8, "credit_ledger_cursors", _credit_ledger_cursors),
+]
+LATEST_VERSION = max(version for version, _, _ in STEPS)
+
+
+# -----------------------------------------------------------------
+# 3. القفل بين العمال (Advisory Lock)
+# -----------------------------------------------------------------
+
+@contextmanager
+def _migration_lock(conn):
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        conn.commit()
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            conn.commit()
+        return
+
+    # SQLite: كل العمال على نفس الجهاز، قفل ملف بجانب قاعدة البيانات يكفي
+    database = engine.url.database
+    if fcntl is None or not database or database == ":memory:":
+        yield
+        return
+    with open(f"{database}.migrate.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# -----------------------------------------------------------------
+# 4. التنفيذ (Run Pending Steps)
+# -----------------------------------------------------------------
+
+def current_version(conn) -> int:
+    version = 0
+    if inspect(conn).has_table(SchemaVersion.__tablename__):
+        version = conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar()
+    conn.commit()
+    return version
+
+
+def run() -> int:
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        version = current_version(conn)
+        if version >= LATEST_VERSION:
+            print(f"✅ Schema up to date (v{version}) in {(time.perf_counter() - started) * 1000:.1f} ms")
+            return version
+
+        with _migration_lock(conn):
+            # عامل آخر ربما أنهى الهجرة أثناء انتظارنا للقفل
+            version = current_version(conn)
+            SchemaVersion.__table__.create(bind=conn, checkfirst=True)
+            conn.commit()
+            for step_version, name, step in STEPS:
+                if step_version <= version:
+                    continue
+                try:
+                    with conn.begin():
+                        step(conn)
+                        conn.execute(insert(SchemaVersion).values(version=step_version, name=name))
+                except Exception as e:
+                    # الخطوة تُلغى كاملة وتُعاد في الإقلاع القادم. الخطأ يُرفع ليفشل الإقلاع نفسه:
+                    # الكود الجديد لا يخدم الطلبات على بنية نصف مهاجرة (فيفشل وقت الاستعلام بدل الإقلاع)
+                    print(f"⚠️ Migration {step_version} ({name}) failed: {e}")
+                    raise
+                version = step_version
+                print(f"🧱 Applied migration {step_version}: {name}")
+
+    print(f"✅ Schema at v{version} in {(time.perf_counter() - started) * 1000:.1f} ms")
+    return version
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,375 @@
+# =================================================================
+# 📰 KAIA NEWS AGGREGATOR – محرك الأخبار الخلفي المشترك بين العمال
+# =================================================================
+# مهمة خلفية تجلب مصادر RSS المسجلة لكل لغة (news_feed_registry) بالتوازي (طلبات
+# مشروطة ETag / Last-Modified)، وتحللها بمحلل XML تدريجي يتوقف بعد أول 15 خبراً،
+# وتفلترها بكلمات اللغة المفتاحية (news_matcher)، ثم تنشر نص الشريط في جدول
+# news_ticker. الطلبات تقرأ من المخزن فوراً (stale-while-revalidate) ولا تنتظر
+# أي مصدر خارجي، وعامل واحد فقط يحدّث الشريط في كل دورة عبر عقد (lease).
+
+import os
+import re
+import json
+import time
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import requests
+from lxml import etree
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+
+import news_matcher
+from database import SessionLocal, Article, NewsTicker, NewsFeedState, NewsFeed, NewsKeyword
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+NEWS_REFRESH_INTERVAL = int(os.getenv("NEWS_REFRESH_INTERVAL", "600"))
+NEWS_CHECK_INTERVAL = float(os.getenv("NEWS_CHECK_INTERVAL", "30"))
+NEWS_FETCH_TIMEOUT = float(os.getenv("NEWS_FETCH_TIMEOUT", "5"))
+NEWS_LEASE_SECONDS = int(os.getenv("NEWS_LEASE_SECONDS", "60"))
+# مدة احتفاظ كل عامل بنسخته المحلية قبل إعادة قراءة المخزن المشترك
+NEWS_LOCAL_TTL = float(os.getenv("NEWS_LOCAL_TTL", "15"))
+NEWS_ITEMS_PER_FEED = 15
+NEWS_TICKER_MAX_ITEMS = int(os.getenv("NEWS_TICKER_MAX_ITEMS", "40"))
+NEWS_DEDUP_THRESHOLD = float(os.getenv("NEWS_DEDUP_THRESHOLD", "0.6"))
+
+DEFAULT_TICKER = {
+    "ar": "KAIA AI: نراقب تحركات السيولة والسياسة النقدية الحالية",
+    "en": "KAIA AI: Monitoring current liquidity and monetary policy",
+}
+
+# القيم الأولية لسجل المصادر والكلمات (تُزرع مرة واحدة ثم تُدار من لوحة الإدارة)
+DEFAULT_FEEDS = {
+    "ar": [
+        ("سكاي نيوز اقتصاد", "https://www.skynewsarabia.com/web/rss/business.xml"),
+        ("انفستنج أخبار عامة", "https://sa.investing.com/rss/news_1.rss"),
+    ],
+    "en": [
+        ("Investing.com News", "https://www.investing.com/rss/news_1.rss"),
+        ("CNBC Finance", "https://www.cnbc.com/id/10000664/device/rss/rss.html"),
+    ],
+}
+
+DEFAULT_KEYWORDS = {
+    "ar": [
+        "بطالة", "تضخم", "تداول", "بورصة", "بنك", "أسعار", "اتفاقيات",
+        "تجارة", "رجال أعمال", "رجل أعمال", "هبوط", "ارتفاع", "مؤشرات",
+        "صناديق استثمارية", "سيولة", "الفيدرالي", "الذهب", "النفط",
+    ],
+    "en": [
+        "inflation", "unemployment", "jobs report", "federal reserve", "the fed", "interest rate",
+        "central bank", "gold", "oil", "stocks", "dollar", "liquidity", "tariff", "recession",
+    ],
+}
+
+LABELS = {
+    "ar": {"article": "🔥 من تقارير المحلل: ", "breaking_word": "عاجل", "breaking": "🚨 [عاجل] "},
+    "en": {"article": "🔥 From the analyst: ", "breaking_word": "breaking", "breaking": "🚨 [BREAKING] "},
+}
+
+_local = {}  # lang -> (text, loaded_at)
+_matchers = {}  # lang -> KeywordMatcher
+_languages = {}  # {"set": لغات السجل, "loaded_at": ...}
+
+
+# -----------------------------------------------------------------
+# 2. الجلب والتحليل التدريجي (Conditional Fetch + Streaming XML)
+# -----------------------------------------------------------------
+
+def parse_rss_titles(chunks, limit: int = NEWS_ITEMS_PER_FEED) -> list:
+    # يحلل البايتات أثناء وصولها ويتوقف عند أول limit عنصر (بدون تحميل الملف كاملاً)
+    parser = etree.XMLPullParser(events=("end",), tag="{*}item", recover=True)
+    titles = []
+
+    def drain():
+        for _, item in parser.read_events():
+            title = item.findtext("{*}title")
+            if title and title.strip():
+                titles.append(title.strip())
+            item.clear()
+            if len(titles) >= limit:
+                return True
+        return False
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        if drain():
+            return titles
+    parser.close()
+    drain()
+    return titles[:limit]
+
+
+def fetch_feed(url: str, etag: str = None, last_modified: str = None):
+    # يعيد None إذا لم يتغير المصدر (304)، وإلا (titles, etag, last_modified)
+    headers = {"User-Agent": "Mozilla/5.0"}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    with requests.get(url, headers=headers, timeout=NEWS_FETCH_TIMEOUT, stream=True) as response:
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        titles = parse_rss_titles(response.iter_content(chunk_size=16384))
+        return titles, response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+
+def _matcher_for(lang: str, keywords: list):
+    matcher = _matchers.get(lang)
+    if matcher is None or matcher.keywords != sorted({news_matcher.normalize(k) for k in keywords if news_matcher.normalize(k)}):
+        matcher = news_matcher.KeywordMatcher(keywords)
+        _matchers[lang] = matcher
+    return matcher
+
+
+def build_ticker_text(lang: str, article_titles: list, feed_titles: list, keywords: list) -> str:
+    labels = LABELS.get(lang, LABELS["en"])
+    matcher = _matcher_for(lang, keywords)
+    dedup = news_matcher.Deduplicator(NEWS_DEDUP_THRESHOLD)
+
+    items = []
+    for title in article_titles:
+        dedup.is_duplicate(news_matcher.normalize(title))
+        items.append(f"{labels['article']}{title}")
+
+    for title in feed_titles:
+        if len(items) >= NEWS_TICKER_MAX_ITEMS:
+            break
+        normalized = news_matcher.normalize(title)
+        breaking = labels["breaking_word"] in normalized
+        # فلترة الخبر بالكلمات المفتاحية (تمريرة واحدة) ثم استبعاد المكرر من مصدر آخر
+        if not matcher.matches(normalized, normalized=True):
+            continue
+        if dedup.is_duplicate(normalized.replace(labels["breaking_word"], "") if breaking else normalized):
+            continue
+        clean_t = title.replace("'", "").replace('"', "")
+        # تمييز العاجل
+        if breaking:
+            clean_t = re.sub(labels["breaking_word"], "", clean_t, flags=re.IGNORECASE).strip(" :-|")
+            clean_t = f"{labels['breaking']}{clean_t}"
+        items.append(clean_t)
+    # دمج الأخبار بفاصل النجمة الفخمة
+    return " ★ ".join(items)
+
+
+# -----------------------------------------------------------------
+# 3. المخزن المشترك وعقد التحديث (Shared Store + Refresh Lease)
+# -----------------------------------------------------------------
+
+def seed_defaults():
+    db = SessionLocal()
+    try:
+        if db.query(NewsFeed.id).first() is None:
+            for lang, feeds in DEFAULT_FEEDS.items():
+                for name, url in feeds:
+                    db.add(NewsFeed(url=url, name=name, language=lang))
+        if db.query(NewsKeyword.id).first() is None:
+            for lang, keywords in DEFAULT_KEYWORDS.items():
+                for keyword in keywords:
+                    db.add(NewsKeyword(language=lang, keyword=keyword))
+        db.commit()
+    except IntegrityError:
+        # عامل آخر زرع القيم في نفس اللحظة
+        db.rollback()
+    finally:
+        db.close()
+
+
+def load_registry(lang: str):
+    db = SessionLocal()
+    try:
+        feeds = [
+            url for (url,) in
+            db.query(NewsFeed.url).filter(NewsFeed.language == lang, NewsFeed.enabled == True).order_by(NewsFeed.id).all()
+        ]
+        keywords = [k for (k,) in db.query(NewsKeyword.keyword).filter(NewsKeyword.language == lang).all()]
+        return feeds, keywords
+    finally:
+        db.close()
+
+
+def languages() -> list:
+    # كل لغة لها مصدر أو كلمات في السجل (لغة جديدة من لوحة الإدارة تُخدم بدون تعديل الكود)
+    db = SessionLocal()
+    try:
+        registered = {lang for (lang,) in db.query(NewsFeed.language).distinct().all()}
+        registered |= {lang for (lang,) in db.query(NewsKeyword.language).distinct().all()}
+    finally:
+        db.close()
+    found = sorted(registered | set(DEFAULT_TICKER))
+    _languages["set"], _languages["loaded_at"] = set(found), time.monotonic()
+    return found
+
+
+def is_served(lang: str) -> bool:
+    # فحص لغة الطلب في /api/news من نسخة محلية للسجل (تُحدث كل NEWS_LOCAL_TTL)
+    if lang in DEFAULT_TICKER:
+        return True
+    if _languages.get("set") is None or time.monotonic() - _languages["loaded_at"] >= NEWS_LOCAL_TTL:
+        try:
+            languages()
+        except Exception as e:
+            print(f"News Engine Error: {e}")
+            return False
+    return lang in _languages["set"]
+
+
+def mark_stale(lang: str = None):
+    # بعد تعديل السجل من لوحة الإدارة: الفحص التالي يعيد بناء الشريط فوراً
+    _languages.clear()
+    db = SessionLocal()
+    try:
+        q = db.query(NewsTicker)
+        if lang:
+            q = q.filter(NewsTicker.lang == lang)
+        q.update({"updated_at": None}, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _claim_refresh(lang: str) -> bool:
+    db = SessionLocal()
+    try:
+        if db.get(NewsTicker, lang) is None:
+            try:
+                db.add(NewsTicker(lang=lang, text=""))
+                db.commit()
+            except IntegrityError:
+                db.rollback()
+
+        now = datetime.now(timezone.utc)
+        # تحديث مشروط: ينجح لعامل واحد فقط عندما يكون الشريط قديماً ولا يوجد عقد ساري
+        claimed = db.query(NewsTicker).filter(
+            NewsTicker.lang == lang,
+            or_(NewsTicker.updated_at.is_(None), NewsTicker.updated_at < now - timedelta(seconds=NEWS_REFRESH_INTERVAL)),
+            or_(NewsTicker.refresh_lease_until.is_(None), NewsTicker.refresh_lease_until < now),
+        ).update({"refresh_lease_until": now + timedelta(seconds=NEWS_LEASE_SECONDS)}, synchronize_session=False)
+        db.commit()
+        return claimed == 1
+    finally:
+        db.close()
+
+
+def _load_feed_states(urls: list) -> dict:
+    db = SessionLocal()
+    try:
+        return {
+            s.url: (s.etag, s.last_modified, json.loads(s.titles or "[]"))
+            for s in db.query(NewsFeedState).filter(NewsFeedState.url.in_(urls)).all()
+        }
+    finally:
+        db.close()
+
+
+def _publish(lang: str, urls: list, results: list, states: dict, keywords: list):
+    db = SessionLocal()
+    try:
+        now = datetime.now(timezone.utc)
+        feed_titles = []
+        for url, result in zip(urls, results):
+            etag, last_modified, titles = states.get(url, (None, None, []))
+            if isinstance(result, Exception):
+                # مصدر متعطل: نبقي آخر عناوين معروفة بدل إسقاطها
+                print(f"News Engine Error: {url}: {result}")
+            elif result is not None:
+                titles, etag, last_modified = result
+                db.merge(NewsFeedState(
+                    url=url, etag=etag, last_modified=last_modified,
+                    titles=json.dumps(titles, ensure_ascii=False), fetched_at=now,
+                ))
+            feed_titles.extend(titles)
+
+        # جلب آخر 3 مقالات من تقارير المحلل أولاً
+        article_titles = [
+            title for (title,) in
+            db.query(Article.title).filter(Article.language == lang).order_by(Article.id.desc()).limit(3).all()
+        ]
+        text = build_ticker_text(lang, article_titles, feed_titles, keywords)
+
+        ticker = db.get(NewsTicker, lang)
+        if text:
+            ticker.text = text
+            ticker.updated_at = now
+        # بدون أخبار: نبقي النص السابق ونحرر العقد لتعاد المحاولة في الفحص التالي
+        ticker.refresh_lease_until = None
+        db.commit()
+        _local.pop(lang, None)
+    finally:
+        db.close()
+
+
+def _release(lang: str):
+    db = SessionLocal()
+    try:
+        db.query(NewsTicker).filter(NewsTicker.lang == lang).update({"refresh_lease_until": None}, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+async def refresh(lang: str = "ar") -> bool:
+    # يعيد True إذا قام هذا العامل بالتحديث فعلاً
+    if not await run_in_threadpool(_claim_refresh, lang):
+        return False
+    try:
+        urls, keywords = await run_in_threadpool(load_registry, lang)
+        states = await run_in_threadpool(_load_feed_states, urls)
+        results = await asyncio.gather(
+            *(run_in_threadpool(fetch_feed, url, *states.get(url, (None, None, []))[:2]) for url in urls),
+            return_exceptions=True,
+        )
+        await run_in_threadpool(_publish, lang, urls, results, states, keywords)
+        return True
+    except BaseException:
+        await run_in_threadpool(_release, lang)
+        raise
+
+
+# -----------------------------------------------------------------
+# 4. القراءة الفورية + المهمة الخلفية (Instant Reads & Refresher Loop)
+# -----------------------------------------------------------------
+
+def get_ticker(lang: str = "ar") -> str:
+    entry = _local.get(lang)
+    if entry is not None and time.monotonic() - entry[1] < NEWS_LOCAL_TTL:
+        return entry[0]
+
+    db = SessionLocal()
+    try:
+        text = db.query(NewsTicker.text).filter(NewsTicker.lang == lang).scalar()
+    except Exception as e:
+        print(f"News Engine Error: {e}")
+        return entry[0] if entry is not None else DEFAULT_TICKER.get(lang, DEFAULT_TICKER["en"])
+    finally:
+        db.close()
+
+    text = text or DEFAULT_TICKER.get(lang, DEFAULT_TICKER["en"])
+    _local[lang] = (text, time.monotonic())
+    return text
+
+
+async def _refresher_loop():
+    try:
+        await run_in_threadpool(seed_defaults)
+    except Exception as e:
+        print(f"News Engine Error: {e}")
+    while True:
+        try:
+            for lang in await run_in_threadpool(languages):
+                await refresh(lang)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"News Engine Error: {e}")
+        await asyncio.sleep(NEWS_CHECK_INTERVAL)
+
+
+def start_refresher():
+    return asyncio.create_task(_refresher_loop())
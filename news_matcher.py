@@ -0,0 +1,149 @@
+# =================================================================
+# 🔎 KAIA NEWS MATCHER – مطابقة الكلمات المفتاحية وإزالة الأخبار المكررة
+# =================================================================
+# - تطبيع النص العربي (الألف/الهمزة/التاء المربوطة/الألف المقصورة/التشكيل).
+# - آلة Aho-Corasick: تمريرة واحدة على العنوان مهما كان عدد الكلمات المفتاحية
+#   (الكلمات اللاتينية ككلمات كاملة، والعربية كمقاطع بسبب السوابق الملتصقة).
+# - إزالة التكرار بين المصادر عبر تشابه مقاطع العناوين (word shingles + Jaccard)
+#   مع فهرس معكوس حتى لا نقارن كل عنوان بكل العناوين السابقة.
+
+import re
+from collections import deque
+
+# -----------------------------------------------------------------
+# 1. التطبيع (Arabic / Latin Normalization)
+# -----------------------------------------------------------------
+
+_TASHKEEL = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]")
+_PUNCT = re.compile(r"[^\w\s]", re.UNICODE)
+_SPACES = re.compile(r"\s+")
+_LETTER_MAP = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ة": "ه",
+    "ى": "ي", "ئ": "ي",
+    "ؤ": "و",
+})
+
+
+def normalize(text: str) -> str:
+    text = _TASHKEEL.sub("", text or "").translate(_LETTER_MAP).lower()
+    return _SPACES.sub(" ", text).strip()
+
+
+# -----------------------------------------------------------------
+# 2. آلة المطابقة متعددة الأنماط (Aho-Corasick Automaton)
+# -----------------------------------------------------------------
+
+_ARABIC = re.compile("[\u0600-\u06ff]")
+
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isalnum() or ch == "_"
+
+
+class KeywordMatcher:
+    def __init__(self, keywords):
+        self.keywords = sorted({normalize(k) for k in keywords if k and normalize(k)})
+        # الكلمات غير العربية تُطابق ككلمات كاملة ("oil" لا تطابق "toil" و "gold" لا تطابق "goldman").
+        # العربية تبقى مطابقة جزئية: السوابق الملتصقة (ال، و، ب) جزء من الكلمة نفسها
+        self._bounded = {k for k in self.keywords if not _ARABIC.search(k)}
+        self._node_of = {}
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [None]
+        for keyword in self.keywords:
+            node = 0
+            for ch in keyword:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(None)
+                node = nxt
+            self._out[node] = keyword
+            self._node_of[keyword] = node
+        self._build_failure_links()
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                # كلمة تنتهي داخل كلمة أطول تُكتشف عبر رابط الفشل
+                if self._out[child] is None:
+                    self._out[child] = self._out[self._fail[child]]
+
+    def _whole_word(self, text: str, keyword: str, end: int) -> bool:
+        start = end - len(keyword) + 1
+        if start > 0 and _is_word_char(text[start - 1]):
+            return False
+        return end + 1 >= len(text) or not _is_word_char(text[end + 1])
+
+    def first_match(self, text: str, normalized: bool = False):
+        if not self.keywords:
+            return None
+        if not normalized:
+            text = normalize(text)
+        node = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            keyword = out[node]
+            # كلمة رُفضت لحدودها قد تخفي كلمة أقصر تنتهي في نفس الموضع: نتبع سلسلة المخرجات
+            while keyword is not None:
+                if keyword not in self._bounded or self._whole_word(text, keyword, i):
+                    return keyword
+                keyword = out[fail[self._node_of[keyword]]]
+        return None
+
+    def matches(self, text: str, normalized: bool = False) -> bool:
+        return self.first_match(text, normalized) is not None
+
+
+# -----------------------------------------------------------------
+# 3. إزالة التكرار بين المصادر (Shingle Dedup)
+# -----------------------------------------------------------------
+
+def shingles(normalized_text: str, size: int = 2) -> set:
+    words = _PUNCT.sub(" ", normalized_text).split()
+    if len(words) < size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class Deduplicator:
+    def __init__(self, threshold: float = 0.6):
+        self.threshold = threshold
+        self._sets = []
+        self._index = {}  # shingle -> [ids]
+
+    def is_duplicate(self, normalized_text: str) -> bool:
+        # يسجل العنوان إذا كان جديداً ويعيد True إذا كان مكرراً
+        current = shingles(normalized_text)
+        if not current:
+            return True
+
+        overlaps = {}
+        for sh in current:
+            for other in self._index.get(sh, ()):
+                overlaps[other] = overlaps.get(other, 0) + 1
+        for other, common in overlaps.items():
+            union = len(current) + len(self._sets[other]) - common
+            if common / union >= self.threshold:
+                return True
+
+        new_id = len(self._sets)
+        self._sets.append(current)
+        for sh in current:
+            self._index.setdefault(sh, []).append(new_id)
+        return False
@@ -0,0 +1,199 @@
+# =================================================================
+# 🔎 KAIA QUERY PLANS – فحص خطط الاستعلامات الساخنة (EXPLAIN)
+# =================================================================
+# يزرع قاعدة بيانات منفصلة بأحجام واقعية (100 ألف مستخدم، مليون تحليل) ثم يطلب خطة كل
+# استعلام ساخن ويفشل (exit 1) إذا مسح أي استعلام جدولاً كاملاً أو رتّب النتائج بدون فهرس.
+# SQLite: EXPLAIN QUERY PLAN (سطر SCAN أو USE TEMP B-TREE) | Postgres: EXPLAIN (FORMAT JSON) (Seq Scan أو Sort)
+# التشغيل: python query_plans.py          (هجرة + زرع إن كانت القاعدة فارغة + فحص)
+#          python query_plans.py check    (فحص فقط)
+# القاعدة من QUERY_PLANS_DATABASE_URL وليس DATABASE_URL، حتى لا يُزرع في قاعدة الإنتاج بالخطأ.
+# استعلام ساخن جديد في التطبيق = سطر جديد في hot_queries() بنفس الشكل.
+
+import os
+import sys
+import time
+import json
+import random
+from datetime import datetime, timedelta, timezone
+
+QUERY_PLANS_DATABASE_URL = os.getenv("QUERY_PLANS_DATABASE_URL", "sqlite:///./query_plans.db")
+os.environ["DATABASE_URL"] = QUERY_PLANS_DATABASE_URL
+os.environ.setdefault("MIGRATE_ON_STARTUP", "0")
+
+from sqlalchemy import select, delete, insert, func, text
+
+import migrations
+from database import (
+    engine, User, Analysis, Article, Sponsor, AnalysisCacheEntry, AnalysisJob,
+    ChartFingerprint, CreditLedgerEntry,
+)
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+QP_USERS = int(os.getenv("QP_USERS", "100000"))
+QP_ANALYSES = int(os.getenv("QP_ANALYSES", "1000000"))
+QP_ARTICLES = int(os.getenv("QP_ARTICLES", "20000"))
+QP_SPONSORS = int(os.getenv("QP_SPONSORS", "2000"))
+QP_CACHE_ENTRIES = int(os.getenv("QP_CACHE_ENTRIES", "50000"))
+QP_JOBS = int(os.getenv("QP_JOBS", "50000"))
+QP_BATCH = 20000
+
+SYMBOLS = ["XAUUSD", "EURUSD", "BTCUSD", "GBPUSD", "USDJPY", "NAS100", "US30", "ETHUSD"]
+TIMEFRAMES = ["M5", "M15", "H1", "H4", "D1"]
+TIERS = ["Trial", "Trial", "Trial", "Pro", "Whale"]
+LOCATIONS = ["main", "sidebar", "news", "footer"]
+
+
+# -----------------------------------------------------------------
+# 2. الزرع (Realistic Volumes)
+# -----------------------------------------------------------------
+
+def _bulk(conn, table, count: int, make_row):
+    for start in range(0, count, QP_BATCH):
+        conn.execute(insert(table), [make_row(i) for i in range(start, min(start + QP_BATCH, count))])
+
+
+def seed():
+    rnd = random.Random(2025)
+    now = datetime.now(timezone.utc)
+    ago = lambda days: now - timedelta(seconds=rnd.randint(0, days * 86400))
+    started = time.perf_counter()
+
+    with engine.begin() as conn:
+        _bulk(conn, User.__table__, QP_USERS, lambda i: {
+            "email": f"trader{i}@seed.kaia", "password_hash": "x", "tier": rnd.choice(TIERS),
+            "credits": rnd.randint(0, 50), "payment_status": rnd.choice(["Paid", "Unpaid"]),
+            "is_flagged": rnd.random() < 0.01, "last_active": ago(60), "version": 0,
+        })
+        # توزيع غير متساوٍ: قلة من المستخدمين يملكون معظم التحليلات (مثل الإنتاج)
+        _bulk(conn, Analysis.__table__, QP_ANALYSES, lambda i: {
+            "user_id": min(QP_USERS, int(rnd.paretovariate(1.2))) if rnd.random() < 0.3 else rnd.randint(1, QP_USERS),
+            "symbol": rnd.choice(SYMBOLS), "signal": rnd.choice(["BUY", "SELL"]), "timeframe": rnd.choice(TIMEFRAMES),
+            "entry_data": "2350.5", "tp_data": "2362.0", "sl_data": "2344.0", "reason": "seed", "created_at": ago(365),
+        })
+        _bulk(conn, Article.__table__, QP_ARTICLES, lambda i: {
+            "title": f"Report {i}", "summary": "seed", "content": "seed", "language": rnd.choice(["ar", "en"]), "created_at": ago(365),
+        })
+        _bulk(conn, Sponsor.__table__, QP_SPONSORS, lambda i: {
+            "name": f"Sponsor {i}", "image_url": "", "link_url": "", "location": rnd.choice(LOCATIONS), "is_active": rnd.random() < 0.2,
+        })
+        _bulk(conn, AnalysisCacheEntry.__table__, QP_CACHE_ENTRIES, lambda i: {
+            "cache_key": f"{i:064x}", "result": "{}", "hits": 0, "created_at": ago(7), "last_hit_at": ago(7),
+        })
+        _bulk(conn, AnalysisJob.__table__, QP_JOBS, lambda i: {
+            "user_id": rnd.randint(1, QP_USERS), "filename": f"{i}.png", "timeframe": "H1", "analysis_type": "full",
+            "status": "done" if rnd.random() < 0.98 else rnd.choice(["queued", "running", "failed"]),
+            "priority": rnd.randint(0, 2), "available_at": ago(30), "locked_at": ago(30), "created_at": ago(30),
+        })
+        _bulk(conn, ChartFingerprint.__table__, QP_CACHE_ENTRIES, lambda i: {
+            "filename": f"{i}.png", "phash": f"{rnd.getrandbits(64):016x}", "cache_key": f"{i:064x}", "created_at": ago(7),
+        })
+        _bulk(conn, CreditLedgerEntry.__table__, QP_USERS * 3, lambda i: {
+            "user_id": i % QP_USERS + 1, "delta": -1, "kind": "reserve", "ref": f"seed:{i}", "balance_after": 0, "created_at": ago(60),
+        })
+        # إحصاءات المخطط (planner statistics) كما في قاعدة عاملة منذ مدة
+        conn.execute(text("ANALYZE"))
+
+    print(f"🌱 Seeded {QP_USERS} users / {QP_ANALYSES} analyses in {time.perf_counter() - started:.1f}s")
+
+
+# -----------------------------------------------------------------
+# 3. الاستعلامات الساخنة (Same Shape as the App Code)
+# -----------------------------------------------------------------
+
+def hot_queries() -> list:
+    now = datetime.now(timezone.utc)
+    user_id = 1
+    history = [Analysis.id, Analysis.symbol, Analysis.signal, Analysis.timeframe, Analysis.created_at,
+               Analysis.entry_data, Analysis.tp_data, Analysis.sl_data, Analysis.reason]
+    history_page = select(*history).where(Analysis.user_id == user_id)
+    return [
+        ("get_current_user / auth_cache (main.py)", select(User).where(User.email == "trader1@seed.kaia")),
+        ("auth_cache version check", select(User.version).where(User.id == user_id)),
+        ("/api/history first page", history_page.order_by(Analysis.id.desc()).limit(51)),
+        ("/api/history cursor page", history_page.where(Analysis.id < 500000).order_by(Analysis.id.desc()).limit(51)),
+        ("/api/history symbol filter", history_page.where(Analysis.symbol == "XAUUSD").order_by(Analysis.id.desc()).limit(51)),
+        ("/api/articles", select(Article).where(Article.language == "ar").order_by(Article.id.desc()).limit(6)),
+        ("news ticker article titles", select(Article.title).where(Article.language == "ar").order_by(Article.id.desc()).limit(3)),
+        ("/api/sponsors", select(Sponsor).where(Sponsor.location == "main", Sponsor.is_active == True)),
+        ("admin_delete_user / nuclear_wipe analyses", delete(Analysis).where(Analysis.user_id == user_id)),
+        ("admin credit history", select(CreditLedgerEntry).where(CreditLedgerEntry.user_id == user_id)
+            .order_by(CreditLedgerEntry.id.desc()).limit(50)),
+        ("credit ledger purge", delete(CreditLedgerEntry).where(CreditLedgerEntry.user_id == user_id)),
+        ("credit orphan reservations scan", select(CreditLedgerEntry.id).where(CreditLedgerEntry.id > 1000, CreditLedgerEntry.kind == "reserve")
+            .order_by(CreditLedgerEntry.id.asc()).limit(5000)),
+        ("credit orphan resolved refs", select(CreditLedgerEntry.ref).where(
+            CreditLedgerEntry.kind.in_(("settle", "refund")), CreditLedgerEntry.ref.in_(["analysis:1", "analysis:2"]))),
+        ("admin online users", select(func.count(User.id)).where(User.last_active >= now - timedelta(minutes=5))),
+        ("jobs claim_next", select(AnalysisJob.id).where(AnalysisJob.status == "queued", AnalysisJob.available_at <= now)
+            .order_by(AnalysisJob.priority.desc(), AnalysisJob.id.asc()).limit(1)),
+        ("jobs requeue_stale", select(AnalysisJob.id).where(AnalysisJob.status == "running", AnalysisJob.locked_at < now)),
+        ("analysis_cache evict by age", delete(AnalysisCacheEntry).where(AnalysisCacheEntry.created_at < now - timedelta(days=3))),
+        ("chart fingerprint sync", select(ChartFingerprint).where(ChartFingerprint.id > 1000, ChartFingerprint.cache_key.isnot(None))
+            .order_by(ChartFingerprint.id.asc())),
+    ]
+
+
+# -----------------------------------------------------------------
+# 4. قراءة الخطة (EXPLAIN per Dialect)
+# -----------------------------------------------------------------
+
+def _explain(conn, stmt, prefix: str) -> list:
+    compiled = stmt.compile(dialect=conn.dialect, compile_kwargs={"render_postcompile": True})
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    return conn.exec_driver_sql(prefix + str(compiled), params).all()
+
+
+def _sqlite_problems(conn, stmt) -> tuple:
+    details = [row[3] for row in _explain(conn, stmt, "EXPLAIN QUERY PLAN ")]
+    # SEARCH = بحث بالفهرس | SCAN = مرور على كل الجدول أو كل الفهرس | TEMP B-TREE = ترتيب في الذاكرة
+    problems = [d for d in details if d.startswith("SCAN ") or "TEMP B-TREE" in d]
+    return details, problems
+
+
+def _postgres_problems(conn, stmt) -> tuple:
+    # enable_seqscan=off: إن بقي Seq Scan فلا يوجد فهرس صالح أصلاً (وليس مجرد جدول صغير)
+    conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+    raw = _explain(conn, stmt, "EXPLAIN (FORMAT JSON) ")[0][0]
+    plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]["Plan"]
+    details, problems, stack = [], [], [plan]
+    while stack:
+        node = stack.pop()
+        label = " ".join(filter(None, [node["Node Type"], node.get("Relation Name"), node.get("Index Name")]))
+        details.append(label)
+        if node["Node Type"] in ("Seq Scan", "Sort", "Incremental Sort"):
+            problems.append(label)
+        stack.extend(node.get("Plans", []))
+    return details, problems
+
+
+def check() -> int:
+    failures = 0
+    with engine.connect() as conn:
+        inspect_plan = _postgres_problems if conn.dialect.name == "postgresql" else _sqlite_problems
+        for name, stmt in hot_queries():
+            # EXPLAIN لا ينفذ الحذف، والتراجع يلغي SET LOCAL
+            with conn.begin() as tx:
+                details, problems = inspect_plan(conn, stmt)
+                tx.rollback()
+            failures += bool(problems)
+            print(f"{'❌' if problems else '✅'} {name}")
+            for detail in details:
+                print(f"      {detail}")
+    print(f"{'❌' if failures else '✅'} {failures} of {len(hot_queries())} hot queries without an index plan")
+    return failures
+
+
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "all"
+    if mode != "check":
+        migrations.run()
+        with engine.connect() as conn:
+            empty = conn.execute(select(func.count(User.id))).scalar() == 0
+        if empty:
+            seed()
+    sys.exit(1 if check() else 0)
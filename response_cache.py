@@ -0,0 +1,228 @@
+# =================================================================
+# 🌐 KAIA RESPONSE CACHE – كاش HTTP للواجهات العامة (ETag / 304)
+# =================================================================
+# لكل مجموعة بيانات (articles, sponsors ...) رقم نسخة في جدول cache_versions يرتفع
+# تلقائياً بعد أي commit يعدّل جداولها (حتى التعديلات الجماعية query.update/delete).
+# الاستجابة تُبنى مرة واحدة لكل (مجموعة + معاملات + نسخة) في كل عامل، والـ ETag
+# مشتق من النسخة، فيرد السيرفر 304 بدون أي استعلام، و Cache-Control يسمح للـ CDN
+# بامتصاص زيارات الصفحة الرئيسية.
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import event, select, update
+from sqlalchemy.exc import IntegrityError
+
+from database import SessionLocal, run_read, engine, Article, Sponsor, CacheVersion
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+RESPONSE_CACHE_MAX_AGE = int(os.getenv("RESPONSE_CACHE_MAX_AGE", "60"))
+RESPONSE_CACHE_STALE_WHILE_REVALIDATE = int(os.getenv("RESPONSE_CACHE_STALE_WHILE_REVALIDATE", "300"))
+# كم ثانية يثق العامل برقم النسخة المحلي قبل إعادة قراءته (تعديلات العمال الآخرين)
+RESPONSE_CACHE_VERSION_TTL = float(os.getenv("RESPONSE_CACHE_VERSION_TTL", "5"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "500"))
+
+# الجداول التي تُبطل كل مجموعة عند تعديلها
+TRACKED_MODELS = {Article: "articles", Sponsor: "sponsors"}
+
+_lock = threading.Lock()
+_versions = {}             # namespace -> (version, checked_at)
+_entries = OrderedDict()   # (namespace, params) -> (version, etag, body)
+
+STATS = {"hits": 0, "misses": 0, "not_modified": 0}
+
+
+# -----------------------------------------------------------------
+# 2. أرقام النسخ المشتركة (Shared Data Versions)
+# -----------------------------------------------------------------
+
+def _fresh_version(namespace: str):
+    with _lock:
+        entry = _versions.get(namespace)
+    if entry is not None and time.monotonic() - entry[1] < RESPONSE_CACHE_VERSION_TTL:
+        return entry, entry[0]
+    return entry, None
+
+
+def _remember_version(namespace: str, version: int) -> int:
+    with _lock:
+        _versions[namespace] = (version, time.monotonic())
+    return version
+
+
+def current_version(namespace: str) -> int:
+    entry, version = _fresh_version(namespace)
+    if version is not None:
+        return version
+
+    db = SessionLocal()
+    try:
+        version = db.query(CacheVersion.version).filter(CacheVersion.namespace == namespace).scalar() or 0
+    except Exception as e:
+        print(f"Response Cache Error: {e}")
+        return entry[0] if entry is not None else 0
+    finally:
+        db.close()
+    return _remember_version(namespace, version)
+
+
+async def current_version_async(namespace: str) -> int:
+    entry, version = _fresh_version(namespace)
+    if version is not None:
+        return version
+
+    try:
+        version = await run_read(
+            lambda db: db.execute(select(CacheVersion.version).where(CacheVersion.namespace == namespace)).scalar()
+        ) or 0
+    except Exception as e:
+        print(f"Response Cache Error: {e}")
+        return entry[0] if entry is not None else 0
+    return _remember_version(namespace, version)
+
+
+def bump(namespace: str):
+    try:
+        with engine.begin() as conn:
+            res = conn.execute(
+                update(CacheVersion).where(CacheVersion.namespace == namespace).values(version=CacheVersion.version + 1)
+            )
+            if res.rowcount == 0:
+                conn.execute(CacheVersion.__table__.insert().values(namespace=namespace, version=1))
+    except IntegrityError:
+        # عامل آخر أنشأ الصف في نفس اللحظة: نعيد الزيادة عليه
+        with engine.begin() as conn:
+            conn.execute(
+                update(CacheVersion).where(CacheVersion.namespace == namespace).values(version=CacheVersion.version + 1)
+            )
+    with _lock:
+        _versions.pop(namespace, None)
+
+
+# -----------------------------------------------------------------
+# 3. الإبطال التلقائي بعد الـ commit (Session Events)
+# -----------------------------------------------------------------
+
+def _mark(session, namespace: str):
+    session.info.setdefault("response_cache_dirty", set()).add(namespace)
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _track_flush(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        namespace = TRACKED_MODELS.get(type(obj))
+        if namespace:
+            _mark(session, namespace)
+
+
+@event.listens_for(SessionLocal, "do_orm_execute")
+def _track_bulk(orm_execute_state):
+    # query(...).update() / delete() لا تمر عبر flush
+    if orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert:
+        mapper = orm_execute_state.bind_mapper
+        namespace = TRACKED_MODELS.get(mapper.class_) if mapper is not None else None
+        if namespace:
+            _mark(orm_execute_state.session, namespace)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _bump_after_commit(session):
+    for namespace in session.info.pop("response_cache_dirty", ()):
+        try:
+            bump(namespace)
+        except Exception as e:
+            print(f"Response Cache Error: {e}")
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_after_rollback(session):
+    session.info.pop("response_cache_dirty", None)
+
+
+# -----------------------------------------------------------------
+# 4. بناء الاستجابة (ETag + 304 + Cache-Control)
+# -----------------------------------------------------------------
+
+def _etag(namespace: str, params: tuple, version) -> str:
+    digest = hashlib.sha1(repr((params, version)).encode("utf-8")).hexdigest()[:16]
+    return f'"{namespace}-{digest}"'
+
+
+def _headers(etag: str, max_age: int) -> dict:
+    return {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={max_age}, stale-while-revalidate={RESPONSE_CACHE_STALE_WHILE_REVALIDATE}",
+    }
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag in candidates or "*" in candidates
+
+
+def _lookup(request: Request, namespace: str, params: dict, version, max_age: int):
+    # يعيد (استجابة جاهزة أو None, مفتاح الكاش, etag, الترويسات)
+    max_age = RESPONSE_CACHE_MAX_AGE if max_age is None else max_age
+    params_key = tuple(sorted(params.items()))
+    etag = _etag(namespace, params_key, version)
+    headers = _headers(etag, max_age)
+
+    if _not_modified(request, etag):
+        STATS["not_modified"] += 1
+        return Response(status_code=304, headers=headers), None, etag, headers
+
+    key = (namespace, params_key)
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry[0] == version:
+            _entries.move_to_end(key)
+            STATS["hits"] += 1
+            return Response(content=entry[2], media_type="application/json", headers=headers), key, etag, headers
+
+    STATS["misses"] += 1
+    return None, key, etag, headers
+
+
+def _store(key, version, etag: str, headers: dict, data) -> Response:
+    body = json.dumps(jsonable_encoder(data), ensure_ascii=False).encode("utf-8")
+    with _lock:
+        _entries[key] = (version, etag, body)
+        _entries.move_to_end(key)
+        while len(_entries) > RESPONSE_CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def cached_json(request: Request, namespace: str, params: dict, producer, version=None, max_age: int = None) -> Response:
+    # producer() يُستدعى فقط عند تغير النسخة؛ version يمكن تمريره مباشرة (مثل بصمة نص الأخبار)
+    if version is None:
+        version = current_version(namespace)
+    response, key, etag, headers = _lookup(request, namespace, params, version, max_age)
+    if response is not None:
+        return response
+    return _store(key, version, etag, headers, producer())
+
+
+async def cached_json_async(request: Request, namespace: str, params: dict, producer, max_age: int = None) -> Response:
+    # نفس cached_json للمسارات غير المتزامنة: producer دالة async (استعلام عبر run_read)
+    version = await current_version_async(namespace)
+    response, key, etag, headers = _lookup(request, namespace, params, version, max_age)
+    if response is not None:
+        return response
+    return _store(key, version, etag, headers, await producer())
+
+
+def stats() -> dict:
+    return dict(STATS, entries=len(_entries), versions={ns: v for ns, (v, _) in _versions.items()})
@@ -1,5 +1,6 @@
 # هذا هو ملف set_admin.py كاملاً
 from database import SessionLocal, User
+import credit_ledger
 
 def make_admin():
     db = SessionLocal()
@@ -17,7 +18,7 @@ def make_admin():
         user.is_premium = True
         user.is_whale = True
         user.tier = "Platinum"
-        user.credits = 9999  # رصيد ضخم جداً
+        credit_ledger.set_balance(db, user.id, 9999)  # رصيد ضخم جداً (يُسجل في دفتر الرصيد)
         
         db.commit() # حفظ التغييرات في قاعدة البيانات
         print(f"\n✅ نجاح! الحساب {email_input} أصبح الآن مديراً للنظام (Admin) ولديه رصيد كامل 👑.")
@@ -0,0 +1,149 @@
+# =================================================================
+# 🔗 KAIA SINGLE FLIGHT – دمج طلبات التحليل المتطابقة الجارية
+# =================================================================
+# الطلبات المتزامنة بنفس المفتاح (بصمة الصورة + الإطار + النوع + اللغة) تنتظر
+# استدعاءً واحداً لـ OpenAI وتتشارك نتيجته:
+# - داخل العامل الواحد عبر Future مشترك.
+# - بين عمال gunicorn عبر جدول أقفال inflight_analyses، والنتيجة تصل من
+#   ذاكرة النتائج المشتركة (ANALYSIS_CACHE_BACKEND=sql).
+
+import os
+import socket
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+
+import analysis_cache
+from database import SessionLocal, InflightAnalysis
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+# مدة صلاحية القفل: بعدها يُعتبر صاحب القفل متوقفاً ويحق لغيره التنفيذ
+SINGLE_FLIGHT_LOCK_TTL = int(os.getenv("SINGLE_FLIGHT_LOCK_TTL", "180"))
+SINGLE_FLIGHT_POLL_INTERVAL = float(os.getenv("SINGLE_FLIGHT_POLL_INTERVAL", "0.3"))
+
+OWNER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+METRICS = {"leaders": 0, "coalesced_local": 0, "coalesced_remote": 0, "retries": 0}
+
+_local = {}
+
+
+# -----------------------------------------------------------------
+# 2. جدول الأقفال (Cross-Worker Lock Table)
+# -----------------------------------------------------------------
+
+def _try_lock(key: str) -> bool:
+    db = SessionLocal()
+    try:
+        now = datetime.now(timezone.utc)
+        db.query(InflightAnalysis).filter(
+            InflightAnalysis.cache_key == key, InflightAnalysis.expires_at < now
+        ).delete(synchronize_session=False)
+        db.add(InflightAnalysis(
+            cache_key=key, owner=OWNER_ID, expires_at=now + timedelta(seconds=SINGLE_FLIGHT_LOCK_TTL)
+        ))
+        db.commit()
+        return True
+    except IntegrityError:
+        db.rollback()
+        return False
+    finally:
+        db.close()
+
+
+def _unlock(key: str):
+    db = SessionLocal()
+    try:
+        db.query(InflightAnalysis).filter(
+            InflightAnalysis.cache_key == key, InflightAnalysis.owner == OWNER_ID
+        ).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _is_locked(key: str) -> bool:
+    db = SessionLocal()
+    try:
+        return db.query(InflightAnalysis.cache_key).filter(
+            InflightAnalysis.cache_key == key,
+            InflightAnalysis.expires_at >= datetime.now(timezone.utc),
+        ).first() is not None
+    finally:
+        db.close()
+
+
+# -----------------------------------------------------------------
+# 3. التنفيذ الموحد (Leader / Follower)
+# -----------------------------------------------------------------
+
+async def _lead_or_follow(key: str, compute):
+    # يعيد (النتيجة, هل هي مشتركة من منفذ آخر)
+    counted = False
+    while True:
+        if await run_in_threadpool(_try_lock, key):
+            METRICS["leaders"] += 1
+            try:
+                return await compute(), False
+            finally:
+                await run_in_threadpool(_unlock, key)
+
+        # عامل آخر يحلل نفس الشارت الآن: ننتظر نتيجته في الذاكرة المشتركة
+        if not counted:
+            METRICS["coalesced_remote"] += 1
+            counted = True
+        while True:
+            await asyncio.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+            result = await run_in_threadpool(analysis_cache.peek, key)
+            if result is not None:
+                return result, True
+            if not await run_in_threadpool(_is_locked, key):
+                # تحرر القفل بدون نتيجة (فشل صاحبه): نحاول أن نكون المنفذ
+                break
+
+
+class _LeaderCancelled(Exception):
+    # انقطع عميل المنفذ المحلي: المنتظرون لا يفشلون بسببه، بل يعيدون المحاولة
+    pass
+
+
+async def run(key: str, compute):
+    # compute: دالة غير متزامنة تنفذ الاستدعاء الفعلي وتحفظ النتيجة في analysis_cache
+    # يعيد (النتيجة, shared) حيث shared = True للطلبات التي انتظرت استدعاء غيرها
+    counted = False
+    while True:
+        pending = _local.get(key)
+        if pending is None:
+            break
+        if not counted:
+            METRICS["coalesced_local"] += 1
+            counted = True
+        try:
+            result, _ = await asyncio.shield(pending)
+            return result, True
+        except _LeaderCancelled:
+            # أول منتظر يستيقظ يصبح المنفذ (بدالة compute الخاصة به) والبقية تتبعه
+            METRICS["retries"] += 1
+
+    future = asyncio.get_running_loop().create_future()
+    # منع تحذير "exception never retrieved" عندما لا يوجد منتظرون
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    _local[key] = future
+    try:
+        outcome = await _lead_or_follow(key, compute)
+        future.set_result(outcome)
+        return outcome
+    except BaseException as e:
+        future.set_exception(e if isinstance(e, Exception) else _LeaderCancelled())
+        raise
+    finally:
+        _local.pop(key, None)
+
+
+def stats() -> dict:
+    return dict(METRICS, in_flight=len(_local))
@@ -0,0 +1,221 @@
+# =================================================================
+# 📦 KAIA STATIC ASSETS – ملفات الواجهة المضغوطة مسبقاً والمبصومة
+# =================================================================
+# عند التشغيل (أو عبر: python static_assets.py) نبني نسخة من مجلد frontend:
+# - كل ملف غير HTML يحصل على اسم يحوي بصمة محتواه (style.3f2a1b9c0d12.css)
+#   ويُخدم بتخزين طويل immutable لأن أي تعديل يغير الاسم.
+# - صفحات HTML تُعاد كتابة روابط /static/ فيها للأسماء المبصومة، وتُخدم بـ
+#   no-cache + ETag (تحقق سريع 304 بدل إعادة التحميل).
+# - نسخ gzip و brotli جاهزة لكل ملف نصي، ويُختار الترميز حسب Accept-Encoding.
+# sw.js يُولد من قالب يحوي قائمة الملفات المبصومة وإصدارها (كسر الكاش تلقائياً عند النشر).
+# الملفات تُكتب بأسماء مبنية على المحتوى وبشكل ذري، فيمكن لكل عمال gunicorn
+# تنفيذ البناء في نفس الوقت بأمان.
+
+import os
+import re
+import json
+import gzip
+import hashlib
+import mimetypes
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import FileResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+STATIC_SOURCE_DIR = os.getenv("STATIC_SOURCE_DIR", "frontend")
+STATIC_BUILD_DIR = os.getenv("STATIC_BUILD_DIR", "frontend_build")
+STATIC_UNHASHED_MAX_AGE = int(os.getenv("STATIC_UNHASHED_MAX_AGE", "300"))
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+COMPRESSIBLE_EXTENSIONS = {".html", ".js", ".css", ".json", ".svg", ".txt", ".xml", ".map"}
+MIN_COMPRESS_SIZE = 512
+
+# صفحات الواجهة التي يخزنها Service Worker مسبقاً (المسار -> الملف)
+SHELL_PAGES = {"/": "index.html", "/mobile": "mobile.html", "/dashboard": "dashboard.html", "/history": "history.html"}
+# ملفات تُولد من قالب بعد بناء الباقي (قائمة PRECACHE داخل sw.js)
+SERVICE_WORKER = "sw.js"
+PRECACHE_PLACEHOLDER = "__KAIA_PRECACHE_MANIFEST__"
+
+_STATIC_REF = re.compile(r"""(?<=["'(])/static/([A-Za-z0-9_./-]+)""")
+
+_assets = {}   # المسار الأصلي (style.css) -> بيانات الملف المبني
+_hashed = {}   # الاسم المبصوم (style.3f2a....css) -> نفس البيانات
+
+
+# -----------------------------------------------------------------
+# 2. البناء (Fingerprint + Precompress Build Step)
+# -----------------------------------------------------------------
+
+def _write_once(path: str, data: bytes):
+    # الاسم مبني على المحتوى: إذا كان موجوداً فهو مطابق
+    if os.path.exists(path):
+        return
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _hashed_name(rel: str, digest: str) -> str:
+    root, ext = os.path.splitext(rel)
+    return f"{root}.{digest}{ext}"
+
+
+def _emit(rel: str, data: bytes, hashed_rel: str) -> dict:
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    out_path = os.path.join(STATIC_BUILD_DIR, hashed_rel)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    _write_once(out_path, data)
+
+    encodings = {}
+    ext = os.path.splitext(rel)[1].lower()
+    if ext in COMPRESSIBLE_EXTENSIONS and len(data) >= MIN_COMPRESS_SIZE:
+        variants = [("gzip", ".gz", lambda: gzip.compress(data, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variants.append(("br", ".br", lambda: brotli.compress(data, quality=11)))
+        for encoding, suffix, compress in variants:
+            path = out_path + suffix
+            if not os.path.exists(path):
+                compressed = compress()
+                if len(compressed) >= len(data):
+                    continue
+                _write_once(path, compressed)
+            encodings[encoding] = path
+
+    media_type = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+    if media_type.startswith("text/") or media_type in ("application/javascript", "application/json"):
+        media_type += "; charset=utf-8"
+    return {"path": out_path, "etag": f'"{digest}"', "media_type": media_type, "encodings": encodings}
+
+
+def build(source_dir: str = STATIC_SOURCE_DIR) -> dict:
+    if not os.path.isdir(source_dir):
+        return {}
+    assets, hashed, html_files = {}, {}, []
+
+    for dirpath, _, filenames in os.walk(source_dir):
+        for filename in sorted(filenames):
+            full = os.path.join(dirpath, filename)
+            rel = os.path.relpath(full, source_dir).replace(os.sep, "/")
+            if rel.endswith(".html"):
+                html_files.append((rel, full))
+                continue
+            if rel == SERVICE_WORKER:
+                continue
+            with open(full, "rb") as f:
+                data = f.read()
+            hashed_rel = _hashed_name(rel, hashlib.sha256(data).hexdigest()[:12])
+            asset = _emit(rel, data, hashed_rel)
+            asset["url"] = f"/static/{hashed_rel}"
+            assets[rel] = asset
+            hashed[hashed_rel] = asset
+
+    # صفحات HTML: استبدال الروابط بالأسماء المبصومة ثم ضغطها
+    def rewrite(match):
+        asset = assets.get(match.group(1))
+        return asset["url"] if asset else match.group(0)
+
+    for rel, full in html_files:
+        with open(full, "r", encoding="utf-8") as f:
+            html = _STATIC_REF.sub(rewrite, f.read()).encode("utf-8")
+        asset = _emit(rel, html, _hashed_name(rel, hashlib.sha256(html).hexdigest()[:12]))
+        asset["url"] = None
+        assets[rel] = asset
+
+    sw_source = os.path.join(source_dir, SERVICE_WORKER)
+    if os.path.exists(sw_source):
+        with open(sw_source, "r", encoding="utf-8") as f:
+            sw = f.read().replace(PRECACHE_PLACEHOLDER, json.dumps(precache_manifest(assets))).encode("utf-8")
+        asset = _emit(SERVICE_WORKER, sw, _hashed_name(SERVICE_WORKER, hashlib.sha256(sw).hexdigest()[:12]))
+        asset["url"] = None
+        assets[SERVICE_WORKER] = asset
+
+    _assets.clear()
+    _assets.update(assets)
+    _hashed.clear()
+    _hashed.update(hashed)
+    return assets
+
+
+def precache_manifest(assets: dict) -> dict:
+    # الإصدار = بصمة كل الملفات: أي نشر يغير ملفاً واحداً يفرض تحديث الكاش
+    urls = sorted(a["url"] for rel, a in assets.items() if a["url"] and not rel.startswith("well-known/"))
+    shell = [path for path, rel in SHELL_PAGES.items() if rel in assets]
+    fingerprint = hashlib.sha256()
+    for rel in sorted(assets):
+        fingerprint.update(f"{rel}:{assets[rel]['etag']}".encode("utf-8"))
+    return {"version": fingerprint.hexdigest()[:12], "urls": urls + shell, "shell": shell}
+
+
+def asset_url(rel: str) -> str:
+    asset = _assets.get(rel)
+    return asset["url"] if asset and asset["url"] else f"/static/{rel}"
+
+
+# -----------------------------------------------------------------
+# 3. الخدمة (Encoding Negotiation + Cache Headers)
+# -----------------------------------------------------------------
+
+def _accepted_encodings(request: Request) -> set:
+    accepted = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name and q > 0:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def _respond(request: Request, asset: dict, cache_control: str) -> Response:
+    headers = {"ETag": asset["etag"], "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if request.headers.get("if-none-match") == asset["etag"]:
+        return Response(status_code=304, headers=headers)
+
+    accepted = _accepted_encodings(request)
+    for encoding in ("br", "gzip"):
+        if encoding in asset["encodings"] and encoding in accepted:
+            headers["Content-Encoding"] = encoding
+            return FileResponse(asset["encodings"][encoding], media_type=asset["media_type"], headers=headers)
+    return FileResponse(asset["path"], media_type=asset["media_type"], headers=headers)
+
+
+def serve(request: Request, path: str) -> Response:
+    asset = _hashed.get(path)
+    if asset is not None:
+        return _respond(request, asset, IMMUTABLE_CACHE)
+    # الروابط القديمة غير المبصومة (من JavaScript مثلاً) تبقى تعمل بتخزين قصير
+    asset = _assets.get(path)
+    if asset is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    cache_control = REVALIDATE_CACHE if path.endswith(".html") else f"public, max-age={STATIC_UNHASHED_MAX_AGE}"
+    return _respond(request, asset, cache_control)
+
+
+def page(request: Request, rel: str) -> Response:
+    # صفحات HTML و sw.js و manifest.json: روابط ثابتة، تحقق في كل زيارة
+    asset = _assets.get(rel)
+    if asset is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return _respond(request, asset, REVALIDATE_CACHE)
+
+
+if __name__ == "__main__":
+    built = build()
+    print(f"✅ Built {len(built)} static assets into {STATIC_BUILD_DIR} (brotli: {'on' if brotli else 'off'})")
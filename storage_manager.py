@@ -0,0 +1,383 @@
+# =================================================================
+# 🧹 KAIA STORAGE MANAGER – تنظيف الملفات اليتيمة وحصة مساحة القرص
+# =================================================================
+# كل ملف يُكتب في STORAGE_PATH يُسجل في جدول stored_files (النوع، الحجم، العمر،
+# آخر استخدام)، فيعمل التنظيف باستعلامات مفهرسة بدل مسح المجلد في كل دورة:
+# - chart: شارت رُفع ولم يُحلل خلال STORAGE_CHART_TTL (ما لم تنتظره مهمة في الطابور).
+# - article: صورة مقال لم يعد أي مقال يشير إليها بعد مهلة STORAGE_ARTICLE_GRACE.
+# - blob: نسخة المحتوى المشتركة (chart_storage) بلا أي رابط رفع ولم تُستخدم منذ STORAGE_BLOB_TTL.
+# فوق الحصة STORAGE_QUOTA_BYTES نحذف الأقدم استخداماً (LRU) من الملفات غير المرجعية.
+# مسح المجلد الكامل يتم فقط للمزامنة النادرة (STORAGE_RECONCILE_INTERVAL).
+
+import os
+import socket
+import shutil
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+
+import image_pipeline
+import chart_storage
+from chart_storage import STORAGE_PATH, BLOB_DIR
+from database import SessionLocal, StoredFile, Article, AnalysisJob, InflightAnalysis
+
+# -----------------------------------------------------------------
+# 1. الإعدادات (Environment Settings)
+# -----------------------------------------------------------------
+
+STORAGE_GC_INTERVAL = int(os.getenv("STORAGE_GC_INTERVAL", "600"))
+STORAGE_CHART_TTL = int(os.getenv("STORAGE_CHART_TTL", "3600"))
+STORAGE_ARTICLE_GRACE = int(os.getenv("STORAGE_ARTICLE_GRACE", str(24 * 3600)))
+STORAGE_BLOB_TTL = int(os.getenv("STORAGE_BLOB_TTL", str(7 * 24 * 3600)))
+# 0 = 90% من سعة القرص
+STORAGE_QUOTA_BYTES = int(os.getenv("STORAGE_QUOTA_BYTES", "0"))
+STORAGE_RECONCILE_INTERVAL = int(os.getenv("STORAGE_RECONCILE_INTERVAL", str(24 * 3600)))
+STORAGE_GC_BATCH = 500
+
+GC_LOCK_KEY = "maintenance:storage-gc"
+# صف بمدة STORAGE_RECONCILE_INTERVAL: المسح الكامل مرة واحدة لكل المجموعة في كل فترة
+RECONCILE_LOCK_KEY = "maintenance:storage-reconcile"
+OWNER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+LAST_RUN = {}
+
+
+# -----------------------------------------------------------------
+# 2. تسجيل الملفات (File Index)
+# -----------------------------------------------------------------
+
+def _abs(rel: str) -> str:
+    return os.path.join(STORAGE_PATH, rel)
+
+
+def register(rel: str, kind: str, size: int = None):
+    if size is None:
+        try:
+            size = os.path.getsize(_abs(rel))
+        except OSError:
+            size = 0
+    db = SessionLocal()
+    try:
+        now = datetime.now(timezone.utc)
+        db.merge(StoredFile(path=rel, kind=kind, size=size, created_at=now, last_access_at=now))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"Storage Manager Error: {e}")
+    finally:
+        db.close()
+
+
+def touch(rel: str):
+    db = SessionLocal()
+    try:
+        db.query(StoredFile).filter(StoredFile.path == rel).update(
+            {"last_access_at": datetime.now(timezone.utc)}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def forget(rel: str):
+    db = SessionLocal()
+    try:
+        db.query(StoredFile).filter(StoredFile.path == rel).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def record_chart_upload(name: str, sha256: str, deduplicated: bool):
+    # ملف الرفع رابط صلب لنسخة المحتوى: حجمه الحقيقي محسوب على blob وحده
+    blob_rel = os.path.relpath(chart_storage.blob_path(sha256), STORAGE_PATH)
+    db = SessionLocal()
+    try:
+        now = datetime.now(timezone.utc)
+        shared = os.stat(_abs(name)).st_nlink > 1
+        size = 0 if shared else os.path.getsize(_abs(name))
+        db.merge(StoredFile(path=name, kind="chart", size=size, created_at=now, last_access_at=now))
+        updated = db.query(StoredFile).filter(StoredFile.path == blob_rel).update(
+            {"last_access_at": now}, synchronize_session=False
+        )
+        if not updated and shared:
+            db.add(StoredFile(path=blob_rel, kind="blob", size=os.path.getsize(_abs(blob_rel)), created_at=now, last_access_at=now))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"Storage Manager Error: {e}")
+    finally:
+        db.close()
+
+
+def _delete_file(rel: str) -> int:
+    path = _abs(rel)
+    freed = 0
+    for target in (path, image_pipeline.meta_path(path)):
+        try:
+            freed += os.path.getsize(target)
+            os.remove(target)
+        except OSError:
+            pass
+    if rel.startswith("blobs/"):
+        # مجلد التقسيم (blobs/ab/) يُحذف إذا أصبح فارغاً
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+    return freed
+
+
+def _blob_in_use(rel: str) -> bool:
+    # نسخة المحتوى مستخدمة طالما يوجد رابط رفع واحد على الأقل (hard link)
+    try:
+        return os.stat(_abs(rel)).st_nlink > 1
+    except OSError:
+        return False
+
+
+# -----------------------------------------------------------------
+# 3. المراجع (References That Must Survive GC)
+# -----------------------------------------------------------------
+
+def _active_job_files(db) -> set:
+    return {
+        f for (f,) in db.query(AnalysisJob.filename).filter(AnalysisJob.status.in_(("queued", "running"))).all()
+    }
+
+
+def _stem(rel: str) -> str:
+    # art_<id>.png ونسخه art_<id>.w320.webp تشترك في نفس الجذر
+    return os.path.basename(rel).split(".", 1)[0]
+
+
+def _article_refs(db) -> set:
+    refs = set()
+    for (url,) in db.query(Article.image_url).filter(Article.image_url.isnot(None)).all():
+        if url and "/images/" in url:
+            refs.add(_stem(url.split("/images/", 1)[1].split("?", 1)[0]))
+    return refs
+
+
+def _is_unreferenced(row: StoredFile, jobs: set, articles: set) -> bool:
+    if row.kind == "chart":
+        return row.path not in jobs
+    if row.kind == "article":
+        return _stem(row.path) not in articles
+    if row.kind == "blob":
+        return not _blob_in_use(row.path)
+    return False
+
+
+# -----------------------------------------------------------------
+# 4. دورة التنظيف (GC Run)
+# -----------------------------------------------------------------
+
+def _purge(db, rows, jobs: set, articles: set, stats: dict):
+    for row in rows:
+        if not _is_unreferenced(row, jobs, articles):
+            continue
+        stats["bytes_freed"] += _delete_file(row.path)
+        stats["deleted"][row.kind] = stats["deleted"].get(row.kind, 0) + 1
+        db.delete(row)
+    db.commit()
+
+
+def quota_bytes() -> int:
+    if STORAGE_QUOTA_BYTES > 0:
+        return STORAGE_QUOTA_BYTES
+    try:
+        return int(shutil.disk_usage(STORAGE_PATH).total * 0.9)
+    except OSError:
+        return 0
+
+
+def collect_garbage() -> dict:
+    stats = {"deleted": {}, "bytes_freed": 0, "evicted": 0}
+    db = SessionLocal()
+    try:
+        now = datetime.now(timezone.utc)
+        jobs = _active_job_files(db)
+        articles = _article_refs(db)
+
+        # 1) الملفات اليتيمة حسب النوع والعمر (استعلامات مفهرسة على kind + created_at)
+        for kind, field, ttl in (
+            ("chart", StoredFile.created_at, STORAGE_CHART_TTL),
+            ("article", StoredFile.created_at, STORAGE_ARTICLE_GRACE),
+            ("blob", StoredFile.last_access_at, STORAGE_BLOB_TTL),
+        ):
+            cutoff = now - timedelta(seconds=ttl)
+            last_path = ""
+            while True:
+                rows = (
+                    db.query(StoredFile)
+                    .filter(StoredFile.kind == kind, field < cutoff, StoredFile.path > last_path)
+                    .order_by(StoredFile.path)
+                    .limit(STORAGE_GC_BATCH)
+                    .all()
+                )
+                if not rows:
+                    break
+                last_path = rows[-1].path
+                _purge(db, rows, jobs, articles, stats)
+
+        # 2) الحصة: إخلاء الأقدم استخداماً من غير المرجعي حتى ننزل تحت الحد
+        quota = quota_bytes()
+        total = db.query(func.coalesce(func.sum(StoredFile.size), 0)).scalar()
+        if quota and total > quota:
+            offset = 0
+            while total > quota:
+                rows = (
+                    db.query(StoredFile)
+                    .order_by(StoredFile.last_access_at.asc())
+                    .offset(offset)
+                    .limit(STORAGE_GC_BATCH)
+                    .all()
+                )
+                if not rows:
+                    break
+                for row in rows:
+                    if total <= quota:
+                        break
+                    if not _is_unreferenced(row, jobs, articles):
+                        offset += 1
+                        continue
+                    total -= row.size or 0
+                    stats["bytes_freed"] += _delete_file(row.path)
+                    stats["evicted"] += 1
+                    db.delete(row)
+                db.commit()
+    finally:
+        db.close()
+
+    stats["finished_at"] = datetime.now(timezone.utc).isoformat()
+    LAST_RUN.clear()
+    LAST_RUN.update(stats)
+    return stats
+
+
+# -----------------------------------------------------------------
+# 5. المزامنة النادرة مع القرص (Reconcile Index With Disk)
+# -----------------------------------------------------------------
+
+def _classify(rel: str):
+    if rel.endswith(".json") or rel.endswith(".tmp"):
+        return None
+    if rel.startswith("blobs/"):
+        return "blob"
+    if os.path.basename(rel).startswith("art_"):
+        return "article"
+    return "chart"
+
+
+def _walk_storage():
+    with os.scandir(STORAGE_PATH) as entries:
+        for entry in entries:
+            if entry.is_file():
+                yield entry.name, entry
+    if os.path.isdir(BLOB_DIR):
+        with os.scandir(BLOB_DIR) as shards:
+            for shard in shards:
+                if shard.is_dir():
+                    with os.scandir(shard.path) as entries:
+                        for entry in entries:
+                            if entry.is_file():
+                                yield f"blobs/{shard.name}/{entry.name}", entry
+
+
+def reconcile():
+    # يضيف ملفات قديمة غير مسجلة (رُفعت قبل الفهرس) ويحذف صفوف ملفات اختفت
+    db = SessionLocal()
+    try:
+        known = {p for (p,) in db.query(StoredFile.path).all()}
+        seen = set()
+        for rel, entry in _walk_storage():
+            kind = _classify(rel)
+            if kind is None:
+                continue
+            seen.add(rel)
+            if rel not in known:
+                st = entry.stat()
+                mtime = datetime.fromtimestamp(st.st_mtime, timezone.utc)
+                size = 0 if kind == "chart" and st.st_nlink > 1 else st.st_size
+                db.add(StoredFile(path=rel, kind=kind, size=size, created_at=mtime, last_access_at=mtime))
+        missing = known - seen
+        if missing:
+            db.query(StoredFile).filter(StoredFile.path.in_(missing)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+# -----------------------------------------------------------------
+# 6. القفل بين العمال + المهمة الخلفية (Worker Lease & Loop)
+# -----------------------------------------------------------------
+
+def _try_lease(key: str, seconds: int) -> bool:
+    # نفس جدول أقفال single_flight: صف واحد بمفتاح ثابت ومدة صلاحية
+    db = SessionLocal()
+    try:
+        now = datetime.now(timezone.utc)
+        db.query(InflightAnalysis).filter(
+            InflightAnalysis.cache_key == key, InflightAnalysis.expires_at < now
+        ).delete(synchronize_session=False)
+        db.add(InflightAnalysis(cache_key=key, owner=OWNER_ID, expires_at=now + timedelta(seconds=seconds)))
+        db.commit()
+        return True
+    except IntegrityError:
+        db.rollback()
+        return False
+    finally:
+        db.close()
+
+
+def run_once() -> dict:
+    if not _try_lease(GC_LOCK_KEY, STORAGE_GC_INTERVAL):
+        return None
+    # القفل يبقى حتى انتهاء مدته: عامل واحد فقط ينظف في كل دورة
+    # المسح الكامل يتم تحت نفس القفل، وتوقيته محفوظ في قاعدة البيانات وليس في ذاكرة العامل:
+    # أول دورة بعد نشر جديد تمسح إن لم يتم مسح خلال الفترة، ولا يكرره بقية العمال
+    if _try_lease(RECONCILE_LOCK_KEY, STORAGE_RECONCILE_INTERVAL):
+        reconcile()
+    return collect_garbage()
+
+
+async def _gc_loop():
+    while True:
+        try:
+            await run_in_threadpool(run_once)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Storage Manager Error: {e}")
+        await asyncio.sleep(STORAGE_GC_INTERVAL)
+
+
+def start_gc():
+    return asyncio.create_task(_gc_loop())
+
+
+def stats() -> dict:
+    db = SessionLocal()
+    try:
+        by_kind = {
+            kind: {"files": count, "bytes": int(size or 0)}
+            for kind, count, size in db.query(StoredFile.kind, func.count(StoredFile.path), func.sum(StoredFile.size)).group_by(StoredFile.kind).all()
+        }
+    finally:
+        db.close()
+    try:
+        disk = shutil.disk_usage(STORAGE_PATH)
+        disk = {"total": disk.total, "used": disk.used, "free": disk.free}
+    except OSError:
+        disk = None
+    return {
+        "by_kind": by_kind,
+        "tracked_bytes": sum(v["bytes"] for v in by_kind.values()),
+        "quota_bytes": quota_bytes(),
+        "disk": disk,
+        "last_run": dict(LAST_RUN),
+    }